@@ -0,0 +1,834 @@
+"""Asyncio-native serving mode for the WhatsApp bot.
+
+Runs the same webhook pipeline as main.py (dedup, per-user ordering, first-time
+welcome, location detection, history, response cache, streaming, rolling
+summaries) but every I/O wait is awaited instead of holding a thread:
+Mongo goes through pymongo's AsyncMongoClient, the Graph API through a pooled
+httpx.AsyncClient and completions through groq.AsyncGroq. One process can then
+keep thousands of conversations in flight.
+
+    uvicorn asgi:app --host 0.0.0.0 --port $PORT
+
+Configuration is the same .env as main.py, which is imported for its settings,
+prompt building, caches and metrics registry.
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+import uuid
+from datetime import datetime, timezone
+from urllib.parse import parse_qs
+
+import httpx
+from pymongo import AsyncMongoClient
+from pymongo.errors import DuplicateKeyError
+
+import main
+from main import (
+    AI_STREAMING, ASYNC_WEBHOOK, COALESCE_MAX_WAIT, COALESCE_WINDOW, DATABASE_NAME, COLLECTION_NAME,
+    DB_HEALTH_INTERVAL, DB_READY_TIMEOUT, DEDUP_PERSIST, DELIVERY_TRACKING_ENABLED, GROQ_API_KEY, HISTORY_CACHE_ENABLED,
+    HISTORY_CACHE_VERIFY, LOCATION_COLLECTION_NAME, MEMORY_LIMIT, MONGO_URI, PHONE_NUMBER_ID,
+    QUEUE_DRAIN_TIMEOUT, QUEUE_MAXSIZE, RATE_LIMIT_BACKEND, RATE_LIMIT_ENABLED, RESPONSE_CACHE_ENABLED,
+    SUMMARY_ENABLED, USER_SUMMARY_COLLECTION_NAME, USERS_COLLECTION_NAME, VERIFY_TOKEN, WHATSAPP_TOKEN,
+    Histogram, LLMGateway, LLMUnavailableError, WhatsAppSender,
+    delivery_tracker, dev_log, history_cache, history_cache_is_current, is_status_only_payload, known_users,
+    load_shedder, make_user_safe_error, message_dedup, metrics, rate_limiter, response_cache,
+    validate_webhook_payload,
+)
+
+
+class AsyncWhatsAppSender(WhatsAppSender):
+    """WhatsAppSender over an httpx.AsyncClient: same pacing, retry and backoff rules, no blocked threads."""
+
+    # failures before the request went out; a read/write error or a server that drops the
+    # connection (RemoteProtocolError) may come after Meta accepted the message
+    CONNECT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+    MAYBE_SENT_ERRORS = (httpx.TimeoutException, httpx.NetworkError, httpx.RemoteProtocolError)
+
+    def _get_session(self) -> httpx.AsyncClient:
+        # created inside the running loop, one pool per uvicorn worker; like requests' non-blocking
+        # pool, bursts open extra connections and only pool_size of them are kept alive
+        if self._session is None:
+            self._session = httpx.AsyncClient(
+                headers=self.headers,
+                timeout=10,
+                limits=httpx.Limits(max_connections=None, max_keepalive_connections=self.pool_size),
+            )
+        return self._session
+
+    async def _acquire(self):
+        while not self.bucket.try_acquire():
+            await asyncio.sleep(1 / self.bucket.rate)
+
+    async def send(self, to: str, text: str) -> bool:
+        payload = self._payload(to, text)
+        session = self._get_session()
+        for attempt in range(self.max_retries + 1):
+            if self.bucket is not None:
+                await self._acquire()
+            started = time.perf_counter()
+            retry_after = None
+            try:
+                r = await session.post(self.url, json=payload)
+            except Exception as e:
+                if not self._on_error(e, attempt, started):
+                    return False
+            else:
+                sent, retry_after = self._on_response(r, attempt, started)
+                if sent is not None:
+                    return sent
+
+            delay = self._retry_delay(attempt, retry_after)
+            if delay is not None:
+                await asyncio.sleep(delay)
+
+        return self._give_up()
+
+    async def aclose(self):
+        if self._session is not None:
+            await self._session.aclose()
+            self._session = None
+
+
+class AsyncLLMGateway(LLMGateway):
+    """LLMGateway for AsyncGroq: the in-flight cap is an asyncio.Semaphore, the breaker is inherited."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._max_inflight = max(1, kwargs.get("max_inflight", 1))
+        self._async_slots = None
+
+    async def complete(self, messages: list, stream: bool = False, client=None):
+        if client is None:
+            raise LLMUnavailableError("AI client not configured")
+        if self._async_slots is None:
+            self._async_slots = asyncio.Semaphore(self._max_inflight)
+        trial = self._admit()
+        try:
+            await asyncio.wait_for(self._async_slots.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            raise self._no_slot(trial) from None
+
+        self._enter()
+        released = False
+        try:
+            last_error = None
+            for model, remaining in self._attempts():
+                started = time.perf_counter()
+                try:
+                    result = await client.chat.completions.create(
+                        model=model, messages=messages, stream=stream, timeout=remaining
+                    )
+                except Exception as e:
+                    last_error = self._failed(model, started, e)
+                    continue
+                if stream:
+                    released = True  # the stream wrapper gives the slot back once consumed
+                    return self._guarded_async_stream(result, model, started, trial)
+                self._succeeded(started, trial)
+                return result
+            raise self._exhausted(last_error, trial)
+        finally:
+            if not released:
+                self._release()
+
+    async def _guarded_async_stream(self, stream, model: str, started: float, trial: bool):
+        ok = False
+        try:
+            async for chunk in stream:
+                yield chunk
+            ok = True
+        except Exception:
+            self._count(self.errors, model)
+            raise
+        finally:
+            self._stream_done(started, ok, trial)
+
+    def _release(self):
+        with self._lock:
+            self.inflight -= 1
+        self._async_slots.release()
+
+
+class AsyncBot:
+    """Owns the async clients and runs the webhook pipeline for one event loop."""
+
+    def __init__(self):
+        self.mongo_client = None
+        self.collection = None
+        self.location_collection = None
+        self.summary_collection = None
+        self.users_collection = None
+        self.mongo_healthy = False
+        self._mongo_ready = asyncio.Event()
+        self._mongo_task = None
+        self.ai_client = None
+        self.sender = AsyncWhatsAppSender(
+            main.GRAPH_API_URL, PHONE_NUMBER_ID, WHATSAPP_TOKEN,
+            pool_size=main.WHATSAPP_POOL_SIZE,
+            max_rps=main.WHATSAPP_MAX_RPS,
+            max_retries=main.WHATSAPP_MAX_RETRIES,
+            backoff_base=main.WHATSAPP_BACKOFF_BASE,
+        )
+        self.llm = AsyncLLMGateway(
+            main.AI_MODELS,
+            timeout=main.AI_TIMEOUT,
+            max_inflight=main.AI_MAX_INFLIGHT,
+            queue_timeout=main.AI_QUEUE_TIMEOUT,
+            failure_threshold=main.AI_BREAKER_THRESHOLD,
+            reset_timeout=main.AI_BREAKER_RESET,
+        )
+        self.ttfm = Histogram()
+        self._user_locks = {}  # user_id -> [asyncio.Lock, waiters]; keeps each user's turns in order
+        self._tasks = set()  # early-acked messages and coalesced bursts still being handled
+        self._bursts = {}  # user_id -> pending burst (COALESCE_WINDOW)
+        self._burst_tasks = {}  # user_id -> task answering that user's bursts
+        self.coalesced_messages = 0
+        self.coalesced_turns = 0
+        self._startup_lock = asyncio.Lock()
+        self.started = False
+
+    async def startup(self):
+        async with self._startup_lock:
+            if not self.started:
+                await self._connect()
+
+    async def _connect(self):
+        main.database_supervisor.start()  # main's sync collections (summaries, dedup, archive) in this worker
+        if GROQ_API_KEY:
+            try:
+                from groq import AsyncGroq
+                self.ai_client = AsyncGroq(api_key=GROQ_API_KEY, max_retries=0)  # AsyncLLMGateway owns retries
+                logging.info("200 AI service ready (async)")
+            except Exception as e:
+                dev_log(e, "ERR400")
+        if MONGO_URI:
+            # connect in the background like main.DatabaseSupervisor: serving starts at once, /readyz waits
+            self._mongo_task = asyncio.create_task(self._supervise_mongo())
+        self.started = True
+
+    async def _supervise_mongo(self):
+        while True:
+            try:
+                if self.mongo_client is None:
+                    self.mongo_client = AsyncMongoClient(
+                        MONGO_URI,
+                        serverSelectionTimeoutMS=15000,
+                        connectTimeoutMS=15000,
+                        socketTimeoutMS=15000,
+                        maxPoolSize=100,
+                        retryWrites=True,
+                    )
+                await self.mongo_client.admin.command("ping")
+                self.mongo_healthy = True
+                if self.collection is None:
+                    db = self.mongo_client[DATABASE_NAME]
+                    self.location_collection = db[LOCATION_COLLECTION_NAME]
+                    self.summary_collection = db[USER_SUMMARY_COLLECTION_NAME]
+                    self.users_collection = db[USERS_COLLECTION_NAME]
+                    self.collection = db[COLLECTION_NAME]
+                    self._mongo_ready.set()
+                    logging.info("200 Database connected (async)")
+            except Exception as e:
+                self.mongo_healthy = False
+                if self.collection is None:
+                    dev_log(e, "ERRDB_CONN")
+                    logging.error("Async MongoDB connection failed; memory and location features disabled until it recovers.")
+                else:
+                    logging.error("Async database health check failed: %s", e)
+            await asyncio.sleep(DB_HEALTH_INTERVAL)
+
+    async def wait_ready(self, timeout: float) -> bool:
+        """Wait until the async database has been connected once; False after `timeout` seconds."""
+        try:
+            await asyncio.wait_for(self._mongo_ready.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def readiness(self) -> tuple[bool, dict]:
+        ready, details = main.readiness()
+        if MONGO_URI:
+            if self.collection is None:
+                details["async_database"] = "connecting"
+            else:
+                details["async_database"] = "ok" if self.mongo_healthy else "unhealthy"
+            ready = ready and details["async_database"] == "ok"
+        return ready, details
+
+    async def shutdown(self):
+        await self.drain()
+        if self._mongo_task is not None:
+            self._mongo_task.cancel()
+            self._mongo_task = None
+        await self.sender.aclose()
+        if self.ai_client is not None:
+            await self.ai_client.close()
+        if self.mongo_client is not None:
+            await self.mongo_client.close()
+        self.started = False
+
+    async def drain(self, timeout: float = QUEUE_DRAIN_TIMEOUT):
+        if self._tasks:
+            logging.info("Draining %d in-flight messages", len(self._tasks))
+            await asyncio.wait(set(self._tasks), timeout=timeout)
+
+    # --- storage -------------------------------------------------------------------------
+
+    async def is_first_time_user(self, user_id: str) -> bool:
+        """main.KnownUserRegistry.is_new over the async collections (same in-process id cache)."""
+        if self.collection is None:
+            return True
+        if known_users.contains(user_id):
+            return False
+        if self.users_collection is not None:
+            now = datetime.now(timezone.utc)
+            try:
+                await self.users_collection.insert_one({"_id": user_id, "first_seen": now})
+            except DuplicateKeyError:
+                known_users.add(user_id)
+                return False
+            except Exception as e:
+                dev_log(e, "ERR_KNOWN_USERS")
+            else:
+                known_users.inserts += 1
+                known_users.add(user_id)
+                return not await self._has_messages(user_id, before=now)
+        known_users.fallbacks += 1
+        is_new = not await self._has_messages(user_id)
+        if not is_new:
+            known_users.add(user_id)
+        return is_new
+
+    async def _has_messages(self, user_id: str, before: datetime | None = None) -> bool:
+        query = {"user_id": user_id}
+        if before is not None:
+            query["timestamp"] = {"$lt": before}
+        try:
+            if await self.collection.find_one(query, {"_id": 1}) is not None:
+                return True
+            if main.archive_collection is None:
+                return False
+            archived = await asyncio.to_thread(main.archive_collection.find_one, {"user_id": user_id}, {"_id": 1})
+            return archived is not None
+        except Exception:
+            return False
+
+    async def save_user_location(self, user_id: str, location_data: dict, user_name: str | None = None) -> bool:
+        if self.location_collection is None:
+            return False
+        update = main._location_update(location_data, user_name, datetime.now(timezone.utc))
+        try:
+            try:
+                await self.location_collection.update_one({"user_id": user_id}, update, upsert=True)
+            except DuplicateKeyError:
+                await self.location_collection.update_one({"user_id": user_id}, update, upsert=True)
+            main.invalidate_user_context(user_id)
+            logging.info("200 Location extracted")
+            return True
+        except Exception as e:
+            dev_log(e, "ERR_LOCATION_SAVE")
+            logging.error("Failed to save location for user %s", user_id[-4:])
+            return False
+
+    async def save_message(self, user_id: str, message: str, sender_type: str, message_type: str = "text",
+                           user_name: str | None = None, phone_number: str | None = None) -> bool:
+        if self.collection is None:
+            logging.info("DB disabled, skipping save.")
+            return False
+        try:
+            with metrics.stage("save_message_to_db"):
+                now = datetime.now(timezone.utc)
+                doc = {
+                    "user_id": user_id,
+                    "message": message,
+                    "sender_type": sender_type,
+                    "message_type": message_type,
+                    "timestamp": now,
+                    "created_at": now.isoformat(),
+                    "user_name": user_name,
+                    "phone_number": phone_number,
+                    "conversation_id": f"chat_{user_id}",
+                }
+                await self.collection.insert_one(doc)
+                logging.info("200 Saved message to database")
+                if self.summary_collection is not None:
+                    try:
+                        await self.summary_collection.update_one(
+                            {"_id": user_id},
+                            main._summary_update(user_id, sender_type, now, user_name, phone_number),
+                            upsert=True
+                        )
+                    except Exception as e:
+                        dev_log(e, "ERR_SUMMARY_SAVE")
+            if HISTORY_CACHE_ENABLED:
+                history_cache.append(user_id, {
+                    "sender_type": sender_type,
+                    "message": message,
+                    "timestamp": now,
+                    "user_name": user_name,
+                    "conversation_id": doc["conversation_id"]
+                })
+            return True
+        except Exception as e:
+            dev_log(e, "ERR100")
+            logging.error("Failed to save message for user %s", user_id)
+            return False
+
+    async def get_conversation_history(self, user_id: str) -> list:
+        if self.collection is None:
+            return []
+        if HISTORY_CACHE_ENABLED:
+            cached = history_cache.get(user_id, MEMORY_LIMIT)
+            if cached is not None and HISTORY_CACHE_VERIFY:
+                try:
+                    summary = await self.summary_collection.find_one({"_id": user_id}, {"last_message": 1})
+                except Exception as e:
+                    dev_log(e, "ERR200")
+                    summary = {"last_message": datetime.max}  # unverifiable: read from Mongo
+                if not history_cache_is_current(history_cache.newest(user_id), summary):
+                    history_cache.discard(user_id)
+                    cached = None
+            if cached is not None:
+                return cached
+        try:
+            with metrics.stage("get_conversation_history"):
+                cursor = self.collection.find(
+                    {"user_id": user_id, "conversation_id": f"chat_{user_id}"}
+                ).sort("timestamp", -1).limit(MEMORY_LIMIT)
+                records = await cursor.to_list(MEMORY_LIMIT)
+            history = [{
+                "sender_type": r.get("sender_type"),
+                "message": r.get("message"),
+                "timestamp": r.get("timestamp"),
+                "user_name": r.get("user_name"),
+                "conversation_id": r.get("conversation_id")
+            } for r in reversed(records)]
+            if len(history) < MEMORY_LIMIT and main.archive_collection is not None:
+                # the archive tier is read through main's sync client, off the loop
+                oldest = records[-1].get("timestamp") if records else None
+                history = await asyncio.to_thread(
+                    main.archived_history, user_id, MEMORY_LIMIT - len(history), oldest
+                ) + history
+            if HISTORY_CACHE_ENABLED:
+                history_cache.load(user_id, history)
+            return history
+        except Exception as e:
+            dev_log(e, "ERR200")
+            logging.error("Failed to retrieve conversation history for user %s", user_id[-4:])
+            return []
+
+    async def build_system_prompt(self, user_id: str) -> str:
+        block = main.cached_user_context(user_id)
+        if block is None:
+            location_data = None
+            if self.location_collection is not None:
+                try:
+                    location_data = await self.location_collection.find_one({"user_id": user_id})
+                except Exception as e:
+                    dev_log(e, "ERR_LOCATION_GET")
+            block = main.format_user_context(user_id, location_data)
+            main.remember_user_context(user_id, block)
+        return main._PROMPT_HEAD + block + main._PROMPT_RULES
+
+    async def build_chat_messages(self, user_id: str, user_text: str) -> list:
+        history = await self.get_conversation_history(user_id)
+        summary = None
+        if SUMMARY_ENABLED:
+            # usually an in-process dict hit; a cold user costs one sync read, kept off the loop
+            summary = await asyncio.to_thread(main.get_conversation_summary, user_id)
+        system_prompt = await self.build_system_prompt(user_id)
+        return main.assemble_chat_messages(user_id, user_text, history, system_prompt, summary)
+
+    # --- replies ---------------------------------------------------------------------------
+
+    async def send_message(self, to: str, text: str) -> bool:
+        if not WHATSAPP_TOKEN or not PHONE_NUMBER_ID:
+            logging.error("WhatsApp token or phone id missing.")
+            return False
+        with metrics.stage("send_message"):
+            return await self.sender.send(to, text)
+
+    async def generate_reply(self, user_id: str, user_text: str) -> str:
+        default_reply = f"Echo: {user_text}"
+        if not self.ai_client:
+            return default_reply
+
+        scope = main.response_cache_scope(user_id)
+        shared = RESPONSE_CACHE_ENABLED and response_cache.applies(user_text)
+        if shared:
+            cached = response_cache.lookup(user_text, scope)
+            if cached:
+                logging.info("200 Answered from response cache")
+                return cached
+
+        try:
+            if shared:
+                messages = main.response_cache_messages(user_text)
+            else:
+                messages = await self.build_chat_messages(user_id, user_text)
+            started = time.perf_counter()
+            completion = await self.llm.complete(messages, client=self.ai_client)
+            ai_text = completion.choices[0].message.content.strip()  # type: ignore
+            if ai_text and shared:
+                response_cache.store(user_text, ai_text, time.perf_counter() - started, scope)
+            return ai_text or default_reply
+        except LLMUnavailableError as e:
+            logging.error("AI unavailable: %s", e)
+            return make_user_safe_error("ERR400")
+        except Exception as e:
+            dev_log(e, "ERR400")
+            return make_user_safe_error("ERR400")
+
+    async def stream_reply(self, user_id: str, user_text: str) -> tuple[str, bool]:
+        """Async counterpart of main.stream_ai_reply: (reply_text, already_sent)."""
+        default_reply = f"Echo: {user_text}"
+        if not self.ai_client:
+            return default_reply, False
+
+        scope = main.response_cache_scope(user_id)
+        shared = RESPONSE_CACHE_ENABLED and response_cache.applies(user_text)
+        if shared:
+            cached = response_cache.lookup(user_text, scope)
+            if cached:
+                logging.info("200 Answered from response cache")
+                return cached, False
+
+        started = time.perf_counter()
+        delivered = []
+        buffer = ""
+
+        async def deliver(part: str):
+            part = part.strip()
+            if not part:
+                return
+            if not await self.send_message(user_id, part):
+                logging.error("Failed to send streamed chunk to %s", user_id)
+            if not delivered:
+                self.ttfm.observe(time.perf_counter() - started)
+            delivered.append(part)
+
+        try:
+            if shared:
+                messages = main.response_cache_messages(user_text)
+            else:
+                messages = await self.build_chat_messages(user_id, user_text)
+            stream = await self.llm.complete(messages, stream=True, client=self.ai_client)
+            async for chunk in stream:
+                parts, buffer = main.cut_stream_buffer(buffer + main.stream_delta(chunk))
+                for part in parts:
+                    await deliver(part)
+            await deliver(buffer)
+            if delivered and shared:
+                response_cache.store(user_text, "\n\n".join(delivered), time.perf_counter() - started, scope)
+        except LLMUnavailableError as e:
+            logging.error("AI unavailable: %s", e)
+            return make_user_safe_error("ERR400"), False
+        except Exception as e:
+            dev_log(e, "ERR400")
+            if not delivered:
+                return make_user_safe_error("ERR400"), False
+
+        if not delivered:
+            return default_reply, False
+        return "\n\n".join(delivered), True
+
+    # --- pipeline --------------------------------------------------------------------------
+
+    async def handle_incoming_message(self, message: dict, contacts: list) -> None:
+        """Per-user ordered version of main.handle_incoming_message."""
+        user_id = message.get("from")
+        entry = self._user_locks.setdefault(user_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await self._admit(message, contacts)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                self._user_locks.pop(user_id, None)
+
+    @staticmethod
+    async def _rate_limit_call(fn, *args):
+        # deferred texts live in the rate_limits collection with the mongo backend: keep that read off the loop
+        if RATE_LIMIT_BACKEND == "mongo":
+            return await asyncio.to_thread(fn, *args)
+        return fn(*args)
+
+    async def _admit(self, message: dict, contacts: list) -> None:
+        """Per-user limiter and global shedder, as in main.handle_incoming_message."""
+        user_id = message.get("from")
+        if RATE_LIMIT_ENABLED:
+            if RATE_LIMIT_BACKEND == "mongo":
+                allowed = await asyncio.to_thread(rate_limiter.allow, user_id)
+            else:
+                allowed = rate_limiter.allow(user_id)
+            if not allowed:
+                notice = await self._rate_limit_call(main.turn_away_reply, user_id, message, "user")
+                if notice:
+                    await self.send_message(user_id, notice)
+                return
+        if not load_shedder.try_enter():
+            notice = await self._rate_limit_call(main.turn_away_reply, user_id, message, "global")
+            if notice:
+                await self.send_message(user_id, notice)
+            return
+        try:
+            await self._handle(await self._rate_limit_call(main.with_deferred_texts, user_id, message), contacts)
+        finally:
+            load_shedder.leave()
+
+    async def _handle(self, message: dict, contacts: list) -> None:
+        user_id = message.get("from")
+        msg_type = message.get("type", "unknown")
+        user_name = None
+        user_phone = user_id
+
+        for contact in contacts:
+            if contact.get("wa_id") == user_id:
+                user_name = contact.get("profile", {}).get("name")
+                break
+
+        if msg_type != "text":
+            await self.save_message(user_id, f"[{msg_type.upper()}]", "user", msg_type)
+            await self.send_message(user_id, "I currently support text messages only. "
+                                             "Please send your request as text.")
+            return
+
+        text_body = (message.get("text") or {}).get("body")
+        if not text_body:
+            return
+
+        is_new_user = await self.is_first_time_user(user_id)
+        if is_new_user:
+            location_data = main.detect_user_location(user_id)
+            if location_data:
+                await self.save_user_location(user_id, location_data, user_name)
+            logging.info("New user registered")
+
+        if not await self.save_message(user_id, text_body, "user", "text", user_name, user_phone):
+            await self.send_message(user_id, make_user_safe_error("ERR100"))
+            return
+
+        if is_new_user:
+            welcome_msg = main.build_welcome_message(user_name)
+            await self.send_message(user_id, welcome_msg)
+            await self.save_message(user_id, welcome_msg, "bot", "text", user_name, user_phone)
+
+        if COALESCE_WINDOW > 0:
+            self._coalesce(user_id, text_body, user_name, user_phone)
+        else:
+            await self._reply_to_turn(user_id, text_body, user_name, user_phone)
+
+    async def _reply_to_turn(self, user_id: str, text_body: str, user_name: str | None, user_phone: str | None):
+        reply_sent = False
+        if AI_STREAMING:
+            reply_text, reply_sent = await self.stream_reply(user_id, text_body)
+        else:
+            reply_text = await self.generate_reply(user_id, text_body)
+
+        await self.save_message(user_id, reply_text, "bot", "text", user_name, user_phone)
+        main.note_turns_for_summary(user_id, [text_body, reply_text])
+
+        if not reply_sent and not await self.send_message(user_id, reply_text):
+            logging.error("Failed to send WhatsApp message to %s", user_id)
+
+    def _coalesce(self, user_id: str, text: str, user_name: str | None, user_phone: str | None):
+        """Event-loop version of main.MessageCoalescer: one flusher task per user with a pending burst."""
+        now = asyncio.get_running_loop().time()
+        burst = self._bursts.get(user_id)
+        if burst is None:
+            burst = self._bursts[user_id] = {"texts": [], "first": now, "user_name": user_name,
+                                             "user_phone": user_phone}
+        burst["texts"].append(text)
+        burst["due"] = min(now + COALESCE_WINDOW, burst["first"] + max(COALESCE_WINDOW, COALESCE_MAX_WAIT))
+        self.coalesced_messages += 1
+        if user_id not in self._burst_tasks:
+            task = asyncio.create_task(self._flush_bursts(user_id))
+            self._burst_tasks[user_id] = task
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _flush_bursts(self, user_id: str):
+        loop = asyncio.get_running_loop()
+        try:
+            while user_id in self._bursts:
+                burst = self._bursts[user_id]
+                delay = burst["due"] - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                    continue
+                # texts arriving while this turn is answered start the next burst
+                del self._bursts[user_id]
+                self.coalesced_turns += 1
+                try:
+                    await self._reply_to_turn(user_id, "\n".join(burst["texts"]), burst["user_name"],
+                                              burst["user_phone"])
+                except Exception as e:
+                    dev_log(e, "ERR_COALESCE")
+        finally:
+            self._burst_tasks.pop(user_id, None)
+
+    async def _seen_before(self, message_id: str | None) -> bool:
+        if DEDUP_PERSIST:
+            return await asyncio.to_thread(message_dedup.seen_before, message_id)
+        return message_dedup.seen_before(message_id)
+
+    async def _forget(self, message_id: str | None):
+        if DEDUP_PERSIST:
+            await asyncio.to_thread(message_dedup.forget, message_id)
+        else:
+            message_dedup.forget(message_id)
+
+    async def _run_detached(self, message: dict, contacts: list):
+        try:
+            await self.handle_incoming_message(message, contacts)
+        except Exception as e:
+            await self._forget(message.get("id"))
+            dev_log(e, "ERR_WORKER")
+
+    async def webhook(self, body: bytes) -> tuple[int, dict]:
+        if not DELIVERY_TRACKING_ENABLED and is_status_only_payload(body):
+            metrics.inc("webhook_fast_path_total", {"kind": "status"})
+            return 200, {"status": "received"}
+
+        with metrics.stage("webhook_parse"):
+            try:
+                data = json.loads(body)
+            except ValueError:
+                data = None
+            problem = validate_webhook_payload(data)
+        if problem:
+            metrics.inc("webhook_rejected_total")
+            logging.warning("Rejected malformed webhook payload: %s", problem)
+            return 400, {"status": "invalid", "error": problem}
+        logging.info("200 Received message")
+
+        if MONGO_URI and self.collection is None and not await self.wait_ready(DB_READY_TIMEOUT):
+            # as in main.webhook: never run the pipeline as if the database were disabled
+            logging.error("Database not connected yet; asking WhatsApp to retry")
+            return 503, {"status": "unavailable"}
+
+        try:
+            for entry in data.get("entry", []):
+                for change in entry.get("changes", []):
+                    value = change.get("value", {})
+                    contacts = value.get("contacts") or []
+                    for message in value.get("messages") or []:
+                        message_id = message.get("id")
+                        if await self._seen_before(message_id):
+                            logging.info("Skipping redelivered message")
+                            continue
+
+                        if not ASYNC_WEBHOOK:
+                            try:
+                                await self.handle_incoming_message(message, contacts)
+                            except Exception:
+                                await self._forget(message_id)
+                                raise
+                        elif QUEUE_MAXSIZE and len(self._tasks) >= QUEUE_MAXSIZE:
+                            await self._forget(message_id)
+                            logging.error("Too many messages in flight; asking WhatsApp to retry")
+                            return 503, {"status": "busy"}
+                        else:
+                            task = asyncio.create_task(self._run_detached(message, contacts))
+                            self._tasks.add(task)
+                            task.add_done_callback(self._tasks.discard)
+
+                    if DELIVERY_TRACKING_ENABLED:
+                        for status in value.get("statuses") or []:
+                            delivery_tracker.record(status)  # in-memory; flushed by its own thread
+            return 200, {"status": "received"}
+
+        except Exception as e:
+            error_id = str(uuid.uuid4())[:8]
+            dev_log(e, f"WEBHOOK_ERR_{error_id}")
+            return 500, {"status": "error", "error": f"Internal error {error_id}"}
+
+
+bot = AsyncBot()
+
+metrics.register_histogram("stage_seconds", bot.llm.latency, {"stage": "llm_async"})
+metrics.register_histogram("stream_first_chunk_seconds", bot.ttfm, {"mode": "async"})
+
+@metrics.collector
+def _async_gauges() -> list:
+    llm = bot.llm.stats()
+    return [
+        ("async_inflight_messages", None, len(bot._tasks)),
+        ("async_whatsapp_retries", None, bot.sender.retries),
+        ("async_whatsapp_failures", None, bot.sender.failures),
+        ("async_llm_inflight", None, llm["inflight"]),
+        ("async_llm_rejected", None, llm["rejected"]),
+        ("async_coalesce_messages", None, bot.coalesced_messages),
+        ("async_coalesce_turns", None, bot.coalesced_turns),
+    ]
+
+
+async def _read_body(receive) -> bytes:
+    body = b""
+    while True:
+        event = await receive()
+        body += event.get("body", b"")
+        if not event.get("more_body"):
+            return body
+
+
+async def _respond(send, status: int, body, content_type: str = "application/json"):
+    if not isinstance(body, (bytes, str)):
+        body = json.dumps(body)
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(b"content-type", content_type.encode()), (b"content-length", str(len(body)).encode())]})
+    await send({"type": "http.response.body", "body": body})
+
+
+async def app(scope, receive, send):
+    """ASGI entrypoint: /webhook (GET verify, POST messages), /metrics, /healthz, /readyz and lifespan events."""
+    if scope["type"] == "lifespan":
+        while True:
+            event = await receive()
+            if event["type"] == "lifespan.startup":
+                await bot.startup()
+                await send({"type": "lifespan.startup.complete"})
+            elif event["type"] == "lifespan.shutdown":
+                await bot.shutdown()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    if scope["type"] != "http":
+        return
+    await bot.startup()  # servers without lifespan support
+    path, method = scope["path"], scope["method"]
+
+    if path == "/webhook" and method == "GET":
+        query = parse_qs(scope.get("query_string", b"").decode())
+        if query.get("hub.verify_token", [None])[0] == VERIFY_TOKEN:
+            logging.info("200 Webhook validated")
+            await _respond(send, 200, query.get("hub.challenge", [""])[0], "text/plain")
+        else:
+            logging.error("Invalid verification token")
+            await _respond(send, 403, "Invalid verification token", "text/plain")
+    elif path == "/webhook" and method == "POST":
+        status, payload = await bot.webhook(await _read_body(receive))
+        await _respond(send, status, payload)
+    elif path == "/metrics" and method == "GET":
+        await _respond(send, 200, metrics.render(), "text/plain; version=0.0.4")
+    elif path == "/healthz" and method == "GET":
+        await _respond(send, 200, {"status": "alive", "uptime_seconds": round(time.monotonic() - main._started_at, 1)})
+    elif path == "/readyz" and method == "GET":
+        ready, details = bot.readiness()
+        await _respond(send, 200 if ready else 503, {"status": "ready" if ready else "not ready", **details})
+    else:
+        await _respond(send, 404, {"status": "not found"})
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    port = int(os.environ.get("PORT", 5000))
+    logging.info("WhatsApp Bot (async) starting on port %d", port)
+    uvicorn.run(app, host="0.0.0.0", port=port)
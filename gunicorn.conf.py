@@ -0,0 +1,8 @@
+"""gunicorn settings; `gunicorn main:app` reads ./gunicorn.conf.py on its own."""
+
+
+def post_worker_init(worker):
+    # main starts nothing at import (the master may have imported it with --preload), so each
+    # worker brings up its own database supervisor, MongoClient, archiver and migration here
+    import main
+    main.database_supervisor.start()
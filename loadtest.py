@@ -0,0 +1,818 @@
+"""Offline load test for the WhatsApp bot webhook.
+
+Replays synthetic Meta webhook payloads (text, non-text, status callbacks and
+multi-message batches from many users) against the /webhook POST route of the
+Flask app in main.py, or of the asyncio app in asgi.py with --mode asgi. Groq
+and the Graph API are replaced by local stub HTTP servers with configurable
+latency, and MongoDB by mongomock unless --mongo-uri points at a real mongod.
+
+    python loadtest.py --messages 2000 --users 200 --concurrency 16
+    python loadtest.py --save-baseline            # record loadtest_baseline.json
+    python loadtest.py --baseline loadtest_baseline.json   # exit 1 on regression
+    python loadtest.py --mode both --concurrency 256 --mongo-uri mongodb://localhost:27017
+    python loadtest.py --first-contact-bench 10000  # is_first_time_user on users with 10k messages
+    python loadtest.py --dial-code-bench 1000000   # old codes.json scan vs the dial-code index
+    python loadtest.py --user-list-bench 300       # get_all_users: 6 queries per user vs user_summaries
+    python loadtest.py --ordering-check 20 --users 50  # per-user order and exactly-once welcome, exit 1 on failure
+    DELIVERY_TRACKING_ENABLED=true ARCHIVE_ENABLED=true WRITE_DURABILITY=buffered python loadtest.py  # every feature on
+
+--mode both runs each serving mode in its own process and prints them side by
+side. mongomock has no async API, so in asgi mode AsyncMock puts an awaitable
+face on the same in-memory client main.py uses.
+
+mongomock is only needed for the default in-memory mode: python -m pip install mongomock
+patch_mongomock fills in what it lacks (pymongo's bulk sort= keyword and $collStats).
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Answers Graph API sends and Groq chat completions (plain and SSE streaming)."""
+
+    protocol_version = "HTTP/1.1"
+    latency = 0.0
+    reply_words = 40
+    requests = 0
+    echo = False  # --ordering-check: completions name the turn they answer and the reply before it
+    sent = None  # --ordering-check: recipient -> texts received by the Graph stub, in order
+    lock = threading.Lock()
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status: int, body: bytes, content_type: str = "application/json"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        with StubHandler.lock:
+            type(self).requests += 1
+        time.sleep(self.latency)
+        if self.path.endswith("/chat/completions"):
+            self._completion(json.loads(body or b"{}"))
+        else:
+            if self.sent is not None:
+                message = json.loads(body or b"{}")
+                with StubHandler.lock:
+                    self.sent.setdefault(message.get("to"), []).append((message.get("text") or {}).get("body"))
+            self._send(200, json.dumps({"messages": [{"id": f"wamid.stub{time.time_ns()}"}]}).encode())
+
+    def _completion(self, request: dict):
+        text = " ".join(["Sure."] + ["word"] * self.reply_words) + "."
+        if self.echo:
+            messages = request.get("messages") or []
+            turn = next((m["content"] for m in reversed(messages) if m["role"] == "user"), "")
+            previous = next((m["content"] for m in reversed(messages) if m["role"] == "assistant"), "")
+            text = f"re:{turn} after:{previous.split(' ')[0]}"
+        model = request.get("model", "stub")
+        if not request.get("stream"):
+            payload = {
+                "id": "stub", "object": "chat.completion", "created": int(time.time()), "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+            }
+            self._send(200, json.dumps(payload).encode())
+            return
+        events = []
+        for piece in text.split(" "):
+            chunk = {
+                "id": "stub", "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+                "choices": [{"index": 0, "delta": {"content": piece + " "}, "finish_reason": None}],
+            }
+            events.append(f"data: {json.dumps(chunk)}\n\n")
+        events.append("data: [DONE]\n\n")
+        self._send(200, "".join(events).encode(), "text/event-stream")
+
+
+def start_stub(latency: float, **attrs) -> ThreadingHTTPServer:
+    handler = type("Stub", (StubHandler,), {"latency": latency, **attrs})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def load_app(args, graph_url: str, groq_url: str):
+    """Import main.py against the stubs; returns (module, db-ops counter)."""
+    os.environ.update({
+        "WHATSAPP_TOKEN": "loadtest", "PHONE_NUMBER_ID": "1000", "VERIFY_TOKEN": "loadtest",
+        "GRAPH_API_URL": graph_url, "GROQ_API_KEY": "loadtest", "GROQ_BASE_URL": groq_url,
+        "MONGODB_URI": args.mongo_uri or "mongodb://loadtest", "DATABASE_NAME": args.database,
+        "COLLECTION_NAME": "conversations", "BOT_NAME": "Load Test Bot",
+        "WHATSAPP_MAX_RPS": "0",
+    })
+    ops = OpCounter()
+    import pymongo
+    if args.mongo_uri:
+        from pymongo import monitoring
+        monitoring.register(ops)
+    else:
+        try:
+            import mongomock
+        except ImportError:
+            sys.exit("mongomock is required without --mongo-uri: python -m pip install mongomock")
+        pymongo.MongoClient = mongomock.MongoClient
+        patch_mongomock(mongomock)
+    import main
+    main.database_supervisor.wait_ready(timeout=20)  # the import no longer blocks on the connection
+    if args.mongo_uri and main.db is not None:
+        for name in main.db.list_collection_names():
+            main.db[name].delete_many({})
+    if not args.mongo_uri:
+        ops.wrap_collections(main)
+    return main, ops
+
+
+def patch_mongomock(mongomock):
+    """Fill the gaps between mongomock and the pymongo/server features main.py uses (shared with tests)."""
+    import bson
+    from mongomock.collection import BulkOperationBuilder, Collection
+
+    # pymongo >= 4.11 passes sort= to the bulk builder for UpdateOne/ReplaceOne; mongomock predates it
+    for name in ("add_update", "add_replace"):
+        original = getattr(BulkOperationBuilder, name)
+
+        def accept(self, *args, _original=original, sort=None, **kwargs):
+            return _original(self, *args, **kwargs)
+        setattr(BulkOperationBuilder, name, accept)
+
+    # $collStats (the archiver's storage report) is not implemented; answer it from the documents
+    original_aggregate = Collection.aggregate
+
+    def aggregate(self, pipeline, *args, **kwargs):
+        if pipeline and "$collStats" in pipeline[0]:
+            size = sum(len(bson.encode(doc)) for doc in self.find({}))
+            count = self.count_documents({})
+            stats = {"count": count, "size": size, "storageSize": size, "totalIndexSize": 0}
+            return iter([{"ns": self.full_name, "storageStats": stats}])
+        return original_aggregate(self, pipeline, *args, **kwargs)
+    Collection.aggregate = aggregate
+
+
+class OpCounter:
+    """Counts database operations: command events for a real mongod, outermost calls for mongomock.
+
+    Reads are also counted on their own, and reads of user_summaries (HISTORY_CACHE_VERIFY's
+    per-hit check) separately again.
+    """
+
+    METHODS = ("insert_one", "insert_many", "find", "find_one", "update_one", "bulk_write",
+               "count_documents", "aggregate", "delete_one", "delete_many", "distinct", "find_one_and_update")
+    READS = {"find", "find_one", "count_documents", "aggregate", "distinct", "count"}
+    SUMMARIES = "user_summaries"  # main.USER_SUMMARY_COLLECTION_NAME
+
+    def __init__(self):
+        self.count = 0
+        self.reads = 0
+        self.summary_reads = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _add(self, operation: str, collection: str | None):
+        with self._lock:
+            self.count += 1
+            if operation in self.READS:
+                self.reads += 1
+                self.summary_reads += collection == self.SUMMARIES
+
+    # pymongo CommandListener interface
+    def started(self, event):
+        if event.command_name not in ("ping", "hello", "isMaster", "endSessions", "getMore"):
+            self._add(event.command_name, event.command.get(event.command_name))
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+    def wrap_collections(self, main):
+        for name in dir(main):
+            coll = getattr(main, name)
+            if name.endswith("collection") and coll is not None and hasattr(coll, "insert_one"):
+                for method in self.METHODS:
+                    if hasattr(coll, method):
+                        setattr(coll, method, self._wrap(getattr(coll, method), method, coll.name))
+
+    def _wrap(self, fn, method: str, collection: str):
+        def wrapper(*args, **kwargs):
+            # mongomock implements some calls via others (find_one -> find); count only the outer one
+            if getattr(self._local, "depth", 0) == 0:
+                self._add(method, collection)
+            self._local.depth = getattr(self._local, "depth", 0) + 1
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self._local.depth -= 1
+        return wrapper
+
+
+def make_payloads(args) -> list:
+    """Build (payload, inbound message count) pairs following the requested traffic mix."""
+    rng = random.Random(args.seed)
+    users = [f"2547{rng.randint(0, 99999999):08d}" for _ in range(args.users)]
+    names = ["Ann", "Brian", "Chen", "Dede", None]
+    questions = ["hi", "what is your privacy policy", "who made you", "tell me a joke",
+                 "how is the weather in Nairobi", "translate good morning to french", "thanks!"]
+    seq = 0
+
+    def message(user: str, kind: str = "text") -> dict:
+        nonlocal seq
+        seq += 1
+        msg = {"from": user, "id": f"wamid.load{seq}", "timestamp": str(int(time.time())), "type": kind}
+        if kind == "text":
+            msg["text"] = {"body": rng.choice(questions)}
+        else:
+            msg[kind] = {"id": f"media{seq}"}
+        return msg
+
+    def envelope(value: dict) -> dict:
+        value.setdefault("messaging_product", "whatsapp")
+        value.setdefault("metadata", {"display_phone_number": "15550000000", "phone_number_id": "1000"})
+        return {"object": "whatsapp_business_account",
+                "entry": [{"id": "waba", "changes": [{"field": "messages", "value": value}]}]}
+
+    payloads = []
+    kinds = ["text", "non_text", "status", "batch"]
+    weights = [args.text_ratio, args.non_text_ratio, args.status_ratio, args.batch_ratio]
+    while len(payloads) < args.messages:
+        kind = rng.choices(kinds, weights)[0]
+        user = rng.choice(users)
+        contacts = [{"wa_id": user, "profile": {"name": rng.choice(names)}}]
+        if kind == "text":
+            payloads.append((envelope({"contacts": contacts, "messages": [message(user)]}), 1))
+        elif kind == "non_text":
+            payloads.append((envelope({"contacts": contacts, "messages": [message(user, rng.choice(["image", "audio", "sticker"]))]}), 1))
+        elif kind == "batch":
+            batch = [message(user) for _ in range(rng.randint(2, 4))]
+            payloads.append((envelope({"contacts": contacts, "messages": batch}), len(batch)))
+        else:
+            statuses = [{"id": f"wamid.out{rng.randint(0, 10**9)}", "recipient_id": user,
+                         "status": rng.choice(["sent", "delivered", "read"]),
+                         "timestamp": str(int(time.time()))} for _ in range(rng.randint(1, 3))]
+            payloads.append((envelope({"statuses": statuses}), 0))
+    return payloads
+
+
+def percentile(values: list, pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def run(args) -> dict:
+    graph = start_stub(args.graph_latency / 1000)
+    groq = start_stub(args.groq_latency / 1000)
+    main, ops = load_app(args, f"http://127.0.0.1:{graph.server_port}/v21.0", f"http://127.0.0.1:{groq.server_port}")
+    payloads = make_payloads(args)
+    inbound = sum(n for _, n in payloads)
+    ops_before, reads_before, summary_reads_before = ops.count, ops.reads, ops.summary_reads
+    groq_before = groq.RequestHandlerClass.requests
+    drive = drive_asgi if args.mode == "asgi" else drive_sync
+    latencies, statuses, acked, total = drive(main, payloads, args)
+
+    result = {
+        "mode": args.mode,
+        "requests": len(payloads),
+        "inbound_messages": inbound,
+        "status_codes": {str(k): v for k, v in sorted(statuses.items())},
+        "throughput_rps": round(len(payloads) / total, 2),
+        "messages_per_second": round(inbound / total, 2),
+        "ack_p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "ack_p95_ms": round(percentile(latencies, 95) * 1000, 2),
+        "ack_p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "ack_mean_ms": round(statistics.fmean(latencies) * 1000, 2) if latencies else 0.0,
+        "ack_seconds": round(acked, 3),
+        "total_seconds": round(total, 3),
+        "db_ops_per_message": round((ops.count - ops_before) / max(1, inbound), 2),
+        "db_reads_per_message": round((ops.reads - reads_before) / max(1, inbound), 2),
+        "summary_reads_per_message": round((ops.summary_reads - summary_reads_before) / max(1, inbound), 2),
+        "llm_calls": groq.RequestHandlerClass.requests - groq_before,
+        "coalesce_ratio": coalesce_ratio(main, args.mode),
+        "graph_api_calls": graph.RequestHandlerClass.requests,
+    }
+    graph.shutdown()
+    groq.shutdown()
+    return result
+
+
+def coalesce_ratio(main, mode: str) -> float:
+    """Inbound texts per reply turn with COALESCE_WINDOW set (0.0 when coalescing is off)."""
+    if mode == "asgi":
+        import asgi
+        turns = asgi.bot.coalesced_turns
+        return round(asgi.bot.coalesced_messages / turns, 2) if turns else 0.0
+    return main.message_coalescer.stats()["ratio"]
+
+
+def drive_sync(main, payloads: list, args):
+    """POST every payload through Flask's test client from --concurrency threads."""
+    client_local = threading.local()
+    latencies, statuses = [], {}
+    lock = threading.Lock()
+
+    def post(payload: dict):
+        client = getattr(client_local, "client", None)
+        if client is None:
+            client = client_local.client = main.app.test_client()
+        started = time.perf_counter()
+        response = client.post("/webhook", json=payload)
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies.append(elapsed)
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        list(pool.map(post, (p for p, _ in payloads)))
+    acked = time.perf_counter() - started
+    # queued mode acknowledges early: wait for the background work so throughput is end to end
+    main.work_queue.drain()
+    main.message_coalescer.drain()  # COALESCE_WINDOW: answer bursts still waiting for quiet
+    main.write_buffer.flush()
+    return latencies, statuses, acked, time.perf_counter() - started
+
+
+class AsyncMock:
+    """Just enough of pymongo's async API over a mongomock object for asgi.py."""
+
+    def __init__(self, target):
+        self._target = target
+
+    def __getitem__(self, name):
+        return AsyncMock(self._target[name])
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if name in ("find", "sort", "limit", "skip"):
+            return lambda *args, **kwargs: AsyncMock(attr(*args, **kwargs))
+        if not callable(attr):
+            return AsyncMock(attr)
+
+        async def call(*args, **kwargs):
+            return attr(*args, **kwargs)
+        return call
+
+    async def to_list(self, length=None):
+        return list(self._target)[:length]
+
+
+def drive_asgi(main, payloads: list, args):
+    """POST every payload into asgi.app in-process, with --concurrency requests in flight."""
+    import asyncio
+    import httpx
+    import asgi
+
+    if not args.mongo_uri:
+        asgi.AsyncMongoClient = lambda *args, **kwargs: AsyncMock(main.mongo_client)
+    latencies, statuses = [], {}
+
+    async def go():
+        await asgi.bot.startup()
+        deadline = time.monotonic() + 20  # the async client connects in the background too
+        while main.collection is not None and asgi.bot.collection is None and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+        slots = asyncio.Semaphore(args.concurrency)
+        transport = httpx.ASGITransport(app=asgi.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://loadtest") as client:
+            async def post(payload: dict):
+                async with slots:
+                    started = time.perf_counter()
+                    response = await client.post("/webhook", json=payload)
+                    latencies.append(time.perf_counter() - started)
+                    statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+            started = time.perf_counter()
+            await asyncio.gather(*(post(p) for p, _ in payloads))
+            acked = time.perf_counter() - started
+            await asgi.bot.drain()  # early-acked messages (ASYNC_WEBHOOK) finish here
+            total = time.perf_counter() - started
+        await asgi.bot.shutdown()
+        return acked, total
+
+    acked, total = asyncio.run(go())
+    return latencies, statuses, acked, total
+
+
+def run_both(argv: list) -> dict:
+    """Run each serving mode in a fresh process so caches, dedup state and pools are not shared."""
+    results = {}
+    for mode in ("sync", "asgi"):
+        out = subprocess.run([sys.executable, os.path.abspath(__file__), *argv, "--mode", mode, "--json"],
+                             capture_output=True, text=True, check=True).stdout
+        results[mode] = json.loads(out[out.index("{"):])
+    return results
+
+
+def bench_first_contact(args) -> dict:
+    """Time the old count_documents first-contact check against the known-user registry.
+
+    Every benchmark user already has --first-contact-bench messages but no users document,
+    like an existing chat the first time the registry sees it.
+    """
+    main, _ = load_app(args, "http://127.0.0.1:9/v21.0", "http://127.0.0.1:9")
+    if main.collection is None:
+        sys.exit("first-contact benchmark needs a database")
+    users = [f"2547{i:08d}" for i in range(args.bench_users)]
+    started_at = datetime.now(timezone.utc) - timedelta(days=1)
+    for user in users:
+        main.collection.insert_many([
+            {"user_id": user, "conversation_id": f"chat_{user}", "sender_type": "user", "message_type": "text",
+             "message": "hi", "timestamp": started_at + timedelta(seconds=i)}
+            for i in range(args.first_contact_bench)
+        ])
+
+    def per_call_ms(check, rounds: int = 1) -> float:
+        started = time.perf_counter()
+        for _ in range(rounds):
+            for user in users:
+                if check(user):
+                    sys.exit(f"{check.__name__} wrongly reported {user} as a first-time user")
+        return round((time.perf_counter() - started) * 1000 / (rounds * len(users)), 4)
+
+    def count_documents(user: str) -> bool:
+        return main.collection.count_documents({"user_id": user}) == 0
+
+    return {
+        "users": len(users),
+        "messages_per_user": args.first_contact_bench,
+        "count_documents_ms": per_call_ms(count_documents),
+        "registry_first_sight_ms": per_call_ms(main.is_first_time_user),  # users insert + one indexed probe
+        "registry_cached_ms": per_call_ms(main.is_first_time_user, rounds=20),
+    }
+
+
+def legacy_get_all_users(collection) -> list:
+    """get_all_users as it was before user_summaries: distinct, then six queries per user."""
+    users = []
+    for user_id in collection.distinct("user_id"):
+        user_filter = {"user_id": user_id}
+        first_msg = collection.find_one(user_filter, sort=[("timestamp", 1)])
+        last_msg = collection.find_one(user_filter, sort=[("timestamp", -1)])
+        user_info = collection.find_one({**user_filter, "user_name": {"$exists": True, "$ne": None}},
+                                        sort=[("timestamp", -1)])
+        users.append({
+            "user_id": user_id,
+            "user_name": user_info.get("user_name") if user_info else "Unknown",
+            "total_messages": collection.count_documents(user_filter),
+            "user_messages": collection.count_documents({**user_filter, "sender_type": "user"}),
+            "bot_messages": collection.count_documents({**user_filter, "sender_type": "bot"}),
+            "first_message": first_msg.get("timestamp") if first_msg else None,
+            "last_message": last_msg.get("timestamp") if last_msg else None,
+        })
+    return sorted(users, key=lambda x: x.get("last_message") or datetime.min, reverse=True)
+
+
+def bench_user_list(args) -> dict:
+    """List --user-list-bench users the old way (6 queries each) and from user_summaries.
+
+    Messages are inserted without summaries, like a deployment before the migration, so
+    the rebuild that backfills them is timed too.
+    """
+    main, ops = load_app(args, "http://127.0.0.1:9/v21.0", "http://127.0.0.1:9")
+    if main.collection is None or main.summary_collection is None:
+        sys.exit("user list benchmark needs a database")
+    per_user = 10
+    started_at = datetime.now(timezone.utc) - timedelta(days=1)
+    docs = []
+    for i in range(args.user_list_bench):
+        user = f"2547{i:08d}"
+        docs.extend(
+            {"user_id": user, "conversation_id": f"chat_{user}", "sender_type": "user" if j % 2 == 0 else "bot",
+             "message": "hi", "timestamp": started_at + timedelta(seconds=i * per_user + j),
+             "user_name": f"user {i}" if j == 0 else None, "phone_number": user}
+            for j in range(per_user)
+        )
+    main.collection.insert_many(docs)
+
+    def timed(fn) -> tuple:
+        before = ops.count
+        started = time.perf_counter()
+        value = fn()
+        return value, round((time.perf_counter() - started) * 1000, 2), ops.count - before
+
+    legacy, legacy_ms, legacy_ops = timed(lambda: legacy_get_all_users(main.collection))
+    written, rebuild_ms, _ = timed(main.rebuild_user_summaries)
+    summaries, list_ms, list_ops = timed(main.get_all_users)
+    _, page_ms, page_ops = timed(lambda: main.get_all_users(limit=50))
+
+    key = ("user_id", "total_messages", "user_messages", "bot_messages")
+    mismatches = sum(
+        tuple(old[k] for k in key) != tuple(new[k] for k in key)
+        for old, new in zip(legacy, summaries)
+    ) + abs(len(legacy) - len(summaries))
+    return {
+        "users": args.user_list_bench,
+        "messages_per_user": per_user,
+        "legacy_ms": legacy_ms,
+        "legacy_db_ops": legacy_ops,
+        "rebuild_ms": rebuild_ms,
+        "summaries_rebuilt": written,
+        "summary_list_ms": list_ms,
+        "summary_list_db_ops": list_ops,
+        "summary_page_50_ms": page_ms,
+        "summary_page_50_db_ops": page_ops,
+        "speedup": round(legacy_ms / list_ms, 1) if list_ms else None,
+        "mismatches": mismatches,
+    }
+
+
+def bench_startup(args) -> dict:
+    """Time `import main` in fresh interpreters while MongoDB is unreachable.
+
+    The connection is made by the database supervisor in the background, so the import
+    (and with it worker boot) should not wait out serverSelectionTimeoutMS.
+    """
+    env = dict(os.environ, MONGODB_URI="mongodb://10.255.255.1:27017/?serverSelectionTimeoutMS=15000",
+               WHATSAPP_TOKEN="loadtest", PHONE_NUMBER_ID="1000", VERIFY_TOKEN="loadtest", GROQ_API_KEY="loadtest")
+    code = "import time; t = time.perf_counter(); import main; print(time.perf_counter() - t)"
+    here = os.path.dirname(os.path.abspath(__file__))
+    samples = []
+    for _ in range(args.startup_bench):
+        out = subprocess.run([sys.executable, "-c", code], cwd=here, env=env,
+                             capture_output=True, text=True, check=True).stdout
+        samples.append(float(out.strip().splitlines()[-1]))
+    return {
+        "runs": len(samples),
+        "import_mean_s": round(statistics.mean(samples), 3),
+        "import_max_s": round(max(samples), 3),
+    }
+
+
+def check_ordering(args) -> dict:
+    """Fire --ordering-check texts from each of --users users, interleaved, and verify every reply.
+
+    Each user's texts are posted one after another, as Meta delivers them, while all users
+    post at once. Every user must get exactly one welcome, first, then one reply per text
+    in the order sent, each generated with the previous reply already in its history.
+    """
+    os.environ.setdefault("ASYNC_WEBHOOK", "true")  # the per-user lanes are what is under test
+    graph = start_stub(args.graph_latency / 1000, sent={})
+    groq = start_stub(args.groq_latency / 1000, echo=True)
+    main, _ = load_app(args, f"http://127.0.0.1:{graph.server_port}/v21.0", f"http://127.0.0.1:{groq.server_port}")
+    rng = random.Random(args.seed)
+    users = [f"2547{i:08d}" for i in range(args.users)]
+    texts = [f"turn-{i}" for i in range(args.ordering_check)]
+
+    def payload(user: str, i: int) -> dict:
+        message = {"from": user, "id": f"wamid.order{user}.{i}", "timestamp": str(int(time.time())),
+                   "type": "text", "text": {"body": texts[i]}}
+        value = {"messaging_product": "whatsapp", "contacts": [{"wa_id": user, "profile": {}}], "messages": [message]}
+        return {"object": "whatsapp_business_account",
+                "entry": [{"id": "waba", "changes": [{"field": "messages", "value": value}]}]}
+
+    statuses = {}
+    lock = threading.Lock()
+    if args.mode == "asgi":
+        import asyncio
+        import httpx
+        import asgi
+
+        if not args.mongo_uri:
+            asgi.AsyncMongoClient = lambda *a, **kw: AsyncMock(main.mongo_client)
+
+        async def go():
+            await asgi.bot.startup()
+            deadline = time.monotonic() + 20
+            while main.collection is not None and asgi.bot.collection is None and time.monotonic() < deadline:
+                await asyncio.sleep(0.01)
+            transport = httpx.ASGITransport(app=asgi.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://loadtest") as client:
+                async def converse(user: str, jitter: list):
+                    for i in range(len(texts)):
+                        await asyncio.sleep(jitter[i])
+                        response = await client.post("/webhook", json=payload(user, i))
+                        statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+                await asyncio.gather(*(converse(u, [rng.random() / 500 for _ in texts]) for u in users))
+                await asgi.bot.drain()
+            await asgi.bot.shutdown()
+
+        asyncio.run(go())
+    else:
+        def converse(user: str, jitter: list):
+            client = main.app.test_client()
+            for i in range(len(texts)):
+                time.sleep(jitter[i])
+                response = client.post("/webhook", json=payload(user, i))
+                with lock:
+                    statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+        with ThreadPoolExecutor(len(users)) as pool:
+            list(pool.map(converse, users, [[rng.random() / 500 for _ in texts] for _ in users]))
+        main.work_queue.drain()
+        main.message_coalescer.drain()
+
+    welcome = main.build_welcome_message(None)
+    expected = [welcome] + [f"re:{t} after:{p}" for t, p in zip(texts, [welcome.split(" ")[0]] + [f"re:{t}" for t in texts])]
+    problems = []
+    for user in users:
+        got = graph.RequestHandlerClass.sent.get(user, [])
+        if got.count(welcome) != 1:
+            problems.append(f"{user}: {got.count(welcome)} welcome messages")
+        if got != expected:
+            first = next((i for i, (a, b) in enumerate(zip(got, expected)) if a != b), min(len(got), len(expected)))
+            problems.append(f"{user}: message {first} was {got[first] if first < len(got) else None!r}, "
+                            f"expected {expected[first] if first < len(expected) else None!r}")
+    graph.shutdown()
+    groq.shutdown()
+    return {
+        "mode": args.mode,
+        "users": len(users),
+        "texts_per_user": len(texts),
+        "status_codes": {str(k): v for k, v in sorted(statuses.items())},
+        "users_out_of_order": len({p.split(":")[0] for p in problems}),
+        "problems": problems[:20],
+    }
+
+
+def legacy_detect_user_location(phone_number: str, country_codes: list) -> dict | None:
+    """detect_user_location as it was before the dial-code index: sort and scan codes.json per call."""
+    if not country_codes or not phone_number:
+        return None
+    clean_phone = ''.join(filter(str.isdigit, phone_number))
+    if not clean_phone:
+        return None
+    sorted_codes = sorted(country_codes, key=lambda x: len(x['dial_code'].replace('-', '')), reverse=True)
+    for country in sorted_codes:
+        dial_code = country['dial_code'].replace('-', '')
+        if clean_phone.startswith(dial_code):
+            return {
+                'country_name': country['name'],
+                'country_code': country['code'],
+                'dial_code': country['dial_code'],
+                'phone_number': phone_number,
+                'clean_phone': clean_phone,
+                'detected_at': datetime.now(timezone.utc),
+                'mobile_number_length': country.get('mobile_number_length')
+            }
+    return None
+
+
+def synthetic_numbers(count: int, seed: int) -> list:
+    """Numbers built from real dial codes (most of them) plus random digits, with some repeats."""
+    with open("codes.json", encoding="utf-8") as f:
+        codes = [c["dial_code"].replace("-", "") for c in json.load(f)]
+    rng = random.Random(seed)
+    numbers = []
+    for _ in range(count):
+        prefix = rng.choice(codes) if rng.random() < 0.9 else str(rng.randint(1, 999))
+        numbers.append(prefix + "".join(rng.choices("0123456789", k=12 - len(prefix))))
+    return numbers
+
+
+def bench_dial_codes(args) -> dict:
+    """Resolve --dial-code-bench synthetic numbers with the old scan and with the compiled index."""
+    main, _ = load_app(args, "http://127.0.0.1:9/v21.0", "http://127.0.0.1:9")
+    main.load_dial_code_index()
+    numbers = synthetic_numbers(args.dial_code_bench, args.seed)
+    legacy_sample = numbers[:min(len(numbers), 50000)]  # the old scan is slow; time a sample and scale
+
+    started = time.perf_counter()
+    legacy = [legacy_detect_user_location(n, main.country_codes) for n in legacy_sample]
+    legacy_us = (time.perf_counter() - started) * 1e6 / len(legacy_sample)
+
+    main.match_dial_code.cache_clear()
+    started = time.perf_counter()
+    indexed = [main.detect_user_location(n) for n in numbers]
+    indexed_us = (time.perf_counter() - started) * 1e6 / len(numbers)
+
+    main.match_dial_code.cache_clear()
+    started = time.perf_counter()
+    batch = main.detect_user_locations(numbers)
+    batch_us = (time.perf_counter() - started) * 1e6 / len(numbers)
+
+    mismatches = sum(
+        (old or {}).get("country_code") != (new or {}).get("country_code")
+        for old, new in zip(legacy, indexed)
+    )
+    mismatches += sum((indexed[i] or {}).get("country_code") != (batch[n] or {}).get("country_code")
+                      for i, n in enumerate(numbers))
+    return {
+        "numbers": len(numbers),
+        "legacy_sampled": len(legacy_sample),
+        "legacy_us_per_number": round(legacy_us, 2),
+        "indexed_us_per_number": round(indexed_us, 2),
+        "batch_us_per_number": round(batch_us, 2),
+        "speedup": round(legacy_us / indexed_us, 1) if indexed_us else None,
+        "mismatches": mismatches,
+    }
+
+
+def compare(result: dict, baseline: dict, tolerance: float) -> list:
+    """Regressions beyond `tolerance` (fraction) versus a saved baseline."""
+    problems = []
+    if result["throughput_rps"] < baseline["throughput_rps"] * (1 - tolerance):
+        problems.append(f"throughput {result['throughput_rps']} rps < baseline {baseline['throughput_rps']}")
+    for key in ("ack_p95_ms", "ack_p99_ms"):
+        if result[key] > baseline[key] * (1 + tolerance):
+            problems.append(f"{key} {result[key]} > baseline {baseline[key]}")
+    if result["db_ops_per_message"] > baseline["db_ops_per_message"] * (1 + tolerance):
+        problems.append(f"db ops/message {result['db_ops_per_message']} > baseline {baseline['db_ops_per_message']}")
+    return problems
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Replay synthetic WhatsApp webhook traffic against main.py")
+    parser.add_argument("--messages", type=int, default=1000, help="webhook payloads to send")
+    parser.add_argument("--users", type=int, default=100, help="distinct WhatsApp users")
+    parser.add_argument("--concurrency", type=int, default=8, help="concurrent webhook requests")
+    parser.add_argument("--groq-latency", type=float, default=50, help="stub completion latency (ms)")
+    parser.add_argument("--graph-latency", type=float, default=10, help="stub Graph API latency (ms)")
+    parser.add_argument("--text-ratio", type=float, default=0.55)
+    parser.add_argument("--non-text-ratio", type=float, default=0.05)
+    parser.add_argument("--status-ratio", type=float, default=0.3)
+    parser.add_argument("--batch-ratio", type=float, default=0.1)
+    parser.add_argument("--mongo-uri", help="use a real mongod instead of mongomock (its database is wiped)")
+    parser.add_argument("--database", default="whatsapp_bot_loadtest")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--baseline", help="compare against this baseline and exit 1 on regression")
+    parser.add_argument("--save-baseline", nargs="?", const="loadtest_baseline.json", help="write the result as a baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed regression as a fraction")
+    parser.add_argument("--mode", choices=("sync", "asgi", "both"), default="sync",
+                        help="serve through main.app (Flask), asgi.app, or compare both")
+    parser.add_argument("--first-contact-bench", type=int, default=0, metavar="MESSAGES",
+                        help="benchmark is_first_time_user for users with this many messages, then exit")
+    parser.add_argument("--bench-users", type=int, default=20, help="users seeded by --first-contact-bench")
+    parser.add_argument("--ordering-check", type=int, default=0, metavar="TEXTS",
+                        help="send this many interleaved texts per user, verify order and one welcome, then exit")
+    parser.add_argument("--dial-code-bench", type=int, default=0, metavar="NUMBERS",
+                        help="compare the old codes.json scan with the dial-code index on this many numbers, then exit")
+    parser.add_argument("--user-list-bench", type=int, default=0, metavar="USERS",
+                        help="list this many users the old way and from user_summaries, then exit")
+    parser.add_argument("--startup-bench", type=int, default=0, metavar="RUNS",
+                        help="time `import main` with an unreachable MongoDB this many times, then exit")
+    parser.add_argument("--json", action="store_true", help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.json:
+        print(json.dumps(run(args)))
+        sys.exit(0)
+
+    print("\n===== WhatsApp Bot Load Test =====")
+    if args.ordering_check:
+        result = check_ordering(args)
+        print(json.dumps(result, indent=2))
+        sys.exit(1 if result["users_out_of_order"] else 0)
+    if args.first_contact_bench:
+        print(json.dumps(bench_first_contact(args), indent=2))
+        sys.exit(0)
+    if args.startup_bench:
+        print(json.dumps(bench_startup(args), indent=2))
+        sys.exit(0)
+    if args.user_list_bench:
+        result = bench_user_list(args)
+        print(json.dumps(result, indent=2))
+        sys.exit(1 if result["mismatches"] else 0)
+    if args.dial_code_bench:
+        result = bench_dial_codes(args)
+        print(json.dumps(result, indent=2))
+        sys.exit(1 if result["mismatches"] else 0)
+    if args.mode == "both":
+        argv = [a for a in sys.argv[1:] if a not in ("--mode", "both", "--mode=both")]
+        results = run_both(argv)
+        keys = [k for k in results["sync"] if k not in ("mode", "status_codes")]
+        print(f"{'metric':<22}{'sync':>14}{'asgi':>14}")
+        for key in keys:
+            print(f"{key:<22}{results['sync'][key]:>14}{results['asgi'][key]:>14}")
+        print(f"{'status_codes':<22}{json.dumps(results['sync']['status_codes']):>14}  {json.dumps(results['asgi']['status_codes'])}")
+        sys.exit(0)
+
+    result = run(args)
+    print(json.dumps(result, indent=2))
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+        print(f"Baseline saved to {args.save_baseline}")
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            problems = compare(result, json.load(f), args.tolerance)
+        if problems:
+            print("Performance regression:")
+            for problem in problems:
+                print(f"  - {problem}")
+            sys.exit(1)
+        print("No regression against baseline")
@@ -1,16 +1,31 @@
 # WhatsApp Bot with memory and meta api integration
 import os
 import requests
+import requests.adapters
+from urllib3.exceptions import NewConnectionError
 import logging
 import json
-from flask import Flask, request, jsonify
+import re
+from flask import Flask, Response, request, jsonify
 from dotenv import load_dotenv
-from groq import Groq
-from pymongo import MongoClient
-from pymongo.errors import ConnectionFailure, ServerSelectionTimeoutError
-from datetime import datetime, timezone
+from pymongo import MongoClient, ReturnDocument, UpdateOne, monitoring
+from pymongo.errors import ConnectionFailure, ServerSelectionTimeoutError, DuplicateKeyError, BulkWriteError
+from datetime import datetime, timedelta, timezone
 import traceback
+try:
+    import numpy as np  # optional: enables similarity lookups in the response cache
+except ImportError:
+    np = None
 import uuid
+import time
+import threading
+import queue
+import atexit
+import zlib
+import random
+from collections import OrderedDict, deque
+from functools import lru_cache, wraps
+from contextlib import contextmanager
 
 load_dotenv(override=True)  # Force reload env variables
 
@@ -24,13 +39,35 @@ logging.basicConfig(
 WHATSAPP_TOKEN = os.getenv("WHATSAPP_TOKEN")
 PHONE_NUMBER_ID = os.getenv("PHONE_NUMBER_ID")
 VERIFY_TOKEN = os.getenv("VERIFY_TOKEN")
+GRAPH_API_URL = os.getenv("GRAPH_API_URL", "https://graph.facebook.com/v21.0")  # override to point at a local stub
+WHATSAPP_POOL_SIZE = int(os.getenv("WHATSAPP_POOL_SIZE", "10"))  # keep-alive connections to the Graph API
+WHATSAPP_MAX_RPS = float(os.getenv("WHATSAPP_MAX_RPS", "20"))  # outbound pacing, 0 disables
+WHATSAPP_MAX_RETRIES = int(os.getenv("WHATSAPP_MAX_RETRIES", "3"))  # retries on 429/5xx/connect errors (not read timeouts)
+WHATSAPP_BACKOFF_BASE = float(os.getenv("WHATSAPP_BACKOFF_BASE", "0.5"))  # seconds, doubled per attempt
+WHATSAPP_BACKOFF_MAX = float(os.getenv("WHATSAPP_BACKOFF_MAX", "8"))
 
 GROQ_API_KEY = os.getenv("GROQ_API_KEY")
+AI_MODELS = [m.strip() for m in os.getenv("AI_MODELS", "openai/gpt-oss-20B").split(",") if m.strip()]  # tried in order
+AI_TIMEOUT = float(os.getenv("AI_TIMEOUT", "20"))  # per-completion deadline in seconds, shared by every model tried
+AI_MAX_INFLIGHT = int(os.getenv("AI_MAX_INFLIGHT", "8"))  # concurrent completions per process
+AI_QUEUE_TIMEOUT = float(os.getenv("AI_QUEUE_TIMEOUT", "5"))  # seconds to wait for a free completion slot
+AI_BREAKER_THRESHOLD = int(os.getenv("AI_BREAKER_THRESHOLD", "5"))  # consecutive failures that open the breaker
+AI_BREAKER_RESET = float(os.getenv("AI_BREAKER_RESET", "30"))  # seconds before a trial call is let through
 
 MONGO_URI = os.getenv("MONGODB_URI")
 DATABASE_NAME = os.getenv("DATABASE_NAME")
 COLLECTION_NAME = os.getenv("COLLECTION_NAME")#import collection for storing the conversations this is set in .env file 
 LOCATION_COLLECTION_NAME = "user_locations"  # a collection for storing location data
+DIAL_CODE_CACHE_SIZE = int(os.getenv("DIAL_CODE_CACHE_SIZE", "100000"))  # memoized phone -> country lookups
+KNOWN_USERS_MAX_CACHED = int(os.getenv("KNOWN_USERS_MAX_CACHED", "500000"))  # user ids kept in memory per process
+CONVERSATION_SUMMARY_COLLECTION_NAME = "conversation_summaries"  # rolling per-user summaries of older turns
+USER_SUMMARY_COLLECTION_NAME = "user_summaries"  # per-user counters maintained on every saved message
+PROCESSED_COLLECTION_NAME = "processed_messages"  # whatsapp message ids already handled (dedup of redeliveries)
+DELIVERY_COLLECTION_NAME = "message_deliveries"  # sent/delivered/read times per outbound message
+ARCHIVE_COLLECTION_NAME = "conversation_archive"  # older messages packed per user and day (ARCHIVE_ENABLED)
+USERS_COLLECTION_NAME = "users"  # one tiny document per user who ever wrote, for first-contact checks
+MIGRATIONS_COLLECTION_NAME = "migrations"  # one document per one-off data migration that has run
+RATE_LIMIT_COLLECTION_NAME = "rate_limits"  # per-user token buckets shared by all workers (RATE_LIMIT_BACKEND=mongo)
 
 BOT_NAME = os.getenv("BOT_NAME")
 CREATOR_NAME = os.getenv("CREATOR_NAME")
@@ -40,6 +77,92 @@ PRIVACY_URL = os.getenv("PRIVACY_URL")
 TERMS_URL = os.getenv("TERMS_URL")
 MEMORY_LIMIT = int(os.getenv("MEMORY_LIMIT", "30"))  # messages (user+bot) to keep for prompt
 
+# prompt assembly: history is trimmed (oldest first) to fit this many estimated tokens, 0 disables
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "6000"))
+PROMPT_CONTEXT_TTL = float(os.getenv("PROMPT_CONTEXT_TTL", "600"))  # seconds a cached user context block stays valid
+PROMPT_CONTEXT_CACHE_SIZE = int(os.getenv("PROMPT_CONTEXT_CACHE_SIZE", "10000"))
+
+# rolling summaries: condense older turns in the background and prompt with summary + recent turns
+SUMMARY_ENABLED = os.getenv("SUMMARY_ENABLED", "false").lower() == "true"
+SUMMARY_TRIGGER_TURNS = int(os.getenv("SUMMARY_TRIGGER_TURNS", "20"))  # unsummarized turns that trigger a summary
+SUMMARY_TRIGGER_TOKENS = int(os.getenv("SUMMARY_TRIGGER_TOKENS", "3000"))  # ...or estimated tokens, 0 disables
+SUMMARY_KEEP_TURNS = int(os.getenv("SUMMARY_KEEP_TURNS", "6"))  # newest turns always sent verbatim
+SUMMARY_WORKERS = int(os.getenv("SUMMARY_WORKERS", "2"))  # also the summaries' own completion slots
+SUMMARY_MAX_TURNS = int(os.getenv("SUMMARY_MAX_TURNS", "200"))  # oldest unsummarized turns folded per run
+SUMMARY_MAX_INPUT_TOKENS = int(os.getenv("SUMMARY_MAX_INPUT_TOKENS", "4000"))  # transcript tokens per completion
+
+# response cache for repeated questions about the bot itself (exact match, plus n-gram similarity when numpy is installed)
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "false").lower() == "true"
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "86400"))  # seconds an answer may be reused
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "2000"))
+RESPONSE_CACHE_SIMILARITY = float(os.getenv("RESPONSE_CACHE_SIMILARITY", "0.9"))  # cosine threshold for tier two
+RESPONSE_CACHE_SCOPE = os.getenv("RESPONSE_CACHE_SCOPE", "global").lower()  # "global" or "country"
+RESPONSE_CACHE_MIN_WORDS = int(os.getenv("RESPONSE_CACHE_MIN_WORDS", "3"))  # shorter messages depend on context
+RESPONSE_CACHE_MAX_CHARS = int(os.getenv("RESPONSE_CACHE_MAX_CHARS", "120"))  # longer messages are rarely repeated
+
+# streaming replies: send long answers in chunks while the model is still generating
+AI_STREAMING = os.getenv("AI_STREAMING", "false").lower() == "true"
+STREAM_MIN_CHUNK_CHARS = int(os.getenv("STREAM_MIN_CHUNK_CHARS", "160"))  # don't cut chunks shorter than this
+STREAM_MAX_CHUNK_CHARS = int(os.getenv("STREAM_MAX_CHUNK_CHARS", "1500"))  # force a cut without a sentence end
+
+# index bootstrap: declare/ensure indexes on boot (tests/test_query_plans.py checks the hot queries use them)
+ENSURE_INDEXES = os.getenv("ENSURE_INDEXES", "true").lower() == "true"
+DB_HEALTH_INTERVAL = float(os.getenv("DB_HEALTH_INTERVAL", "15"))  # seconds between reconnect attempts / health pings
+DB_READY_TIMEOUT = float(os.getenv("DB_READY_TIMEOUT", "5"))  # webhook wait for the first connection before a 503
+MIGRATION_STALE_AFTER = float(os.getenv("MIGRATION_STALE_AFTER", "3600"))  # seconds before an unfinished migration is retried
+
+# message writes: "sync" inserts every message immediately, "buffered" batches non-critical ones (insert_many)
+WRITE_DURABILITY = os.getenv("WRITE_DURABILITY", "sync").lower()
+WRITE_BUFFER_MAX_DOCS = int(os.getenv("WRITE_BUFFER_MAX_DOCS", "100"))  # flush once this many are pending
+WRITE_BUFFER_FLUSH_INTERVAL = float(os.getenv("WRITE_BUFFER_FLUSH_INTERVAL", "1.0"))  # seconds between flushes
+
+# in-process history cache: recent turns per user, written through by save_message_to_db
+HISTORY_CACHE_ENABLED = os.getenv("HISTORY_CACHE_ENABLED", "true").lower() == "true"
+HISTORY_CACHE_MAX_USERS = int(os.getenv("HISTORY_CACHE_MAX_USERS", "5000"))
+HISTORY_CACHE_MAX_BYTES = int(os.getenv("HISTORY_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1"))  # gunicorn worker processes (gunicorn reads it too)
+# other workers write turns this process never sees: with more than one, check
+# user_summaries.last_message before serving a hit (a find_one per hit)
+HISTORY_CACHE_VERIFY = os.getenv("HISTORY_CACHE_VERIFY", "true" if WEB_CONCURRENCY > 1 else "false").lower() == "true"
+
+# webhook ingestion: when enabled the POST handler only enqueues messages and returns 200 at once
+ASYNC_WEBHOOK = os.getenv("ASYNC_WEBHOOK", "false").lower() == "true"
+WORKER_THREADS = int(os.getenv("WORKER_THREADS", "8"))  # per-user lanes, one consumer thread each
+QUEUE_MAXSIZE = int(os.getenv("QUEUE_MAXSIZE", "1000"))  # pending messages (split across lanes) before we push back on Meta
+QUEUE_PUT_TIMEOUT = float(os.getenv("QUEUE_PUT_TIMEOUT", "2"))  # seconds to wait for a free slot
+QUEUE_DRAIN_TIMEOUT = float(os.getenv("QUEUE_DRAIN_TIMEOUT", "25"))  # seconds allowed to finish work on shutdown
+
+# redelivery dedup: Meta resends a payload when we answer slowly, so remember message ids we have handled
+DEDUP_MAX_ENTRIES = int(os.getenv("DEDUP_MAX_ENTRIES", "10000"))  # ids kept in memory (LRU)
+DEDUP_TTL_SECONDS = int(os.getenv("DEDUP_TTL_SECONDS", "86400"))  # how long an id counts as handled
+DEDUP_PERSIST = os.getenv("DEDUP_PERSIST", "false").lower() == "true"  # share ids across workers via mongo
+
+# Delivery tracking: status callbacks are acknowledged without parsing unless this is on
+DELIVERY_TRACKING_ENABLED = os.getenv("DELIVERY_TRACKING_ENABLED", "false").lower() == "true"
+DELIVERY_BUFFER_MAX = int(os.getenv("DELIVERY_BUFFER_MAX", "500"))  # message ids pending before an early flush
+DELIVERY_FLUSH_INTERVAL = float(os.getenv("DELIVERY_FLUSH_INTERVAL", "5"))  # seconds between batched writes
+
+# Abuse protection, checked before any DB write or completion for a message
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "false").lower() == "true"
+RATE_LIMIT_PER_MINUTE = float(os.getenv("RATE_LIMIT_PER_MINUTE", "10"))  # sustained messages per user
+RATE_LIMIT_BURST = float(os.getenv("RATE_LIMIT_BURST", "5"))  # messages a user may send back to back
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory").lower()  # "memory" (per process) or "mongo"
+RATE_LIMIT_ACTION = os.getenv("RATE_LIMIT_ACTION", "reply").lower()  # "reply" or "coalesce" into the next turn
+RATE_LIMIT_NOTICE_INTERVAL = float(os.getenv("RATE_LIMIT_NOTICE_INTERVAL", "60"))  # seconds between "slow down" replies
+MAX_CONCURRENT_TURNS = int(os.getenv("MAX_CONCURRENT_TURNS", "0"))  # global shedding threshold per process, 0 disables
+
+# Retention tiering: messages past ARCHIVE_AFTER_DAYS move from conversations into daily per-user buckets
+ARCHIVE_ENABLED = os.getenv("ARCHIVE_ENABLED", "false").lower() == "true"
+ARCHIVE_AFTER_DAYS = float(os.getenv("ARCHIVE_AFTER_DAYS", "7"))  # age at which a message leaves the hot tier
+ARCHIVE_RETENTION_DAYS = float(os.getenv("ARCHIVE_RETENTION_DAYS", "0"))  # archived days are deleted after this, 0 keeps forever
+ARCHIVE_INTERVAL = float(os.getenv("ARCHIVE_INTERVAL", "3600"))  # seconds between compaction passes
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "1000"))  # messages packed per bulk write
+
+# Burst coalescing: texts a user sends in quick succession are answered with one completion
+COALESCE_WINDOW = float(os.getenv("COALESCE_WINDOW", "0"))  # seconds of quiet that close a burst, 0 disables
+COALESCE_MAX_WAIT = float(os.getenv("COALESCE_MAX_WAIT", "5"))  # a burst is answered at most this long after it starts
+COALESCE_WORKERS = int(os.getenv("COALESCE_WORKERS", "8"))  # threads generating coalesced replies
+
 
 ERROR_MESSAGES = {
     "ERR100": "I encountered a problem when processing your request. Please tell the developer: ERR100.",
@@ -48,77 +171,523 @@ ERROR_MESSAGES = {
     "ERR400": "AI service is unavailable. Please try again later. (ERR400)"
 }
 
+class Histogram:
+    """Thread-safe cumulative histogram with fixed bucket bounds (seconds unless given other buckets)."""
+
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self, buckets: tuple = DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self._counts = [0] * (len(self.buckets) + 1)  # last slot is +Inf
+        self._sum = 0.0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float):
+        with self._lock:
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    self._counts[i] += 1
+                    break
+            else:
+                self._counts[-1] += 1
+            self._sum += seconds
+            self._count += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            cumulative, running = [], 0
+            for bound, n in zip(self.buckets + (float("inf"),), self._counts):
+                running += n
+                cumulative.append((bound, running))
+            return {"buckets": cumulative, "sum": self._sum, "count": self._count}
+
+
+class MetricsRegistry:
+    """Minimal in-process Prometheus-style registry rendered by the /metrics endpoint.
+
+    Counters and histograms are plain dict/lock updates so instrumenting the hot path
+    costs a perf_counter call and a bucket increment; gauges are read lazily from
+    collector callbacks only when /metrics is scraped.
+    """
+
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+        self._counters = {}  # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> Histogram
+        self._collectors = []  # callables returning [(name, labels dict, value)] gauges
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(name: str, labels: dict | None) -> tuple:
+        return name, tuple(sorted((labels or {}).items()))
+
+    def inc(self, name: str, labels: dict | None = None, value: float = 1):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def histogram(self, name: str, labels: dict | None = None, buckets: tuple = Histogram.DEFAULT_BUCKETS) -> Histogram:
+        key = self._key(name, labels)
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = Histogram(buckets)
+            return hist
+
+    def register_histogram(self, name: str, histogram: Histogram, labels: dict | None = None):
+        with self._lock:
+            self._histograms[self._key(name, labels)] = histogram
+
+    def collector(self, fn):
+        self._collectors.append(fn)
+        return fn
+
+    @contextmanager
+    def stage(self, stage: str):
+        """Time a block of the webhook pipeline: `with metrics.stage("webhook_parse"): ...`"""
+        hist = self.histogram("stage_seconds", {"stage": stage})
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.inc("stage_errors_total", {"stage": stage})
+            raise
+        finally:
+            hist.observe(time.perf_counter() - started)
+
+    def timed(self, stage: str):
+        """Decorator form of stage() for whole functions."""
+        def decorator(fn):
+            hist = self.histogram("stage_seconds", {"stage": stage})
+
+            @wraps(fn)
+            def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return fn(*args, **kwargs)
+                except Exception:
+                    self.inc("stage_errors_total", {"stage": stage})
+                    raise
+                finally:
+                    hist.observe(time.perf_counter() - started)
+            return wrapper
+        return decorator
+
+    @staticmethod
+    def _labels(labels, extra: str = "") -> str:
+        parts = [f'{k}="{str(v)}"' for k, v in labels] + ([extra] if extra else [])
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    def render(self) -> str:
+        lines, typed = [], set()
+
+        def declare(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} {kind}")
+
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items(), key=lambda item: item[0])
+        for (name, labels), value in counters:
+            full = f"{self.prefix}_{name}"
+            declare(full, "counter")
+            lines.append(f"{full}{self._labels(labels)} {value}")
+        for (name, labels), hist in histograms:
+            full = f"{self.prefix}_{name}"
+            declare(full, "histogram")
+            snap = hist.snapshot()
+            for bound, count in snap["buckets"]:
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                bucket_labels = self._labels(labels, 'le="' + le + '"')
+                lines.append(f"{full}_bucket{bucket_labels} {count}")
+            lines.append(f"{full}_sum{self._labels(labels)} {snap['sum']}")
+            lines.append(f"{full}_count{self._labels(labels)} {snap['count']}")
+        for collect in self._collectors:
+            try:
+                gauges = collect()
+            except Exception as e:
+                logging.error("Metrics collector %s failed: %s", collect.__name__, e)
+                continue
+            for name, labels, value in sorted(gauges, key=lambda g: g[0]):  # keep each family contiguous
+                full = f"{self.prefix}_{name}"
+                declare(full, "gauge")
+                lines.append(f"{full}{self._labels(sorted((labels or {}).items()))} {value}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry("whatsapp_bot")
+
+
+class MongoPoolListener(monitoring.ConnectionPoolListener):
+    """Tracks open and checked-out MongoDB connections for the /metrics endpoint."""
+
+    def __init__(self):
+        self.open = 0
+        self.checked_out = 0
+        self._lock = threading.Lock()
+
+    def _add(self, attr: str, delta: int):
+        with self._lock:
+            setattr(self, attr, getattr(self, attr) + delta)
+
+    def connection_created(self, event): self._add("open", 1)
+    def connection_closed(self, event): self._add("open", -1)
+    def connection_checked_out(self, event): self._add("checked_out", 1)
+    def connection_checked_in(self, event): self._add("checked_out", -1)
+    def pool_created(self, event): pass
+    def pool_ready(self, event): pass
+    def pool_cleared(self, event): pass
+    def pool_closed(self, event): pass
+    def connection_ready(self, event): pass
+    def connection_check_out_started(self, event): pass
+    def connection_check_out_failed(self, event): pass
+
+
+mongo_pool_listener = MongoPoolListener()
+
+_ERROR_ID_SUFFIX = re.compile(r"_[0-9a-f]{8}$")
+
 def dev_log(exc: Exception, code: str):
   
+    metrics.inc("errors_total", {"code": _ERROR_ID_SUFFIX.sub("", code)})
     logging.error("Developer error %s: %s", code, exc)
     logging.error(traceback.format_exc())
 
 
 ai_client = None
-if GROQ_API_KEY:
-    try:
-        ai_client = Groq(api_key=GROQ_API_KEY)
-        logging.info("200 AI service ready")
-    except Exception as e:
-        dev_log(e, "ERR400")
-        ai_client = None
-        logging.error("AI service failed")
-else:
+_ai_client_lock = threading.Lock()
+
+def get_ai_client():
+    """Groq client, built on first use so importing groq and creating its session stay off the boot path."""
+    global ai_client
+    if ai_client is None and GROQ_API_KEY:
+        with _ai_client_lock:
+            if ai_client is None:
+                try:
+                    from groq import Groq
+                    # no SDK retries: LLMGateway owns retries, model fallback and the deadline
+                    ai_client = Groq(api_key=GROQ_API_KEY, max_retries=0)
+                    logging.info("200 AI service ready")
+                except Exception as e:
+                    dev_log(e, "ERR400")
+                    logging.error("AI service failed")
+    return ai_client
+
+if not GROQ_API_KEY:
     logging.error("No AI API key configured")
 
 mongo_client = None
 db = None
 collection = None
 location_collection = None
+summary_collection = None
+conversation_summary_collection = None
+users_collection = None
+archive_collection = None
+processed_collection = None
+delivery_collection = None
+rate_limit_collection = None
 country_codes = []
+_db_lock = threading.Lock()
 
+def connect_database() -> bool:
+    """Connect to MongoDB and publish the collection globals; True once they are set.
 
-try:
-    with open('codes.json', 'r', encoding='utf-8') as f:
-        country_codes = json.load(f)
-except Exception as e:
-    logging.error("Could not load codes.json: %s", e)
-    country_codes = []
+    Never called at import time: DatabaseSupervisor runs it in the background so a slow
+    or unreachable Mongo can't stall worker boot, and calls it again until it succeeds.
+    """
+    global mongo_client, db, collection, location_collection, summary_collection
+    global conversation_summary_collection, users_collection, archive_collection
+    global processed_collection, delivery_collection, rate_limit_collection
+    if not MONGO_URI:
+        return False
+    with _db_lock:
+        if collection is not None:
+            return True
+        try:
+            if mongo_client is None:
+                # MongoClient is not fork-safe; this only ever runs in the process that uses it
+                mongo_client = MongoClient(
+                    MONGO_URI, 
+                    serverSelectionTimeoutMS=15000,  
+                    connectTimeoutMS=15000,
+                    socketTimeoutMS=15000,
+                    maxPoolSize=10,
+                    retryWrites=True,
+                    event_listeners=[mongo_pool_listener]
+                )
+            
+            # testing  the connection
+            mongo_client.admin.command('ping')
+        except (ConnectionFailure, ServerSelectionTimeoutError) as e:
+            dev_log(e, "ERRDB_CONN")
+            logging.error("MongoDB connection failed; memory and location features disabled until it recovers.")
+            return False
+        except Exception as e:
+            dev_log(e, "ERRDB_CONN")
+            logging.error("MongoDB connection error; memory and location features disabled until it recovers.")
+            return False
 
-if MONGO_URI:
-    try:
-        mongo_client = MongoClient(
-            MONGO_URI, 
-            serverSelectionTimeoutMS=15000,  
-            connectTimeoutMS=15000,
-            socketTimeoutMS=15000,
-            maxPoolSize=10,
-            retryWrites=True
-        )
-        
-        # testing  the connection
-        mongo_client.admin.command('ping')
         db = mongo_client[DATABASE_NAME]
-        collection = db[COLLECTION_NAME]
         location_collection = db[LOCATION_COLLECTION_NAME]  # Initialize location collection
+        summary_collection = db[USER_SUMMARY_COLLECTION_NAME]
+        conversation_summary_collection = db[CONVERSATION_SUMMARY_COLLECTION_NAME]
+        users_collection = db[USERS_COLLECTION_NAME]
+        if ARCHIVE_ENABLED:
+            archive_collection = db[ARCHIVE_COLLECTION_NAME]
+        if DEDUP_PERSIST:
+            processed_collection = db[PROCESSED_COLLECTION_NAME]
+        if DELIVERY_TRACKING_ENABLED:
+            delivery_collection = db[DELIVERY_COLLECTION_NAME]
+        if RATE_LIMIT_ENABLED and RATE_LIMIT_BACKEND == "mongo":
+            rate_limit_collection = db[RATE_LIMIT_COLLECTION_NAME]
+        collection = db[COLLECTION_NAME]  # set last: `collection is None` is what every feature checks
         logging.info("200 Database connected")
-        
-    except (ConnectionFailure, ServerSelectionTimeoutError) as e:
-        dev_log(e, "ERRDB_CONN")
-        logging.error("MongoDB connection failed; memory and location features disabled.")
-        collection = None
-        location_collection = None
-    except Exception as e:
-        dev_log(e, "ERRDB_CONN")
-        logging.error("MongoDB connection error; memory and location features disabled.")
-        collection = None
-        location_collection = None
-else:
+    _on_database_ready()
+    return True
+
+
+class DatabaseSupervisor:
+    """Brings the database up off the import path and keeps an eye on it afterwards.
+
+    Until the first ping succeeds the bot runs with DB features off and retries every
+    DB_HEALTH_INTERVAL seconds, so a failed boot recovers without a restart. Once
+    connected it keeps pinging; the result feeds /readyz. Started per process (after a
+    gunicorn fork the worker starts its own).
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.healthy = False
+        self.checks = 0
+        self.failures = 0
+        self.last_error = None
+        self._ready = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        if not MONGO_URI:
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="database-supervisor", daemon=True)
+            self._thread.start()
+
+    def reset(self):
+        # new process after fork: forget the parent's thread and state
+        self.__init__(self.interval)
+
+    def _run(self):
+        while True:
+            ok = connect_database() if collection is None else self.ping()
+            self.checks += 1
+            if not ok:
+                self.failures += 1
+            elif not self.healthy:
+                self._ready.set()
+            self.healthy = ok
+            time.sleep(self.interval)
+
+    def ping(self) -> bool:
+        try:
+            mongo_client.admin.command("ping")
+            self.last_error = None
+            return True
+        except Exception as e:
+            self.last_error = str(e)
+            logging.error("Database health check failed: %s", e)
+            return False
+
+    def wait_ready(self, timeout: float | None = None) -> bool:
+        """Block until the database has been connected once (webhooks, scripts and tests)."""
+        self.start()
+        return self._ready.wait(timeout)
+
+    def stats(self) -> dict:
+        return {"healthy": int(self.healthy), "checks": self.checks, "failures": self.failures}
+
+
+database_supervisor = DatabaseSupervisor(DB_HEALTH_INTERVAL)
+
+def _reset_after_fork():
+    # safety net for a parent that did connect before forking (nothing connects at import): a forked
+    # worker must not reuse its Mongo/Groq clients, since sockets and monitor threads don't survive fork
+    global mongo_client, db, collection, location_collection, summary_collection
+    global conversation_summary_collection, users_collection, archive_collection
+    global processed_collection, delivery_collection, rate_limit_collection
+    global ai_client, _db_lock, _ai_client_lock
+    mongo_client = db = collection = location_collection = summary_collection = None
+    conversation_summary_collection = users_collection = archive_collection = None
+    processed_collection = delivery_collection = rate_limit_collection = None
+    ai_client = None
+    _db_lock = threading.Lock()
+    _ai_client_lock = threading.Lock()
+    database_supervisor.reset()
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+if not MONGO_URI:
     logging.warning("MONGO_URI not set; memory features disabled.")
 
 
+def _index_specs() -> list:
+    #(collection, keys, options) for every access pattern main.py relies on
+    specs = []
+    if collection is not None:
+        # get_conversation_history: equality on user_id+conversation_id, newest first
+        specs.append((collection, [("user_id", 1), ("conversation_id", 1), ("timestamp", -1)],
+                      {"name": "user_conversation_timestamp"}))
+        # is_first_time_user's pre-registry check and get_user_stats match/sort by user_id then timestamp
+        specs.append((collection, [("user_id", 1), ("timestamp", -1)], {"name": "user_timestamp"}))
+    if archive_collection is not None:
+        # the archiver's age scan, and history/stats reads over a user's buckets
+        specs.append((collection, [("timestamp", 1)], {"name": "timestamp"}))
+        specs.append((archive_collection, [("user_id", 1), ("day", -1)], {"name": "user_day"}))
+        specs.append((archive_collection, [("expires_at", 1)], {"name": "expires_at_ttl", "expireAfterSeconds": 0}))
+    if location_collection is not None:
+        specs.append((location_collection, [("user_id", 1)], {"name": "user_id_unique", "unique": True}))
+    if summary_collection is not None:
+        specs.append((summary_collection, [("last_message", -1)], {"name": "last_message"}))
+    if processed_collection is not None:
+        specs.append((processed_collection, [("created_at", 1)],
+                      {"name": "created_at_ttl", "expireAfterSeconds": DEDUP_TTL_SECONDS}))
+    if delivery_collection is not None:
+        # get_delivery_stats windows on sent_at
+        specs.append((delivery_collection, [("sent_at", -1)], {"name": "sent_at"}))
+    if rate_limit_collection is not None:
+        specs.append((rate_limit_collection, [("expires_at", 1)], {"name": "expires_at_ttl", "expireAfterSeconds": 0}))
+    return specs
+
+def ensure_indexes() -> bool:
+    """Create the indexes declared in _index_specs (idempotent; safe to run on every boot)."""
+    ok = True
+    for coll, keys, options in _index_specs():
+        try:
+            coll.create_index(keys, **options)
+        except Exception as e:
+            # e.g. duplicate user_locations rows blocking the unique index; keep serving
+            dev_log(e, "ERRDB_INDEX")
+            logging.error("Could not ensure index %s on %s", options.get("name"), coll.name)
+            ok = False
+    if ok:
+        logging.info("200 Database indexes ensured")
+    return ok
+
+def _plan_stages(plan: dict) -> list:
+    stages = [plan.get("stage")]
+    for child_key in ("inputStage", "queryPlan"):
+        if isinstance(plan.get(child_key), dict):
+            stages += _plan_stages(plan[child_key])
+    for child in plan.get("inputStages", []):
+        stages += _plan_stages(child)
+    return [s for s in stages if s]
+
+def check_query_plans(sample_user_id: str = "0") -> list:
+    """Explain the hot queries; returns the names of those that COLLSCAN or could not be explained.
+
+    Run by tests/test_query_plans.py against a real mongod (mongomock has no planner).
+    """
+    checks = []
+    if collection is not None:
+        checks.append(("conversation_history", collection.find(
+            {"user_id": sample_user_id, "conversation_id": f"chat_{sample_user_id}"}
+        ).sort("timestamp", -1).limit(MEMORY_LIMIT)))
+        checks.append(("first_time_user", collection.find(
+            {"user_id": sample_user_id, "timestamp": {"$lt": datetime.now(timezone.utc)}}
+        ).limit(1)))
+        checks.append(("user_stats_latest_name", collection.find(
+            {"user_id": sample_user_id, "user_name": {"$exists": True, "$ne": None}}
+        ).sort("timestamp", -1).limit(1)))
+    if archive_collection is not None:
+        checks.append(("archived_history", archive_collection.find({"user_id": sample_user_id}).sort("day", -1)))
+    if location_collection is not None:
+        checks.append(("user_location", location_collection.find({"user_id": sample_user_id}).limit(1)))
+    if summary_collection is not None:
+        checks.append(("all_users", summary_collection.find({}).sort("last_message", -1).limit(50)))
+
+    collscans = []
+    for name, cursor in checks:
+        try:
+            plan = cursor.explain().get("queryPlanner", {}).get("winningPlan", {})
+            if "COLLSCAN" in _plan_stages(plan):
+                logging.warning("Query plan check: %s uses a COLLSCAN", name)
+                collscans.append(name)
+        except Exception as e:
+            dev_log(e, "ERRDB_EXPLAIN")
+            collscans.append(name)
+    if not collscans:
+        logging.info("200 Query plans use indexes")
+    return collscans
+
+
 def make_user_safe_error(code_key: str) -> str:
     """Return a short message for the user while logging details to dev logs."""
     return ERROR_MESSAGES.get(code_key, "An error occurred. Please inform the developer.")
 
+def compile_dial_code_index(codes: list) -> dict:
+    """Map dial-code digits (hyphens removed) to their country entry.
+
+    Lookups probe at most max(len(code)) prefixes of the number, longest first. When
+    two countries share a code the first one listed in codes.json wins, as before.
+    """
+    index = {}
+    for country in codes:
+        digits = country['dial_code'].replace('-', '')
+        if digits:
+            index.setdefault(digits, country)
+    return index
+
+dial_code_index = None
+max_dial_code_length = 0
+_dial_code_lock = threading.Lock()
+
+def load_dial_code_index() -> dict:
+    """Parse codes.json and compile the index on first use (once per process, thread-safe)."""
+    global country_codes, dial_code_index, max_dial_code_length
+    if dial_code_index is None:
+        with _dial_code_lock:
+            if dial_code_index is None:
+                try:
+                    with open('codes.json', 'r', encoding='utf-8') as f:
+                        country_codes = json.load(f)
+                except Exception as e:
+                    logging.error("Could not load codes.json: %s", e)
+                    country_codes = []
+                index = compile_dial_code_index(country_codes)
+                max_dial_code_length = max(map(len, index), default=0)
+                dial_code_index = index  # published last so other threads never see a partial index
+    return dial_code_index
+
+@lru_cache(maxsize=DIAL_CODE_CACHE_SIZE)
+def match_dial_code(clean_phone: str) -> dict | None:
+    #longest-prefix match of a digits-only number against the compiled index (memoized per number)
+    index = load_dial_code_index()
+    for length in range(min(max_dial_code_length, len(clean_phone)), 0, -1):
+        country = index.get(clean_phone[:length])
+        if country is not None:
+            return country
+    return None
+
+def _location_from_country(country: dict, phone_number: str, clean_phone: str, detected_at: datetime) -> dict:
+    return {
+        'country_name': country['name'],
+        'country_code': country['code'],
+        'dial_code': country['dial_code'],
+        'phone_number': phone_number,
+        'clean_phone': clean_phone,
+        'detected_at': detected_at,
+        'mobile_number_length': country.get('mobile_number_length')
+    }
+
 def detect_user_location(phone_number: str) -> dict | None:
     #detect user's country and location based on phone number using country codes
-    if not country_codes or not phone_number:
+    if not phone_number or not load_dial_code_index():
         return None
     
     # rrmove any non-digit characters from phone number
@@ -127,38 +696,29 @@ def detect_user_location(phone_number: str) -> dict | None:
     if not clean_phone:
         return None
     
-    # try to match country codes (sorted by length descending to match longer codes first)
-    sorted_codes = sorted(country_codes, key=lambda x: len(x['dial_code'].replace('-', '')), reverse=True)
-    
-    for country in sorted_codes:
-        dial_code = country['dial_code'].replace('-', '')  # Remove hyphens for matching
-        
-        # check if phone number starts with this country code
-        if clean_phone.startswith(dial_code):
-            return {
-                'country_name': country['name'],
-                'country_code': country['code'],
-                'dial_code': country['dial_code'],
-                'phone_number': phone_number,
-                'clean_phone': clean_phone,
-                'detected_at': datetime.now(timezone.utc),
-                'mobile_number_length': country.get('mobile_number_length')
-            }
-    
-    return None
+    country = match_dial_code(clean_phone)
+    if country is None:
+        return None
+    return _location_from_country(country, phone_number, clean_phone, datetime.now(timezone.utc))
 
-def save_user_location(user_id: str, location_data: dict, user_name: str = None) -> bool:
-    #save or update user location data in the location collection
-    if location_collection is None:
-        logging.info("Location collection disabled, skipping location save.")
-        return False
-    
-    try:
-        # Cceck if user location already exists
-        existing_location = location_collection.find_one({"user_id": user_id})
-        
-        location_doc = {
-            "user_id": user_id,
+def detect_user_locations(phone_numbers: list) -> dict:
+    """Resolve many numbers at once (backfills); maps each number to its location or None."""
+    detected_at = datetime.now(timezone.utc)
+    results = {}
+    for phone_number in phone_numbers:
+        if phone_number in results:
+            continue
+        clean_phone = ''.join(filter(str.isdigit, phone_number or ''))
+        country = match_dial_code(clean_phone) if clean_phone and load_dial_code_index() else None
+        results[phone_number] = (
+            _location_from_country(country, phone_number, clean_phone, detected_at) if country else None
+        )
+    return results
+
+def _location_update(location_data: dict, user_name: str | None, now: datetime) -> dict:
+    #single upsert document: refresh details, keep first_detected from the first insert, bump the counter
+    return {
+        "$set": {
             "user_name": user_name,
             "country_name": location_data['country_name'],
             "country_code": location_data['country_code'],
@@ -166,20 +726,26 @@ def save_user_location(user_id: str, location_data: dict, user_name: str = None)
             "phone_number": location_data['phone_number'],
             "clean_phone": location_data['clean_phone'],
             "mobile_number_length": location_data.get('mobile_number_length'),
-            "first_detected": location_data['detected_at'] if not existing_location else existing_location.get('first_detected', location_data['detected_at']),
-            "last_updated": datetime.now(timezone.utc),
-            "detection_count": (existing_location.get('detection_count', 0) + 1) if existing_location else 1
-        }
-        
-        if existing_location:
-            # Update existing location
-            location_collection.update_one(
-                {"user_id": user_id},
-                {"$set": location_doc}
-            )
-        else:
-            # Insert new location
-            location_collection.insert_one(location_doc)
+            "last_updated": now
+        },
+        "$setOnInsert": {"first_detected": location_data['detected_at']},
+        "$inc": {"detection_count": 1}
+    }
+
+def save_user_location(user_id: str, location_data: dict, user_name: str = None) -> bool:
+    #save or update user location data in the location collection (one atomic upsert)
+    if location_collection is None:
+        logging.info("Location collection disabled, skipping location save.")
+        return False
+    
+    update = _location_update(location_data, user_name, datetime.now(timezone.utc))
+    try:
+        try:
+            location_collection.update_one({"user_id": user_id}, update, upsert=True)
+        except DuplicateKeyError:
+            # two workers upserted the same new user at once; the unique index kept one, so retry as an update
+            location_collection.update_one({"user_id": user_id}, update, upsert=True)
+        invalidate_user_context(user_id)
         
         logging.info("200 Location extracted")
         
@@ -190,6 +756,55 @@ def save_user_location(user_id: str, location_data: dict, user_name: str = None)
         logging.error("Failed to save location for user %s", user_id[-4:])
         return False
 
+def save_user_locations_bulk(entries: list) -> int:
+    """Upsert many locations in one unordered bulk_write.
+
+    `entries` holds dicts with user_id, location_data and optional user_name.
+    Returns the number of location documents inserted or updated.
+    """
+    if location_collection is None or not entries:
+        return 0
+
+    now = datetime.now(timezone.utc)
+    ops = [
+        UpdateOne({"user_id": e["user_id"]}, _location_update(e["location_data"], e.get("user_name"), now), upsert=True)
+        for e in entries
+    ]
+    written = 0
+    try:
+        for attempt in range(2):
+            try:
+                result = location_collection.bulk_write(ops, ordered=False)
+                written += result.upserted_count + result.modified_count
+                break
+            except BulkWriteError as e:
+                details = e.details or {}
+                written += details.get("nUpserted", 0) + details.get("nModified", 0)
+                errors = details.get("writeErrors", [])
+                # users another worker inserted at the same moment: the unique index kept theirs, update it
+                retry = [ops[err["index"]] for err in errors if err.get("code") == 11000]
+                if attempt or len(retry) < len(errors) or not retry:
+                    dev_log(e, "ERR_LOCATION_SAVE")
+                    break
+                ops = retry
+        for e in entries:
+            invalidate_user_context(e["user_id"])
+        logging.info("200 Saved %d locations", written)
+        return written
+    except Exception as e:
+        dev_log(e, "ERR_LOCATION_SAVE")
+        return written
+
+def backfill_user_locations(user_ids: list, user_names: dict | None = None) -> int:
+    #detect and store locations for many users at once, e.g. users that predate location detection
+    user_names = user_names or {}
+    detected = detect_user_locations(user_ids)
+    entries = [
+        {"user_id": user_id, "location_data": location_data, "user_name": user_names.get(user_id)}
+        for user_id, location_data in detected.items() if location_data
+    ]
+    return save_user_locations_bulk(entries)
+
 def get_user_location(user_id: str) -> dict | None:
     """Get user's stored location data."""
     if location_collection is None:
@@ -204,53 +819,495 @@ def get_user_location(user_id: str) -> dict | None:
         dev_log(e, "ERR_LOCATION_GET")
         return None
 
+class TokenBucket:
+    """Classic token bucket: `rate` tokens per second refill up to `capacity`."""
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self, tokens: float = 1.0) -> bool:
+        with self._lock:
+            self._refill(time.monotonic())
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return True
+            return False
+
+    def acquire(self, tokens: float = 1.0, timeout: float | None = None) -> bool:
+        """Block until `tokens` are available; False if that would take longer than `timeout`."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return True
+                wait = (tokens - self._tokens) / self.rate
+            if deadline is not None and now + wait > deadline:
+                return False
+            time.sleep(wait)
+
+
+class WorkerThreads:
+    """A few plain daemon threads running submitted calls in FIFO order.
+
+    Used instead of ThreadPoolExecutor for work that may be submitted from atexit hooks
+    (coalesced turns, summaries of the turns they answer): concurrent.futures stops
+    accepting work as interpreter shutdown begins, before any atexit hook has run.
+    Threads start on the first submit, so each gunicorn worker gets its own after fork.
+    """
+
+    def __init__(self, workers: int, name: str):
+        self.workers = max(1, workers)
+        self.name = name
+        self._calls = queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args):
+        with self._lock:
+            if not self._threads:
+                for i in range(self.workers):
+                    t = threading.Thread(target=self._work, name=f"{self.name}-{i}", daemon=True)
+                    t.start()
+                    self._threads.append(t)
+        self._calls.put((fn, args))
+
+    def _work(self):
+        while True:
+            call = self._calls.get()
+            if call is None:
+                return
+            fn, args = call
+            try:
+                fn(*args)
+            except Exception as e:
+                dev_log(e, f"ERR_{self.name.upper().replace('-', '_')}")
+
+    def shutdown(self, timeout: float | None = None):
+        """Finish the calls already submitted, then stop the threads (waits at most `timeout`)."""
+        with self._lock:
+            threads, self._threads = self._threads, []
+        for _ in threads:
+            self._calls.put(None)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for t in threads:
+            t.join(None if deadline is None else max(0, deadline - time.monotonic()))
+
+
+class WhatsAppSender:
+    """Sends text messages through the Cloud API over one pooled keep-alive session.
+
+    Outbound calls are paced by a token bucket (WHATSAPP_MAX_RPS) and retried with
+    jittered exponential backoff on 429/5xx and on failures to connect, honouring
+    Retry-After when Meta sends one. A read timeout or a connection dropped after the
+    request went out is not retried: the send is not idempotent and Meta may already
+    have accepted it.
+    """
+
+    RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+    def __init__(self, base_url: str, phone_number_id: str | None, token: str | None,
+                 pool_size: int, max_rps: float, max_retries: int, backoff_base: float):
+        self.url = f"{base_url.rstrip('/')}/{phone_number_id}/messages"
+        self.headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.bucket = TokenBucket(max_rps) if max_rps > 0 else None
+        self.latency = Histogram()
+        self.retries = 0
+        self.failures = 0
+        self._session = None
+        self._session_lock = threading.Lock()
+
+    def _get_session(self) -> requests.Session:
+        # built lazily so each gunicorn worker gets its own connection pool after fork
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    session = requests.Session()
+                    adapter = requests.adapters.HTTPAdapter(
+                        pool_connections=1, pool_maxsize=self.pool_size, max_retries=0
+                    )
+                    session.mount("https://", adapter)
+                    session.mount("http://", adapter)
+                    session.headers.update(self.headers)
+                    self._session = session
+        return self._session
+
+    def _backoff(self, attempt: int, retry_after: str | None = None) -> float:
+        if retry_after:
+            try:
+                return min(WHATSAPP_BACKOFF_MAX, float(retry_after))
+            except ValueError:
+                pass
+        return random.uniform(0, min(WHATSAPP_BACKOFF_MAX, self.backoff_base * (2 ** attempt)))
+
+    # the retry decisions below are shared with asgi.AsyncWhatsAppSender, which only swaps the awaits
+    CONNECT_ERRORS = (requests.ConnectTimeout,)  # nothing reached Meta
+    MAYBE_SENT_ERRORS = (requests.Timeout, requests.ConnectionError)  # read timeout, "Connection aborted", ...
+
+    @classmethod
+    def _never_sent(cls, e: Exception) -> bool:
+        #requests reports a refused or unresolvable connection as a ConnectionError wrapping
+        #urllib3's NewConnectionError; any other ConnectionError may follow the sent request
+        if isinstance(e, cls.CONNECT_ERRORS):
+            return True
+        reason = getattr(e.args[0], "reason", None) if isinstance(e, requests.ConnectionError) and e.args else None
+        return isinstance(reason, NewConnectionError)
+
+    @staticmethod
+    def _payload(to: str, text: str) -> dict:
+        return {
+            "messaging_product": "whatsapp",
+            "to": to,
+            "type": "text",
+            "text": {"body": text}
+        }
+
+    def _on_response(self, r, attempt: int, started: float) -> tuple[bool | None, str | None]:
+        #(sent, retry_after): True/False ends the send, None means retry
+        self.latency.observe(time.perf_counter() - started)
+        if r.status_code < 400:
+            logging.info("200 Sent message to WhatsApp API")
+            return True, None
+        if r.status_code not in self.RETRYABLE_STATUSES:
+            logging.error("WhatsApp API error: %s", r.text)
+            self.failures += 1
+            return False, None
+        logging.warning("WhatsApp API returned %s (attempt %d)", r.status_code, attempt + 1)
+        return None, r.headers.get("Retry-After")
+
+    def _on_error(self, e: Exception, attempt: int, started: float) -> bool:
+        #True when the failed post may be retried
+        if self._never_sent(e):
+            self.latency.observe(time.perf_counter() - started)
+            logging.warning("WhatsApp API connection problem (attempt %d): %s", attempt + 1, e)
+            return True
+        if isinstance(e, self.MAYBE_SENT_ERRORS):
+            # the message may already be accepted, and resending would deliver it twice
+            self.latency.observe(time.perf_counter() - started)
+            logging.error("WhatsApp API did not answer; not resending: %s", e)
+        else:
+            dev_log(e, "ERR_WAPP_SEND")
+        self.failures += 1
+        return False
+
+    def _retry_delay(self, attempt: int, retry_after: str | None) -> float | None:
+        #seconds to wait before the next attempt, or None when the retries are used up
+        if attempt >= self.max_retries:
+            return None
+        self.retries += 1
+        return self._backoff(attempt, retry_after)
+
+    def _give_up(self) -> bool:
+        logging.error("WhatsApp API send failed after %d attempts", self.max_retries + 1)
+        self.failures += 1
+        return False
+
+    def send(self, to: str, text: str) -> bool:
+        payload = self._payload(to, text)
+        session = self._get_session()
+        for attempt in range(self.max_retries + 1):
+            if self.bucket is not None:
+                self.bucket.acquire()
+            started = time.perf_counter()
+            retry_after = None
+            try:
+                r = session.post(self.url, json=payload, timeout=10)
+            except Exception as e:
+                if not self._on_error(e, attempt, started):
+                    return False
+            else:
+                sent, retry_after = self._on_response(r, attempt, started)
+                if sent is not None:
+                    return sent
+
+            delay = self._retry_delay(attempt, retry_after)
+            if delay is not None:
+                time.sleep(delay)
+
+        return self._give_up()
+
+
+ttfm_histogram = Histogram()  # streaming mode: completion start -> first chunk handed to WhatsApp
+prompt_tokens_histogram = Histogram(buckets=(250, 500, 1000, 2000, 4000, 8000, 16000, 32000))
+
+whatsapp_sender = WhatsAppSender(
+    GRAPH_API_URL, PHONE_NUMBER_ID, WHATSAPP_TOKEN,
+    pool_size=WHATSAPP_POOL_SIZE,
+    max_rps=WHATSAPP_MAX_RPS,
+    max_retries=WHATSAPP_MAX_RETRIES,
+    backoff_base=WHATSAPP_BACKOFF_BASE,
+)
+
+@metrics.timed("send_message")
 def send_message(to: str, text: str) -> bool:
     """Send a text message via WhatsApp Cloud API. Returns True on success."""
     if not WHATSAPP_TOKEN or not PHONE_NUMBER_ID:
         logging.error("WhatsApp token or phone id missing.")
         return False
+    return whatsapp_sender.send(to, text)
 
-    url = f"https://graph.facebook.com/v21.0/{PHONE_NUMBER_ID}/messages"
-    headers = {"Authorization": f"Bearer {WHATSAPP_TOKEN}", "Content-Type": "application/json"}
-    payload = {
-        "messaging_product": "whatsapp",
-        "to": to,
-        "type": "text",
-        "text": {"body": text}
-    }
-    try:
-        r = requests.post(url, headers=headers, json=payload, timeout=10)
-        if r.status_code >= 400:
-            logging.error("WhatsApp API error: %s", r.text)
-            return False
-        logging.info("200 Sent message to WhatsApp API")
-        return True
-    except Exception as e:
-        dev_log(e, "ERR_WAPP_SEND")
-        return False
+class ConversationHistoryCache:
+    """Bounded per-user ring buffers of the most recent turns, kept in process.
+
+    Users are evicted least-recently-used once HISTORY_CACHE_MAX_USERS or the
+    approximate HISTORY_CACHE_MAX_BYTES budget is exceeded. Only users whose full
+    recent history was loaded from Mongo are resident, so write-through appends
+    never produce a partial view. Turns saved by other worker processes never reach
+    this cache, so with HISTORY_CACHE_VERIFY a hit is only served while the user's
+    user_summaries.last_message is no newer than the newest cached turn.
+    """
+
+    ENTRY_OVERHEAD = 200  # rough bytes per cached turn besides the message text
+
+    def __init__(self, turns: int, max_users: int, max_bytes: int):
+        self.turns = max(1, turns)
+        self.max_users = max(1, max_users)
+        self.max_bytes = max_bytes
+        self._users = OrderedDict()  # user_id -> deque of history entries
+        self._sizes = {}  # user_id -> approximate bytes held
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+
+    def _entry_size(self, entry: dict) -> int:
+        return len((entry.get("message") or "").encode("utf-8")) + self.ENTRY_OVERHEAD
+
+    def _evict(self):
+        while self._users and (len(self._users) > self.max_users or self._bytes > self.max_bytes):
+            user_id, _ = self._users.popitem(last=False)
+            self._bytes -= self._sizes.pop(user_id, 0)
+
+    def get(self, user_id: str, limit: int) -> list | None:
+        """Last `limit` turns oldest-first, or None when the user is not resident."""
+        with self._lock:
+            turns = self._users.get(user_id)
+            if turns is None or limit > self.turns:
+                self.misses += 1
+                return None
+            self._users.move_to_end(user_id)
+            self.hits += 1
+            return list(turns)[-limit:]
+
+    def newest(self, user_id: str) -> datetime | None:
+        """Timestamp of the newest cached turn, to compare with user_summaries.last_message."""
+        with self._lock:
+            turns = self._users.get(user_id)
+            return _as_utc(turns[-1].get("timestamp")) if turns else None
+
+    def discard(self, user_id: str):
+        """Drop a user whose history changed elsewhere; the next lookup reloads it."""
+        with self._lock:
+            if self._users.pop(user_id, None) is not None:
+                self._bytes -= self._sizes.pop(user_id, 0)
+                self.hits -= 1
+                self.misses += 1
+                self.stale += 1
+
+    def load(self, user_id: str, history: list):
+        """Make a user resident with history freshly read from the database."""
+        with self._lock:
+            if user_id in self._users:
+                self._bytes -= self._sizes.pop(user_id, 0)
+            turns = deque(history[-self.turns:], maxlen=self.turns)
+            size = sum(self._entry_size(h) for h in turns)
+            self._users[user_id] = turns
+            self._users.move_to_end(user_id)
+            self._sizes[user_id] = size
+            self._bytes += size
+            self._evict()
+
+    def append(self, user_id: str, entry: dict):
+        """Write-through from save_message_to_db; ignored for users that are not resident."""
+        with self._lock:
+            turns = self._users.get(user_id)
+            if turns is None:
+                return
+            delta = self._entry_size(entry)
+            if len(turns) == turns.maxlen:
+                delta -= self._entry_size(turns[0])
+            turns.append(entry)
+            self._sizes[user_id] += delta
+            self._bytes += delta
+            self._users.move_to_end(user_id)
+            self._evict()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+                "stale": self.stale,
+                "resident_users": len(self._users),
+                "bytes_used": self._bytes,
+            }
+
+
+history_cache = ConversationHistoryCache(MEMORY_LIMIT, HISTORY_CACHE_MAX_USERS, HISTORY_CACHE_MAX_BYTES)
+
+def history_cache_is_current(cached_newest: datetime | None, summary: dict | None) -> bool:
+    #a resident user is current unless some process saved a turn after the newest one we hold
+    last_message = _as_utc((summary or {}).get("last_message"))
+    if last_message is None or cached_newest is None:
+        return last_message is None
+    return last_message <= _truncate_ms(cached_newest)
+
+class MessageWriteBuffer:
+    """Write-behind buffer that batches message inserts into insert_many calls.
+
+    Documents are flushed by a background thread every WRITE_BUFFER_FLUSH_INTERVAL
+    seconds or as soon as WRITE_BUFFER_MAX_DOCS are pending, together with the
+    matching user_summaries updates in one unordered bulk_write.
+    """
+
+    def __init__(self, max_docs: int, flush_interval: float):
+        self.max_docs = max(1, max_docs)
+        self.flush_interval = flush_interval
+        self._docs = []
+        self._summary_ops = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._closed = False
+        self.flushes = 0
+        self.flushed_docs = 0
+        self.failed_docs = 0
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None or self._closed:
+                return
+            self._thread = threading.Thread(target=self._run, name="message-write-buffer", daemon=True)
+            self._thread.start()
 
+    def add(self, doc: dict, summary_op: UpdateOne | None = None):
+        self.start()
+        with self._lock:
+            self._docs.append(doc)
+            if summary_op is not None:
+                self._summary_ops.append(summary_op)
+            full = len(self._docs) >= self.max_docs
+        if self._closed:
+            # late writes during shutdown (e.g. the work queue draining) go straight through
+            self.flush()
+        elif full:
+            self._wakeup.set()
+
+    def pending(self) -> int:
+        with self._lock:
+            return len(self._docs)
+
+    def _run(self):
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self) -> int:
+        """Write everything pending now; returns the number of message documents inserted."""
+        with self._flush_lock:
+            with self._lock:
+                docs, self._docs = self._docs, []
+                summary_ops, self._summary_ops = self._summary_ops, []
+            if not docs:
+                return 0
+
+            inserted = 0
+            try:
+                inserted = len(collection.insert_many(docs, ordered=False).inserted_ids)
+            except BulkWriteError as e:
+                inserted = (e.details or {}).get("nInserted", 0)
+                dev_log(e, "ERR100")
+            except Exception as e:
+                dev_log(e, "ERR100")
+            if summary_ops and summary_collection is not None:
+                try:
+                    summary_collection.bulk_write(summary_ops, ordered=False)
+                except Exception as e:
+                    dev_log(e, "ERR_SUMMARY_SAVE")
+
+            self.flushes += 1
+            self.flushed_docs += inserted
+            self.failed_docs += len(docs) - inserted
+            if inserted < len(docs):
+                logging.error("Write buffer lost %d of %d messages", len(docs) - inserted, len(docs))
+            else:
+                logging.info("200 Flushed %d buffered messages to database", inserted)
+            return inserted
+
+    def close(self):
+        """Stop the flusher and write whatever is still pending (called on shutdown)."""
+        self._closed = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.flush_interval + 5)
+        self.flush()
+
+
+write_buffer = MessageWriteBuffer(WRITE_BUFFER_MAX_DOCS, WRITE_BUFFER_FLUSH_INTERVAL)
+atexit.register(write_buffer.close)
+
+@metrics.timed("save_message_to_db")
 def save_message_to_db(user_id: str, message: str, sender_type: str, message_type: str = "text", 
-                       user_name: str | None = None, phone_number: str | None = None) -> bool:
-   
+                       user_name: str | None = None, phone_number: str | None = None,
+                       sync: bool = False) -> bool:
+    #persist one message; with WRITE_DURABILITY=buffered it is batched unless sync=True
     if collection is None:
         logging.info("DB disabled, skipping save.")
         return False
 
     try:
+        now = datetime.now(timezone.utc)
         doc = {
             "user_id": user_id,              
             "message": message,              
             "sender_type": sender_type,      
             "message_type": message_type,    
-            "timestamp": datetime.now(timezone.utc),
-            "created_at": datetime.now(timezone.utc).isoformat(),
+            "timestamp": now,
+            "created_at": now.isoformat(),
             "user_name": user_name,          
             "phone_number": phone_number,   
             "conversation_id": f"chat_{user_id}",  
         }
         
-        result = collection.insert_one(doc)
-        logging.info("200 Saved message to database")
+        if WRITE_DURABILITY == "buffered" and not sync:
+            summary_op = None
+            if summary_collection is not None:
+                summary_op = UpdateOne(
+                    {"_id": user_id},
+                    _summary_update(user_id, sender_type, now, user_name, phone_number),
+                    upsert=True
+                )
+            write_buffer.add(doc, summary_op)
+        else:
+            collection.insert_one(doc)
+            logging.info("200 Saved message to database")
+            update_user_summary(user_id, sender_type, now, user_name, phone_number)
+        if HISTORY_CACHE_ENABLED:
+            history_cache.append(user_id, {
+                "sender_type": sender_type,
+                "message": message,
+                "timestamp": now,
+                "user_name": user_name,
+                "conversation_id": doc["conversation_id"]
+            })
         return True
         
     except Exception as e:
@@ -258,6 +1315,7 @@ def save_message_to_db(user_id: str, message: str, sender_type: str, message_typ
         logging.error("Failed to save message for user %s", user_id)
         return False
 
+@metrics.timed("get_conversation_history")
 def get_conversation_history(user_id: str, limit: int | None = None) -> list:
   
     if collection is None:
@@ -266,7 +1324,25 @@ def get_conversation_history(user_id: str, limit: int | None = None) -> list:
 
     try:
         actual_limit = limit or MEMORY_LIMIT
-        
+        use_cache = HISTORY_CACHE_ENABLED and actual_limit <= MEMORY_LIMIT
+        if use_cache:
+            cached = history_cache.get(user_id, actual_limit)
+            if cached is not None and HISTORY_CACHE_VERIFY:
+                try:
+                    summary = summary_collection.find_one({"_id": user_id}, {"last_message": 1})
+                except Exception as e:
+                    dev_log(e, "ERR200")
+                    summary = {"last_message": datetime.max}  # unverifiable: read from Mongo
+                if not history_cache_is_current(history_cache.newest(user_id), summary):
+                    history_cache.discard(user_id)
+                    cached = None
+            if cached is not None:
+                return cached
+            # cold user: read a full ring's worth so later calls are served from memory
+            actual_limit = MEMORY_LIMIT
+        if write_buffer.pending():
+            # make buffered turns visible before reading from Mongo
+            write_buffer.flush()
         
         query = {
             "user_id": user_id,  
@@ -288,7 +1364,15 @@ def get_conversation_history(user_id: str, limit: int | None = None) -> list:
                     "user_name": r.get("user_name"),       
                     "conversation_id": r.get("conversation_id")  
                 })
+
+        if len(history) < actual_limit and archive_collection is not None:
+            # quiet users: the rest of the window lives in the archive tier
+            oldest = records[-1].get("timestamp") if records else None
+            history = archived_history(user_id, actual_limit - len(history), before=oldest) + history
         
+        if use_cache:
+            history_cache.load(user_id, history)
+            return history[-(limit or MEMORY_LIMIT):]
         return history
         
     except Exception as e:
@@ -296,69 +1380,505 @@ def get_conversation_history(user_id: str, limit: int | None = None) -> list:
         logging.error("Failed to retrieve conversation history for user %s", user_id[-4:])
         return []
 
+def archived_history(user_id: str, limit: int, before: datetime | None = None) -> list:
+    #newest `limit` archived turns older than `before`, oldest first, shaped like get_conversation_history rows
+    if archive_collection is None or limit <= 0:
+        return []
+    turns = []
+    try:
+        for bucket in archive_collection.find({"user_id": user_id}).sort("day", -1):
+            for m in sorted(bucket.get("messages", []), key=lambda m: _as_utc(m["t"]), reverse=True):
+                if before is not None and _as_utc(m["t"]) >= _as_utc(before):
+                    continue  # still hot, or a pass is between packing and deleting it
+                turns.append({
+                    "sender_type": m.get("s"),
+                    "message": m.get("m"),
+                    "timestamp": m.get("t"),
+                    "user_name": bucket.get("user_name"),
+                    "conversation_id": f"chat_{user_id}"
+                })
+                if len(turns) >= limit:
+                    return turns[::-1]
+    except Exception as e:
+        dev_log(e, "ERR200")
+    return turns[::-1]
+
+# same output fields as _COUNTS_GROUP, computed over conversation_archive buckets
+_ARCHIVE_COUNTS = [
+    {"$project": {
+        "user_id": 1,
+        "n": {"$size": "$messages"},
+        "u": {"$size": {"$filter": {"input": "$messages", "cond": {"$eq": ["$$this.s", "user"]}}}},
+        "b": {"$size": {"$filter": {"input": "$messages", "cond": {"$eq": ["$$this.s", "bot"]}}}},
+        "first": {"$min": "$messages.t"},
+        "last": {"$max": "$messages.t"},
+    }},
+    {"$group": {
+        "_id": "$user_id",
+        "total_messages": {"$sum": "$n"},
+        "user_messages": {"$sum": "$u"},
+        "bot_messages": {"$sum": "$b"},
+        "first_message": {"$min": "$first"},
+        "last_message": {"$max": "$last"},
+    }},
+]
+
+def _merge_counts(hot: dict | None, archived: dict | None) -> dict | None:
+    if not archived:
+        return hot
+    if not hot:
+        return archived
+    merged = {key: hot.get(key, 0) + archived.get(key, 0)
+              for key in ("total_messages", "user_messages", "bot_messages")}
+    firsts = [v for v in (hot.get("first_message"), archived.get("first_message")) if v is not None]
+    lasts = [v for v in (hot.get("last_message"), archived.get("last_message")) if v is not None]
+    merged["first_message"] = min(firsts, key=_as_utc) if firsts else None
+    merged["last_message"] = max(lasts, key=_as_utc) if lasts else None
+    return merged
+
+_COUNTS_GROUP = {
+    "$group": {
+        "_id": "$user_id",
+        "total_messages": {"$sum": 1},
+        "user_messages": {"$sum": {"$cond": [{"$eq": ["$sender_type", "user"]}, 1, 0]}},
+        "bot_messages": {"$sum": {"$cond": [{"$eq": ["$sender_type", "bot"]}, 1, 0]}},
+        "first_message": {"$min": "$timestamp"},
+        "last_message": {"$max": "$timestamp"},
+    }
+}
+_NAMED = {"user_name": {"$exists": True, "$ne": None}}
+
+def _stats_from_group(user_id: str, counts: dict | None, user_info: dict | None) -> dict:
+    counts = counts or {}
+    return {
+        "user_id": user_id,
+        "user_name": user_info.get("user_name") if user_info else "Unknown",
+        "phone_number": user_info.get("phone_number") if user_info else user_id,
+        "total_messages": counts.get("total_messages", 0),
+        "user_messages": counts.get("user_messages", 0),
+        "bot_messages": counts.get("bot_messages", 0),
+        "first_message": counts.get("first_message"),
+        "last_message": counts.get("last_message"),
+        "conversation_id": f"chat_{user_id}"
+    }
+
 def get_user_stats(user_id: str) -> dict:
     #get conversation statistics for a specific user. SECURITY: Only returns data for the specified user
     if collection is None:
         return {"error": "Database disabled"}
     
     try:
-       
-        user_filter = {"user_id": user_id}
-        total_messages = collection.count_documents(user_filter)
-        user_messages = collection.count_documents({**user_filter, "sender_type": "user"})
-        bot_messages = collection.count_documents({**user_filter, "sender_type": "bot"})
-        first_msg = collection.find_one(user_filter, sort=[("timestamp", 1)])
-        last_msg = collection.find_one(user_filter, sort=[("timestamp", -1)])
-        user_info = collection.find_one(
-            {**user_filter, "user_name": {"$exists": True, "$ne": None}},
-            sort=[("timestamp", -1)]
-        )
-
-        return {
-            "user_id": user_id,
-            "user_name": user_info.get("user_name") if user_info else "Unknown",
-            "phone_number": user_info.get("phone_number") if user_info else user_id,
-            "total_messages": total_messages,
-            "user_messages": user_messages,
-            "bot_messages": bot_messages,
-            "first_message": first_msg.get("timestamp") if first_msg else None,
-            "last_message": last_msg.get("timestamp") if last_msg else None,
-            "conversation_id": f"chat_{user_id}"
-        }
+        # one round-trip: counters from a single $group plus the newest message carrying a name
+        pipeline = [
+            {"$match": {"user_id": user_id}},
+            {"$facet": {
+                "counts": [_COUNTS_GROUP],
+                "user_info": [
+                    {"$match": _NAMED},
+                    {"$sort": {"timestamp": -1}},
+                    {"$limit": 1},
+                    {"$project": {"_id": 0, "user_name": 1, "phone_number": 1}},
+                ],
+            }},
+        ]
+        result = next(collection.aggregate(pipeline), {})
+        counts = (result.get("counts") or [None])[0]
+        user_info = (result.get("user_info") or [None])[0]
+        if archive_collection is not None:
+            archived = next(archive_collection.aggregate([{"$match": {"user_id": user_id}}] + _ARCHIVE_COUNTS), None)
+            counts = _merge_counts(counts, archived)
+            if user_info is None:
+                user_info = archive_collection.find_one(
+                    {"user_id": user_id, **_NAMED}, {"_id": 0, "user_name": 1, "phone_number": 1},
+                    sort=[("day", -1)]
+                )
+        return _stats_from_group(user_id, counts, user_info)
         
     except Exception as e:
         logging.error("Error getting user stats for %s: %s", user_id[-4:], e)
         return {"error": str(e)}
 
-def get_all_users() -> list:
-    #get a list of all users who have interacted with the bot
-    if collection is None:
+def _summary_update(user_id: str, sender_type: str, timestamp: datetime,
+                    user_name: str | None = None, phone_number: str | None = None) -> dict:
+    update = {
+        "$inc": {
+            "total_messages": 1,
+            "user_messages": 1 if sender_type == "user" else 0,
+            "bot_messages": 1 if sender_type == "bot" else 0,
+        },
+        "$min": {"first_message": timestamp},
+        "$max": {"last_message": timestamp},
+        "$setOnInsert": {"user_id": user_id, "conversation_id": f"chat_{user_id}"},
+    }
+    if user_name is not None:
+        update["$set"] = {"user_name": user_name, "phone_number": phone_number}
+    return update
+
+def update_user_summary(user_id: str, sender_type: str, timestamp: datetime,
+                        user_name: str | None = None, phone_number: str | None = None) -> bool:
+    #incrementally maintain the per-user summary document read by get_all_users
+    if summary_collection is None:
+        return False
+    try:
+        update = _summary_update(user_id, sender_type, timestamp, user_name, phone_number)
+        summary_collection.update_one({"_id": user_id}, update, upsert=True)
+        return True
+    except Exception as e:
+        dev_log(e, "ERR_SUMMARY_SAVE")
+        return False
+
+def rebuild_user_summaries() -> int:
+    #backfill user_summaries from the conversations collection (migration / repair); returns users written.
+    #counters only ever move forward, so it fills in missing counts but never undoes live updates
+    if collection is None or summary_collection is None:
+        return 0
+    try:
+        return _rebuild_user_summaries()
+    except Exception as e:
+        dev_log(e, "ERR_SUMMARY_REBUILD")
+        return 0
+
+def _rebuild_user_summaries() -> int:
+    names = {}
+    name_pipeline = [
+        {"$match": _NAMED},
+        {"$sort": {"timestamp": 1}},
+        {"$group": {"_id": "$user_id", "user_name": {"$last": "$user_name"}, "phone_number": {"$last": "$phone_number"}}},
+    ]
+    for row in collection.aggregate(name_pipeline, allowDiskUse=True):
+        names[row["_id"]] = row
+
+    counts = {row["_id"]: row for row in collection.aggregate([_COUNTS_GROUP], allowDiskUse=True)}
+    if archive_collection is not None:
+        for row in archive_collection.aggregate(_ARCHIVE_COUNTS, allowDiskUse=True):
+            counts[row["_id"]] = _merge_counts(counts.get(row["_id"]), row)
+        archived_names = [
+            {"$match": _NAMED},
+            {"$sort": {"day": 1}},
+            {"$group": {"_id": "$user_id", "user_name": {"$last": "$user_name"}, "phone_number": {"$last": "$phone_number"}}},
+        ]
+        for row in archive_collection.aggregate(archived_names, allowDiskUse=True):
+            names.setdefault(row["_id"], row)
+
+    # counts were aggregated a moment ago, so live $inc/$min/$max writes may have landed since:
+    # only ever move the stored counters forward, and leave names to the newer live $set
+    ops = []
+    for user_id, row in counts.items():
+        user_info = names.get(user_id)
+        stats = _stats_from_group(user_id, row, user_info)
+        update = {
+            "$max": {key: stats[key] for key in ("total_messages", "user_messages", "bot_messages")},
+            "$setOnInsert": {"user_id": user_id, "conversation_id": stats["conversation_id"]},
+        }
+        if stats["last_message"] is not None:
+            update["$max"]["last_message"] = stats["last_message"]
+        if stats["first_message"] is not None:
+            update["$min"] = {"first_message": stats["first_message"]}
+        if user_info:
+            update["$setOnInsert"].update(user_name=stats["user_name"], phone_number=stats["phone_number"])
+        ops.append(UpdateOne({"_id": user_id}, update, upsert=True))
+    if ops:
+        summary_collection.bulk_write(ops, ordered=False)
+    logging.info("200 Rebuilt %d user summaries", len(ops))
+    return len(ops)
+
+def migrate_user_summaries() -> bool:
+    """Backfill user_summaries once per deployment; True once the migration is recorded as done.
+
+    Existing deployments have messages but no summaries, and the first message saved after
+    the upgrade creates a summary, so emptiness can't tell whether the backfill ran. The
+    migrations collection records it instead. A claim older than MIGRATION_STALE_AFTER
+    (a worker that died mid-run) is taken over.
+    """
+    if db is None or summary_collection is None:
+        return False
+    migrations = db[MIGRATIONS_COLLECTION_NAME]
+    now = datetime.now(timezone.utc)
+    try:
+        migrations.update_one(
+            {"_id": "user_summaries", "completed_at": None,
+             "started_at": {"$not": {"$gt": now - timedelta(seconds=MIGRATION_STALE_AFTER)}}},
+            {"$set": {"started_at": now}},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        return False  # already done, or another worker is running it
+    except Exception as e:
+        dev_log(e, "ERR_SUMMARY_REBUILD")
+        return False
+    try:
+        users = _rebuild_user_summaries()
+    except Exception as e:
+        dev_log(e, "ERR_SUMMARY_REBUILD")
+        migrations.delete_one({"_id": "user_summaries", "completed_at": None})  # let the next boot retry
+        return False
+    migrations.update_one({"_id": "user_summaries"}, {"$set": {"completed_at": datetime.now(timezone.utc), "users": users}})
+    return True
+
+def get_all_users(skip: int = 0, limit: int | None = None) -> list:
+    #get a page of users who have interacted with the bot, most recently active first
+    if collection is None or summary_collection is None:
         return []
     
     try:
-        user_ids = collection.distinct("user_id")
+        cursor = summary_collection.find({}).sort("last_message", -1).skip(skip)
+        if limit:
+            cursor = cursor.limit(limit)
+
         users = []
-        
-        for user_id in user_ids:
-            stats = get_user_stats(user_id)
-            if "error" not in stats:
-                users.append(stats)
-        
-        return sorted(users, key=lambda x: x.get("last_message", ""), reverse=True)
+        for s in cursor:
+            user_id = s["_id"]
+            users.append({
+                "user_id": user_id,
+                "user_name": s.get("user_name") or "Unknown",
+                "phone_number": s.get("phone_number") or user_id,
+                "total_messages": s.get("total_messages", 0),
+                "user_messages": s.get("user_messages", 0),
+                "bot_messages": s.get("bot_messages", 0),
+                "first_message": s.get("first_message"),
+                "last_message": s.get("last_message"),
+                "conversation_id": f"chat_{user_id}"
+            })
+        return users
         
     except Exception as e:
         logging.error("Error getting all users: %s", e)
         return []
 
-def is_first_time_user(user_id: str) -> bool:
-  
-    if collection is None:
-        return True
-    try:
-        message_count = collection.count_documents({"user_id": user_id})
-        return message_count == 0
-    except Exception:
+class ConversationArchiver:
+    """Moves messages older than ARCHIVE_AFTER_DAYS out of the hot conversations collection.
+
+    Each pass packs them into one conversation_archive document per user and UTC day with a
+    slim per-message schema (no repeated user_name, phone_number, conversation_id or
+    created_at), then deletes the originals. Messages are added with $addToSet and keep their
+    original _id, so a pass interrupted between the two steps, or run by several gunicorn
+    workers at once, never duplicates a message. Buckets expire ARCHIVE_RETENTION_DAYS after
+    their day when a retention is set.
+    """
+
+    def __init__(self, after_days: float, retention_days: float, interval: float, batch_size: int):
+        self.after_days = after_days
+        self.retention_days = retention_days
+        self.interval = interval
+        self.batch_size = max(1, batch_size)
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.passes = 0
+        self.archived = 0
+        self.last_report = {}
+
+    def start(self):
+        with self._lock:
+            if (self._thread is not None and self._thread.is_alive()) or self._stop.is_set():
+                return
+            self._thread = threading.Thread(target=self._run, name="conversation-archiver", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.compact()
+                self.last_report = self.storage_report()
+            except Exception as e:
+                dev_log(e, "ERR_ARCHIVE")
+            self._stop.wait(self.interval)
+
+    def close(self):
+        self._stop.set()
+
+    def _bucket_update(self, user_id: str, day: datetime, docs: list) -> UpdateOne:
+        messages = []
+        for d in docs:
+            m = {"i": d["_id"], "t": d.get("timestamp"), "s": d.get("sender_type"), "m": d.get("message")}
+            if d.get("message_type", "text") != "text":
+                m["k"] = d["message_type"]
+            messages.append(m)
+        update = {
+            "$addToSet": {"messages": {"$each": messages}},
+            "$setOnInsert": {"user_id": user_id, "day": day},
+        }
+        named = [d for d in docs if d.get("user_name")]
+        fields = {}
+        if named:
+            fields.update(user_name=named[-1]["user_name"], phone_number=named[-1].get("phone_number"))
+        if self.retention_days > 0:
+            fields["expires_at"] = day + timedelta(days=self.retention_days)
+        if fields:
+            update["$set"] = fields
+        return UpdateOne({"_id": f"{user_id}:{day:%Y-%m-%d}"}, update, upsert=True)
+
+    def compact(self, now: datetime | None = None) -> int:
+        """Archive everything older than the cutoff in batches; returns how many messages moved."""
+        if collection is None or archive_collection is None:
+            return 0
+        cutoff = (now or datetime.now(timezone.utc)) - timedelta(days=self.after_days)
+        moved = 0
+        while not self._stop.is_set():
+            docs = list(collection.find({"timestamp": {"$lt": cutoff}}).sort("timestamp", 1).limit(self.batch_size))
+            if not docs:
+                break
+            buckets = {}
+            for d in docs:
+                ts = _as_utc(d.get("timestamp"))
+                day = datetime(ts.year, ts.month, ts.day, tzinfo=timezone.utc)
+                buckets.setdefault((d.get("user_id"), day), []).append(d)
+            archive_collection.bulk_write(
+                [self._bucket_update(user_id, day, group) for (user_id, day), group in buckets.items()],
+                ordered=False
+            )
+            # only delete once every bucket write succeeded (bulk_write raises otherwise)
+            collection.delete_many({"_id": {"$in": [d["_id"] for d in docs]}})
+            moved += len(docs)
+            if len(docs) < self.batch_size:
+                break
+        with self._lock:
+            self.passes += 1
+            self.archived += moved
+        if moved:
+            logging.info("200 Archived %d messages older than %s", moved, cutoff.date())
+        return moved
+
+    @staticmethod
+    def _collection_stats(coll) -> dict:
+        stats = next(coll.aggregate([{"$collStats": {"storageStats": {}}}]), {}).get("storageStats", {})
+        return {
+            "documents": stats.get("count", 0),
+            "data_bytes": stats.get("size", 0),
+            "storage_bytes": stats.get("storageSize", 0),
+            "index_bytes": stats.get("totalIndexSize", 0),
+        }
+
+    def storage_report(self) -> dict:
+        """Size of each tier; the hot tier's data plus indexes is the working set prompts depend on."""
+        if collection is None:
+            return {}
+        try:
+            report = {"hot": self._collection_stats(collection)}
+            if archive_collection is not None:
+                report["archive"] = self._collection_stats(archive_collection)
+            report["working_set_bytes"] = report["hot"]["data_bytes"] + report["hot"]["index_bytes"]
+            return report
+        except Exception as e:
+            dev_log(e, "ERR_ARCHIVE_STATS")
+            return {}
+
+    def gauges(self) -> list:
+        with self._lock:
+            gauges = [("archive_passes", None, self.passes), ("archive_moved_messages", None, self.archived)]
+        report = self.last_report
+        for tier in ("hot", "archive"):
+            for key, value in (report.get(tier) or {}).items():
+                gauges.append((f"storage_{key}", {"tier": tier}, value))
+        if "working_set_bytes" in report:
+            gauges.append(("storage_working_set_bytes", None, report["working_set_bytes"]))
+        return gauges
+
+
+conversation_archiver = ConversationArchiver(ARCHIVE_AFTER_DAYS, ARCHIVE_RETENTION_DAYS, ARCHIVE_INTERVAL,
+                                             ARCHIVE_BATCH_SIZE)
+atexit.register(conversation_archiver.close)
+
+class KnownUserRegistry:
+    """Answers "has this user written before?" without counting their messages.
+
+    1. an in-process LRU of known ids, warmed at startup from the compact users collection
+    2. an insert-if-absent on users keyed by _id: DuplicateKeyError means known, success means
+       first contact, atomically, so two workers can't both welcome the same user
+    3. without the users collection (or when it errors) a single indexed find_one on conversations
+    A successful insert is checked against conversations written before it, so users who
+    predate the users collection are not welcomed a second time.
+    """
+
+    def __init__(self, max_cached: int):
+        self.max_cached = max(1, max_cached)
+        self._known = OrderedDict()  # user_id -> None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.inserts = 0
+        self.fallbacks = 0
+
+    def contains(self, user_id: str) -> bool:
+        with self._lock:
+            if user_id in self._known:
+                self._known.move_to_end(user_id)
+                self.hits += 1
+                return True
+            return False
+
+    def add(self, user_id: str):
+        with self._lock:
+            self._known[user_id] = None
+            self._known.move_to_end(user_id)
+            while len(self._known) > self.max_cached:
+                self._known.popitem(last=False)
+
+    def warm(self) -> int:
+        """Load up to max_cached ids from the users collection; returns how many were loaded."""
+        if users_collection is None:
+            return 0
+        try:
+            ids = [doc["_id"] for doc in users_collection.find({}, {"_id": 1}).limit(self.max_cached)]
+        except Exception as e:
+            dev_log(e, "ERR_KNOWN_USERS")
+            return 0
+        with self._lock:
+            for user_id in ids:
+                self._known.setdefault(user_id, None)
+        logging.info("200 Known-user registry warmed with %d users", len(ids))
+        return len(ids)
+
+    def is_new(self, user_id: str) -> bool:
+        if self.contains(user_id):
+            return False
+        if users_collection is not None:
+            now = datetime.now(timezone.utc)
+            try:
+                users_collection.insert_one({"_id": user_id, "first_seen": now})
+            except DuplicateKeyError:
+                self.add(user_id)
+                return False
+            except Exception as e:
+                dev_log(e, "ERR_KNOWN_USERS")
+            else:
+                self.inserts += 1
+                self.add(user_id)
+                return not self._has_messages(user_id, before=now)
+        self.fallbacks += 1
+        is_new = not self._has_messages(user_id)
+        if not is_new:
+            self.add(user_id)
+        return is_new
+
+    @staticmethod
+    def _has_messages(user_id: str, before: datetime | None = None) -> bool:
+        if collection is None:
+            return False
+        query = {"user_id": user_id}
+        if before is not None:
+            query["timestamp"] = {"$lt": before}
+        try:
+            if collection.find_one(query, {"_id": 1}) is not None:
+                return True
+            # everything older than ARCHIVE_AFTER_DAYS has moved to the archive tier
+            return archive_collection is not None and archive_collection.find_one({"user_id": user_id}, {"_id": 1}) is not None
+        except Exception:
+            return False
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"cached": len(self._known), "hits": self.hits, "inserts": self.inserts,
+                    "fallbacks": self.fallbacks}
+
+
+known_users = KnownUserRegistry(KNOWN_USERS_MAX_CACHED)
+
+@metrics.timed("is_first_time_user")
+def is_first_time_user(user_id: str) -> bool:
+    #first contact check through the known-user registry (no per-message counting)
+    if collection is None:
         return True
+    return known_users.is_new(user_id)
 
 def build_welcome_message(user_name: str | None = None) -> str:
    # Build welcome message for first-time users
@@ -368,80 +1888,1580 @@ def build_welcome_message(user_name: str | None = None) -> str:
 By messaging me, you have agreed to our Terms of Service {TERMS_URL} and Privacy Policy {PRIVACY_URL}.
 """
 
+# the identity line and the behaviour/legal rules never change at runtime, so they are rendered once
+_PROMPT_HEAD = f"You are {BOT_NAME}, a helpful WhatsApp assistant created by {CREATOR_NAME}.\n\n"
+_PROMPT_RULES = "".join([
+    "BOT BEHAVIOR:\n",
+    "- Keep replies concise (1-3 sentences) suitable for WhatsApp\n",
+    "- Use conversation history for context when relevant\n",
+    "- Be helpful, friendly, and informative\n",
+    "- Provide location-aware responses based on user's country code\n",
+    "- Don't invent facts about users or make assumptions beyond their phone number location\n\n",
+
+    "PRIVACY & SECURITY RULES:\n",
+    "- NEVER share information about other users or conversations\n",
+    "- ONLY discuss data related to the current user\n",
+    "- Don't reveal sensitive technical details \n",
+    "- Dont talk about the bot database or sensitive matters concerning the bot \n\n",
+
+    "LEGAL INFORMATION & LINKS:\n",
+    f"- Privacy Policy URL: {PRIVACY_URL}\n",
+    f"- Terms of Service URL: {TERMS_URL}\n",
+    "- IMPORTANT: Always use these EXACT URLs when users ask about privacy or terms\n",
+    "- Do NOT create or suggest alternative links - only use the URLs provided above\n",
+    "- When asked about privacy policy, respond with the Privacy Policy URL\n",
+    "- When asked about terms of service, respond with the Terms of Service URL\n",
+    "- Users automatically agree to terms by messaging the bot\n",
+    f"- For support or data deletion requests, direct users to contact: {CREATOR_EMAIL}\n\n",
+
+    "GUIDELINES:\n",
+    "- Don't repeat old messages verbatim from history\n",
+    "- For technical questions, keep answers general and user-focused\n",
+    "- Direct data deletion requests to contact the developer via appropriate channels\n",
+    f"- CRITICAL: When users ask about privacy policy, ALWAYS respond with: {PRIVACY_URL}\n",
+    f"- CRITICAL: When users ask about terms of service, ALWAYS respond with: {TERMS_URL}\n",
+    "- Never create fake GitHub links or alternative URLs for legal documents\n",
+])
+
+_user_context_cache = OrderedDict()  # user_id -> (expiry, USER CONTEXT block)
+_user_context_lock = threading.Lock()
+
+def invalidate_user_context(user_id: str):
+    #drop the cached prompt context so the next prompt picks up a new location
+    with _user_context_lock:
+        _user_context_cache.pop(user_id, None)
+
+def cached_user_context(user_id: str) -> str | None:
+    now = time.monotonic()
+    with _user_context_lock:
+        cached = _user_context_cache.get(user_id)
+        if cached and cached[0] > now:
+            _user_context_cache.move_to_end(user_id)
+            return cached[1]
+    return None
+
+def remember_user_context(user_id: str, block: str):
+    with _user_context_lock:
+        _user_context_cache[user_id] = (time.monotonic() + PROMPT_CONTEXT_TTL, block)
+        _user_context_cache.move_to_end(user_id)
+        while len(_user_context_cache) > PROMPT_CONTEXT_CACHE_SIZE:
+            _user_context_cache.popitem(last=False)
+
+def format_user_context(user_id: str, location_data: dict | None) -> str:
+    lines = ["USER CONTEXT:\n", f"- Current user's phone number: {user_id}\n"]
+    if location_data:
+        lines.append(f"- User's location: {location_data['country_name']} (Code: {location_data['country_code']})\n")
+        lines.append(f"- Country dial code: {location_data['dial_code']}\n")
+        lines.append(f"- Provide responses relevant to {location_data['country_name']} culture and context\n")
+    else:
+        lines.append("- Use the phone number country code to provide location-relevant information\n")
+    lines.append("- Tailor responses to be culturally and regionally appropriate\n\n")
+    return "".join(lines)
+
+def build_user_context(user_id: str) -> str:
+    #USER CONTEXT block of the system prompt, cached per user for PROMPT_CONTEXT_TTL seconds
+    block = cached_user_context(user_id)
+    if block is None:
+        block = format_user_context(user_id, get_user_location(user_id))
+        remember_user_context(user_id, block)
+    return block
+
+@metrics.timed("build_system_prompt")
 def build_system_prompt(user_id: str = None) -> str:
     #build the system prompt that instructs the assistant about identity and user context
-    s = f"You are {BOT_NAME}, a helpful WhatsApp assistant created by {CREATOR_NAME}.\n\n"
     if user_id:
-        location_data = get_user_location(user_id)
-        s += f"USER CONTEXT:\n"
-        s += f"- Current user's phone number: {user_id}\n"
-        if location_data:
-            s += f"- User's location: {location_data['country_name']} (Code: {location_data['country_code']})\n"
-            s += f"- Country dial code: {location_data['dial_code']}\n"
-            s += f"- Provide responses relevant to {location_data['country_name']} culture and context\n"
-        else:
-            s += f"- Use the phone number country code to provide location-relevant information\n"
-        s += f"- Tailor responses to be culturally and regionally appropriate\n\n"
-    s += "BOT BEHAVIOR:\n"
-    s += "- Keep replies concise (1-3 sentences) suitable for WhatsApp\n"
-    s += "- Use conversation history for context when relevant\n"
-    s += "- Be helpful, friendly, and informative\n"
-    s += "- Provide location-aware responses based on user's country code\n"
-    s += "- Don't invent facts about users or make assumptions beyond their phone number location\n\n"
-    
-    s += "PRIVACY & SECURITY RULES:\n"
-    s += "- NEVER share information about other users or conversations\n"
-    s += "- ONLY discuss data related to the current user\n"
-    s += "- Don't reveal sensitive technical details \n"
-    s += "- Dont talk about the bot database or sensitive matters concerning the bot \n\n"
-    
-    s += "LEGAL INFORMATION & LINKS:\n"
-    s += f"- Privacy Policy URL: {PRIVACY_URL}\n"
-    s += f"- Terms of Service URL: {TERMS_URL}\n"
-    s += "- IMPORTANT: Always use these EXACT URLs when users ask about privacy or terms\n"
-    s += "- Do NOT create or suggest alternative links - only use the URLs provided above\n"
-    s += "- When asked about privacy policy, respond with the Privacy Policy URL\n"
-    s += "- When asked about terms of service, respond with the Terms of Service URL\n"
-    s += "- Users automatically agree to terms by messaging the bot\n"
-    s += f"- For support or data deletion requests, direct users to contact: {CREATOR_EMAIL}\n\n"
-    
-    s += "GUIDELINES:\n"
-    s += "- Don't repeat old messages verbatim from history\n"
-    s += "- For technical questions, keep answers general and user-focused\n"
-    s += "- Direct data deletion requests to contact the developer via appropriate channels\n"
-    s += f"- CRITICAL: When users ask about privacy policy, ALWAYS respond with: {PRIVACY_URL}\n"
-    s += f"- CRITICAL: When users ask about terms of service, ALWAYS respond with: {TERMS_URL}\n"
-    s += "- Never create fake GitHub links or alternative URLs for legal documents\n"
-    return s
+        return _PROMPT_HEAD + build_user_context(user_id) + _PROMPT_RULES
+    return _PROMPT_HEAD + _PROMPT_RULES
+
+_TOKEN_RE = re.compile(r"\w{1,4}|[^\w\s]")
+
+def truncate_tokens(text: str | None, limit: int) -> str:
+    #cut text after `limit` estimated tokens (same counting as estimate_tokens)
+    text = text or ""
+    for i, match in enumerate(_TOKEN_RE.finditer(text)):
+        if i == limit:
+            return text[:match.start()].rstrip() + " ..."
+    return text
+
+def estimate_tokens(text: str | None) -> int:
+    #cheap local stand-in for the model tokenizer: ~4-character word pieces plus punctuation
+    return len(_TOKEN_RE.findall(text or ""))
+
+def estimate_message_tokens(message: dict) -> int:
+    return estimate_tokens(message.get("content")) + 4  # per-message role/formatting overhead
+
+def assemble_chat_messages(user_id: str, user_text: str, history: list, system_prompt: str,
+                           summary: dict | None = None) -> list:
+    """Fit system prompt, optional rolling summary, recent history and the new turn into PROMPT_TOKEN_BUDGET."""
+    system_message = {"role": "system", "content": system_prompt}
+    user_message = {"role": "user", "content": user_text}
+
+    # with a rolling summary, turns it already covers are replaced by the summary itself
+    covered_until = summary.get("covered_until") if summary else None
+    summary_message = None
+    if summary:
+        summary_message = {"role": "system", "content": f"Summary of the earlier conversation:\n{summary['summary']}"}
+
+    turns = []
+    for h in history:
+        role = "user" if h["sender_type"] == "user" else "assistant"
+        if covered_until and h.get("timestamp") and _truncate_ms(_as_utc(h["timestamp"])) <= covered_until:
+            continue
+        if h.get("conversation_id") == f"chat_{user_id}":
+            turns.append({"role": role, "content": h["message"]})
+
+    used = estimate_message_tokens(system_message) + estimate_message_tokens(user_message)
+    if summary_message:
+        used += estimate_message_tokens(summary_message)
+    kept = []
+    for turn in reversed(turns):  # newest first, so the oldest turns are the ones dropped
+        cost = estimate_message_tokens(turn)
+        if PROMPT_TOKEN_BUDGET and used + cost > PROMPT_TOKEN_BUDGET:
+            break
+        kept.append(turn)
+        used += cost
+    if len(kept) < len(turns):
+        logging.info("Prompt trimmed to %d of %d history turns", len(kept), len(turns))
+
+    prompt_tokens_histogram.observe(used)
+    logging.info("Prompt tokens (estimated): %d", used)
+    prefix = [system_message, summary_message] if summary_message else [system_message]
+    return prefix + kept[::-1] + [user_message]
+
+def build_chat_messages(user_id: str, user_text: str) -> list:
+    #assemble system prompt + as much recent history as fits PROMPT_TOKEN_BUDGET + the new user turn
+    history = get_conversation_history(user_id, limit=MEMORY_LIMIT)
+    summary = get_conversation_summary(user_id) if SUMMARY_ENABLED else None
+    return assemble_chat_messages(user_id, user_text, history, build_system_prompt(user_id), summary)
+
+class LLMUnavailableError(Exception):
+    """Raised when the AI provider is shed by the circuit breaker or the concurrency limit."""
+
+
+class LLMGateway:
+    """Guards every completion call made through the Groq client.
+
+    - each call gets one deadline (AI_TIMEOUT seconds) that covers every model it tries
+    - at most AI_MAX_INFLIGHT completions run at once; callers wait AI_QUEUE_TIMEOUT for a slot
+    - AI_BREAKER_THRESHOLD consecutive failures open the breaker for AI_BREAKER_RESET seconds,
+      during which calls fail fast; afterwards a single trial call decides whether it closes again
+    - models in AI_MODELS are tried in order until one answers
+    """
+
+    def __init__(self, models: list, timeout: float, max_inflight: int, queue_timeout: float,
+                 failure_threshold: int, reset_timeout: float):
+        self.models = models
+        self.timeout = timeout
+        self.queue_timeout = queue_timeout
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_timeout = reset_timeout
+        self._slots = threading.BoundedSemaphore(max(1, max_inflight))
+        self._lock = threading.Lock()
+        self._state = "closed"
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_running = False
+        self.inflight = 0
+        self.latency = Histogram()
+        self.requests = {}  # model -> calls
+        self.errors = {}  # model -> failed calls
+        self.rejected = 0
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._state == "open" and time.monotonic() - self._opened_at >= self.reset_timeout:
+                return "half_open"
+            return self._state
+
+    def _allow(self) -> tuple[bool, bool]:
+        #(allowed, trial): trial is True for the single call let through to probe a half-open breaker
+        with self._lock:
+            if self._state == "closed":
+                return True, False
+            if time.monotonic() - self._opened_at < self.reset_timeout or self._trial_running:
+                return False, False
+            self._trial_running = True  # half-open: let exactly one call probe the provider
+            return True, True
+
+    def _record(self, ok: bool, trial: bool = False):
+        with self._lock:
+            if trial:
+                self._trial_running = False  # only the probe itself may let the next one through
+            if ok:
+                if self._state != "closed":
+                    logging.info("200 AI circuit breaker closed")
+                self._state = "closed"
+                self._failures = 0
+                return
+            self._failures += 1
+            if self._state != "closed" or self._failures >= self.failure_threshold:
+                if self._state != "open":
+                    logging.error("AI circuit breaker opened after %d failures", self._failures)
+                self._state = "open"
+                self._opened_at = time.monotonic()
+
+    def _count(self, counter: dict, model: str):
+        with self._lock:
+            counter[model] = counter.get(model, 0) + 1
+
+    # admission, the model loop and the bookkeeping below are shared with asgi.AsyncLLMGateway,
+    # which only swaps the slot semaphore and awaits the client
+    def _admit(self) -> bool:
+        #raises when the breaker sheds the call; returns whether it is the half-open trial
+        allowed, trial = self._allow()
+        if not allowed:
+            self.rejected += 1
+            raise LLMUnavailableError("AI circuit breaker open")
+        return trial
+
+    def _no_slot(self, trial: bool) -> LLMUnavailableError:
+        self.rejected += 1
+        if trial:
+            with self._lock:
+                self._trial_running = False
+        return LLMUnavailableError("Too many AI requests in flight")
+
+    def _enter(self):
+        with self._lock:
+            self.inflight += 1
+
+    def _attempts(self):
+        #(model, seconds left) for each model to try, all under one deadline of self.timeout
+        deadline = time.monotonic() + self.timeout
+        for model in self.models:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            self._count(self.requests, model)
+            yield model, remaining
+
+    def _failed(self, model: str, started: float, e: Exception) -> Exception:
+        self.latency.observe(time.perf_counter() - started)
+        self._count(self.errors, model)
+        logging.error("AI model %s failed: %s", model, e)
+        return e
+
+    def _succeeded(self, started: float, trial: bool):
+        self.latency.observe(time.perf_counter() - started)
+        self._record(True, trial)
+
+    def _exhausted(self, last_error: Exception | None, trial: bool) -> Exception:
+        self._record(False, trial)
+        if last_error is not None:
+            return last_error
+        if self.models:
+            return LLMUnavailableError(f"AI deadline of {self.timeout:g}s exceeded")
+        return LLMUnavailableError("No AI model configured")
+
+    def _stream_done(self, started: float, ok: bool, trial: bool):
+        self.latency.observe(time.perf_counter() - started)
+        self._record(ok, trial)
+        self._release()
+
+    def complete(self, messages: list, stream: bool = False, client=None):
+        """Return a completion (or a chunk iterator when stream=True) from the first healthy model."""
+        client = client or get_ai_client()
+        if client is None:
+            raise LLMUnavailableError("AI client not configured")
+        trial = self._admit()
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            raise self._no_slot(trial)
+
+        self._enter()
+        released = False
+        try:
+            last_error = None
+            for model, remaining in self._attempts():
+                started = time.perf_counter()
+                try:
+                    result = client.chat.completions.create(
+                        model=model, messages=messages, stream=stream, timeout=remaining
+                    )
+                except Exception as e:
+                    last_error = self._failed(model, started, e)
+                    continue
+                if stream:
+                    released = True  # the stream wrapper gives the slot back once consumed
+                    return self._guarded_stream(result, model, started, trial)
+                self._succeeded(started, trial)
+                return result
+            raise self._exhausted(last_error, trial)
+        finally:
+            if not released:
+                self._release()
+
+    def _guarded_stream(self, stream, model: str, started: float, trial: bool):
+        ok = False
+        try:
+            for chunk in stream:
+                yield chunk
+            ok = True
+        except Exception:
+            self._count(self.errors, model)
+            raise
+        finally:
+            self._stream_done(started, ok, trial)
+
+    def _release(self):
+        with self._lock:
+            self.inflight -= 1
+        self._slots.release()
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = sum(self.requests.values())
+            failed = sum(self.errors.values())
+            requests_by_model = dict(self.requests)
+            errors_by_model = dict(self.errors)
+            inflight = self.inflight
+        return {
+            "state": self.state,
+            "inflight": inflight,
+            "requests": requests_by_model,
+            "errors": errors_by_model,
+            "error_rate": round(failed / total, 4) if total else 0.0,
+            "rejected": self.rejected,
+        }
+
+
+llm_gateway = LLMGateway(
+    AI_MODELS,
+    timeout=AI_TIMEOUT,
+    max_inflight=AI_MAX_INFLIGHT,
+    queue_timeout=AI_QUEUE_TIMEOUT,
+    failure_threshold=AI_BREAKER_THRESHOLD,
+    reset_timeout=AI_BREAKER_RESET,
+)
+
+# background summaries get their own slots and breaker, so they can neither starve nor trip user replies
+summary_gateway = LLMGateway(
+    AI_MODELS,
+    timeout=AI_TIMEOUT,
+    max_inflight=SUMMARY_WORKERS,
+    queue_timeout=AI_QUEUE_TIMEOUT,
+    failure_threshold=AI_BREAKER_THRESHOLD,
+    reset_timeout=AI_BREAKER_RESET,
+)
+
+class ResponseCache:
+    """Answers repeated FAQ-style questions without calling the LLM.
+
+    Only questions about the bot itself (privacy, terms, its creator, support) are cached,
+    and their answers are generated without the user's context block or history (see
+    response_cache_messages), because one user's answer is served to everyone.
+
+    Tier one is an exact match on normalized text; tier two (when NumPy is installed)
+    compares hashed character-trigram vectors by cosine similarity, and only accepts
+    a match with the same numbers and the same order of shared words. Entries expire
+    after RESPONSE_CACHE_TTL seconds and live in a scope: "global", or the user's
+    country code when RESPONSE_CACHE_SCOPE=country.
+    """
+
+    DIMENSIONS = 2048
+    # questions that lean on earlier turns ("what about that?") must never be answered from cache
+    CONTEXT_WORDS = {"it", "that", "this", "these", "those", "he", "she", "they", "them", "him", "her",
+                     "above", "again", "more", "else", "also", "previous", "earlier", "last", "yes", "no"}
+    # the FAQ allowlist: a cacheable question mentions one of these
+    FAQ_WORDS = {"privacy", "policy", "terms", "tos", "creator", "created", "developer", "developed",
+                 "owner", "contact", "support", "deletion"}
+
+    def __init__(self, max_entries: int, ttl_seconds: float, similarity: float):
+        self.max_entries = max(1, max_entries)
+        self.ttl_seconds = ttl_seconds
+        self.similarity = similarity
+        self._entries = OrderedDict()  # (scope, normalized) -> {"answer", "expires", "latency", "vector"}
+        self._indexes = {}  # scope -> (keys, matrix) rebuilt lazily after changes
+        self._lock = threading.Lock()
+        self.exact_hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+        self.latency_saved = 0.0
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        return " ".join(re.sub(r"[^\w\s]", " ", (text or "").lower()).split())
+
+    def cacheable(self, normalized: str) -> bool:
+        words = normalized.split()
+        return (RESPONSE_CACHE_MIN_WORDS <= len(words) and len(normalized) <= RESPONSE_CACHE_MAX_CHARS
+                and not self.CONTEXT_WORDS.intersection(words) and bool(self.FAQ_WORDS.intersection(words)))
+
+    def applies(self, text: str) -> bool:
+        return self.cacheable(self.normalize(text))
+
+    @staticmethod
+    def same_shape(a: str, b: str) -> bool:
+        #trigram vectors ignore numbers and word order ("100 dollars to euros" vs "100 euros to dollars")
+        a_words, b_words = a.split(), b.split()
+        numbers = lambda words: [w for w in words if any(c.isdigit() for c in w)]
+        if numbers(a_words) != numbers(b_words):
+            return False
+        shared = set(a_words) & set(b_words)
+        return [w for w in a_words if w in shared] == [w for w in b_words if w in shared]
+
+    def _vector(self, normalized: str):
+        vec = np.zeros(self.DIMENSIONS, dtype=np.float32)
+        padded = f" {normalized} "
+        for i in range(len(padded) - 2):
+            vec[zlib.crc32(padded[i:i + 3].encode("utf-8")) % self.DIMENSIONS] += 1.0
+        norm = np.linalg.norm(vec)
+        return vec / norm if norm else vec
+
+    def _index(self, scope: str):
+        index = self._indexes.get(scope)
+        if index is None:
+            keys = [k for k in self._entries if k[0] == scope]
+            matrix = np.vstack([self._entries[k]["vector"] for k in keys]) if keys else None
+            index = self._indexes[scope] = (keys, matrix)
+        return index
+
+    def lookup(self, text: str, scope: str = "global") -> str | None:
+        normalized = self.normalize(text)
+        if not self.cacheable(normalized):
+            return None
+        now = time.monotonic()
+        with self._lock:
+            key = (scope, normalized)
+            entry = self._entries.get(key)
+            if entry is not None and entry["expires"] <= now:
+                self._entries.pop(key)
+                self._indexes.pop(scope, None)
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.exact_hits += 1
+                self.latency_saved += entry["latency"]
+                return entry["answer"]
+
+            if np is not None:
+                keys, matrix = self._index(scope)
+                if matrix is not None:
+                    scores = matrix @ self._vector(normalized)
+                    best = int(np.argmax(scores))
+                    entry = self._entries.get(keys[best])
+                    if (scores[best] >= self.similarity and entry is not None and entry["expires"] > now
+                            and self.same_shape(normalized, keys[best][1])):
+                        self.similar_hits += 1
+                        self.latency_saved += entry["latency"]
+                        return entry["answer"]
+            self.misses += 1
+            return None
+
+    def store(self, text: str, answer: str, latency: float, scope: str = "global"):
+        normalized = self.normalize(text)
+        if not answer or not self.cacheable(normalized):
+            return
+        with self._lock:
+            key = (scope, normalized)
+            self._entries[key] = {
+                "answer": answer,
+                "expires": time.monotonic() + self.ttl_seconds,
+                "latency": latency,
+                "vector": self._vector(normalized) if np is not None else None,
+            }
+            self._entries.move_to_end(key)
+            self._indexes.pop(scope, None)
+            while len(self._entries) > self.max_entries:
+                (old_scope, _), _ = self._entries.popitem(last=False)
+                self._indexes.pop(old_scope, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            hits = self.exact_hits + self.similar_hits
+            lookups = hits + self.misses
+            return {
+                "exact_hits": self.exact_hits,
+                "similar_hits": self.similar_hits,
+                "misses": self.misses,
+                "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+                "latency_saved_seconds": round(self.latency_saved, 3),
+                "entries": len(self._entries),
+            }
+
+
+response_cache = ResponseCache(RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_TTL, RESPONSE_CACHE_SIMILARITY)
+
+def response_cache_scope(user_id: str) -> str:
+    #country scope comes from the dial code, i.e. the same value stored in user_locations
+    if RESPONSE_CACHE_SCOPE != "country":
+        return "global"
+    country = match_dial_code(''.join(filter(str.isdigit, user_id or '')))
+    return country['code'] if country else "global"
+
+def response_cache_messages(user_text: str) -> list:
+    #answers that go into the shared cache are generated without the USER CONTEXT block or history
+    return [{"role": "system", "content": build_system_prompt()}, {"role": "user", "content": user_text}]
 
 def generate_ai_reply_with_context(user_id: str, user_text: str) -> str:
     # fallback default
     default_reply = f"Echo: {user_text}"
 
-    if not ai_client:
+    if not get_ai_client():
         return default_reply
 
+    scope = response_cache_scope(user_id)
+    shared = RESPONSE_CACHE_ENABLED and response_cache.applies(user_text)
+    if shared:
+        cached = response_cache.lookup(user_text, scope)
+        if cached:
+            logging.info("200 Answered from response cache")
+            return cached
+
     try:
-        history = get_conversation_history(user_id, limit=MEMORY_LIMIT)
-        system_prompt = build_system_prompt(user_id)
-        messages = [{"role": "system", "content": system_prompt}]
-        for h in history:
-            role = "user" if h["sender_type"] == "user" else "assistant"
-            if h.get("conversation_id") == f"chat_{user_id}":
-                messages.append({"role": role, "content": h["message"]})
-        messages.append({"role": "user", "content": user_text})
-
-        completion = ai_client.chat.completions.create(
-            model="openai/gpt-oss-20B",
-            messages=messages,
-        )
+        messages = response_cache_messages(user_text) if shared else build_chat_messages(user_id, user_text)
+
+        started = time.perf_counter()
+        completion = llm_gateway.complete(messages)
         ai_text = completion.choices[0].message.content.strip()  # type: ignore
+        if ai_text and shared:
+            response_cache.store(user_text, ai_text, time.perf_counter() - started, scope)
         return ai_text or default_reply
 
+    except LLMUnavailableError as e:
+        logging.error("AI unavailable: %s", e)
+        return make_user_safe_error("ERR400")
     except Exception as e:
         dev_log(e, "ERR400")
         return make_user_safe_error("ERR400")
 
+_SENTENCE_END = re.compile(r"[.!?](?=\s)")
+
+def _find_stream_cut(buffer: str) -> int:
+    """Index at which the streamed buffer can be cut into a WhatsApp message, or 0 to keep buffering.
+
+    Only cuts between STREAM_MIN_CHUNK_CHARS and STREAM_MAX_CHUNK_CHARS are taken, preferring a
+    paragraph break, then a sentence end; a buffer that reaches the maximum without either is cut
+    at its last space (or hard at the maximum)."""
+    if len(buffer) < STREAM_MIN_CHUNK_CHARS:
+        return 0
+    paragraph = buffer.rfind("\n\n", 0, STREAM_MAX_CHUNK_CHARS)
+    if paragraph + 2 >= STREAM_MIN_CHUNK_CHARS:
+        return paragraph + 2
+    sentence_ends = [m.end() for m in _SENTENCE_END.finditer(buffer, STREAM_MIN_CHUNK_CHARS - 1, STREAM_MAX_CHUNK_CHARS + 1)]
+    if sentence_ends:
+        return sentence_ends[-1]
+    if len(buffer) >= STREAM_MAX_CHUNK_CHARS:
+        space = buffer.rfind(" ", STREAM_MIN_CHUNK_CHARS - 1, STREAM_MAX_CHUNK_CHARS)
+        return space + 1 if space >= 0 else STREAM_MAX_CHUNK_CHARS
+    return 0
+
+def cut_stream_buffer(buffer: str) -> tuple[list, str]:
+    #(parts ready to send, rest still buffered); shared by stream_ai_reply and asgi's stream_reply
+    parts = []
+    cut = _find_stream_cut(buffer)
+    while cut:
+        parts.append(buffer[:cut])
+        buffer = buffer[cut:]
+        cut = _find_stream_cut(buffer)
+    return parts, buffer
+
+def stream_delta(chunk) -> str:
+    return (chunk.choices[0].delta.content or "") if chunk.choices else ""
+
+def stream_ai_reply(user_id: str, user_text: str) -> tuple[str, bool]:
+    """Stream the completion and send it to the user in sentence/paragraph sized chunks.
+
+    Returns (reply_text, sent): reply_text is the assembled reply to persist and sent
+    tells the caller whether it already went out over WhatsApp.
+    """
+    default_reply = f"Echo: {user_text}"
+
+    if not get_ai_client():
+        return default_reply, False
+
+    scope = response_cache_scope(user_id)
+    shared = RESPONSE_CACHE_ENABLED and response_cache.applies(user_text)
+    if shared:
+        cached = response_cache.lookup(user_text, scope)
+        if cached:
+            logging.info("200 Answered from response cache")
+            return cached, False
+
+    started = time.perf_counter()
+    delivered = []  # text handed to send_message so far
+    buffer = ""
+
+    def deliver(part: str):
+        part = part.strip()
+        if not part:
+            return
+        send_ok = send_message(user_id, part)
+        if not send_ok:
+            logging.error("Failed to send streamed chunk to %s", user_id)
+        if not delivered:
+            ttfm_histogram.observe(time.perf_counter() - started)
+        delivered.append(part)
+
+    try:
+        messages = response_cache_messages(user_text) if shared else build_chat_messages(user_id, user_text)
+        stream = llm_gateway.complete(messages, stream=True)
+        for chunk in stream:
+            parts, buffer = cut_stream_buffer(buffer + stream_delta(chunk))
+            for part in parts:
+                deliver(part)
+        deliver(buffer)
+        if delivered and shared:
+            response_cache.store(user_text, "\n\n".join(delivered), time.perf_counter() - started, scope)
+
+    except LLMUnavailableError as e:
+        logging.error("AI unavailable: %s", e)
+        return make_user_safe_error("ERR400"), False
+    except Exception as e:
+        dev_log(e, "ERR400")
+        if not delivered:
+            return make_user_safe_error("ERR400"), False
+
+    if not delivered:
+        return default_reply, False
+    return "\n\n".join(delivered), True
+
+_SUMMARY_INSTRUCTIONS = (
+    "You maintain a running summary of a WhatsApp conversation between a user and an assistant. "
+    "Merge the previous summary with the new turns into one concise summary (at most 10 short bullet points) "
+    "that keeps facts, preferences, open questions and commitments needed to continue the chat. "
+    "Do not add anything that was not said."
+)
+
+_conversation_summaries = OrderedDict()  # user_id -> {"summary", "covered_until"} (in-process view)
+_summary_pending = {}  # user_id -> [turns, tokens] seen since the last scheduled summary
+_summary_running = set()
+_summary_lock = threading.Lock()
+_summary_workers = WorkerThreads(SUMMARY_WORKERS, "summarizer")  # not drained at exit: summaries can wait
+
+def _as_utc(value: datetime | None) -> datetime | None:
+    # pymongo hands back naive UTC datetimes while freshly built ones are aware
+    if value is not None and value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value
+
+def _truncate_ms(value: datetime) -> datetime:
+    # Mongo keeps milliseconds, our own write-through entries keep microseconds
+    return value.replace(microsecond=value.microsecond // 1000 * 1000)
+
+def get_conversation_summary(user_id: str) -> dict | None:
+    """Stored rolling summary for a user ({"summary", "covered_until"}) or None."""
+    with _summary_lock:
+        if user_id in _conversation_summaries:
+            _conversation_summaries.move_to_end(user_id)
+            return _conversation_summaries[user_id]
+    if conversation_summary_collection is None:
+        return None
+    try:
+        doc = conversation_summary_collection.find_one({"_id": user_id})
+    except Exception as e:
+        dev_log(e, "ERR_SUMMARY_GET")
+        return None
+    summary = None
+    if doc and doc.get("summary"):
+        summary = {"summary": doc["summary"], "covered_until": _as_utc(doc.get("covered_until"))}
+    with _summary_lock:
+        _conversation_summaries[user_id] = summary
+        while len(_conversation_summaries) > HISTORY_CACHE_MAX_USERS:
+            _conversation_summaries.popitem(last=False)
+    return summary
+
+def summary_chunks(records: list, max_tokens: int) -> list:
+    #split records into runs of (record, transcript line) within max_tokens; an oversized message is truncated
+    chunks, chunk, used = [], [], 0
+    for r in records:
+        speaker = "User" if r.get("sender_type") == "user" else "Assistant"
+        line = f"{speaker}: {truncate_tokens(r.get('message'), max_tokens)}"
+        tokens = estimate_tokens(line)
+        if chunk and used + tokens > max_tokens:
+            chunks.append(chunk)
+            chunk, used = [], 0
+        chunk.append((r, line))
+        used += tokens
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+def summarize_conversation(user_id: str, client=None) -> bool:
+    """Fold older turns (all but the newest SUMMARY_KEEP_TURNS) into the user's stored summary.
+
+    At most SUMMARY_MAX_TURNS turns are read per run, oldest first, and folded in chunks of
+    SUMMARY_MAX_INPUT_TOKENS so a long backlog never exceeds the model context; the summary
+    is saved after every chunk and the next run picks up where this one stopped.
+    Runs off the request path; `client` defaults to get_ai_client() and can be any object
+    exposing chat.completions.create (e.g. a fake in tests).
+    """
+    client = client or get_ai_client()
+    if client is None or collection is None or conversation_summary_collection is None:
+        return False
+    try:
+        if write_buffer.pending():
+            write_buffer.flush()
+        previous = get_conversation_summary(user_id)
+        query = {"user_id": user_id, "conversation_id": f"chat_{user_id}"}
+        if previous and previous.get("covered_until"):
+            query["timestamp"] = {"$gt": previous["covered_until"]}
+        records = list(collection.find(query).sort("timestamp", 1).limit(SUMMARY_MAX_TURNS + SUMMARY_KEEP_TURNS))
+        older = records[:-SUMMARY_KEEP_TURNS] if SUMMARY_KEEP_TURNS else records
+        if not older:
+            return False
+
+        folded = 0
+        for chunk in summary_chunks(older, max(1, SUMMARY_MAX_INPUT_TOKENS)):
+            transcript = "\n".join(line for _, line in chunk)
+            content = f"Previous summary:\n{previous['summary'] if previous else '(none)'}\n\nNew turns:\n{transcript}"
+            completion = summary_gateway.complete([
+                {"role": "system", "content": _SUMMARY_INSTRUCTIONS},
+                {"role": "user", "content": content},
+            ], client=client)
+            summary_text = (completion.choices[0].message.content or "").strip()
+            if not summary_text:
+                break
+
+            covered_until = _as_utc(chunk[-1][0]["timestamp"])
+            conversation_summary_collection.update_one(
+                {"_id": user_id},
+                {"$set": {"summary": summary_text, "covered_until": covered_until,
+                          "updated_at": datetime.now(timezone.utc)},
+                 "$inc": {"turns_covered": len(chunk)}},
+                upsert=True
+            )
+            previous = {"summary": summary_text, "covered_until": covered_until}
+            with _summary_lock:
+                _conversation_summaries[user_id] = previous
+            folded += len(chunk)
+        if not folded:
+            return False
+        logging.info("200 Summarized %d turns", folded)
+        return True
+    except Exception as e:
+        dev_log(e, "ERR_SUMMARY")
+        return False
+
+def _run_summary(user_id: str):
+    try:
+        summarize_conversation(user_id)
+    finally:
+        with _summary_lock:
+            _summary_running.discard(user_id)
+
+def note_turns_for_summary(user_id: str, texts: list):
+    #count new turns and schedule a background summary once the turn or token trigger is reached
+    if not SUMMARY_ENABLED or conversation_summary_collection is None:
+        return
+    with _summary_lock:
+        pending = _summary_pending.setdefault(user_id, [0, 0])
+        pending[0] += len(texts)
+        pending[1] += sum(estimate_tokens(t) for t in texts)
+        triggered = (pending[0] >= SUMMARY_TRIGGER_TURNS + SUMMARY_KEEP_TURNS
+                     or (SUMMARY_TRIGGER_TOKENS and pending[1] >= SUMMARY_TRIGGER_TOKENS))
+        if not triggered or user_id in _summary_running:
+            return
+        _summary_pending.pop(user_id, None)
+        _summary_running.add(user_id)
+    _summary_workers.submit(_run_summary, user_id)
+
+class MemoryRateLimitBackend:
+    """Per-process token buckets and deferred texts keyed by user id (LRU bounded so idle users are forgotten)."""
+
+    def __init__(self, rate: float, capacity: float, max_keys: int = 100000):
+        self.rate = rate
+        self.capacity = capacity
+        self.max_keys = max(1, max_keys)
+        self._buckets = OrderedDict()  # key -> TokenBucket
+        self._deferred = OrderedDict()  # key -> texts held back for the next allowed turn
+        self._lock = threading.Lock()
+
+    def allow(self, key: str) -> bool:
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(self.rate, self.capacity)
+                while len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+        return bucket.try_acquire()
+
+    def defer(self, key: str, text: str, max_deferred: int):
+        with self._lock:
+            texts = self._deferred.setdefault(key, [])
+            texts.append(text)
+            del texts[:-max_deferred]
+            self._deferred.move_to_end(key)
+            while len(self._deferred) > self.max_keys:
+                self._deferred.popitem(last=False)
+
+    def take_deferred(self, key: str) -> list:
+        with self._lock:
+            return self._deferred.pop(key, [])
+
+
+class MongoRateLimitBackend:
+    """Token buckets in the rate_limits collection, shared by every gunicorn worker.
+
+    Refill and take happen in one find_one_and_update with an update pipeline, so
+    concurrent workers can't both spend the last token; idle buckets expire via a TTL index.
+    Deferred texts (RATE_LIMIT_ACTION=coalesce) are kept in the same document, so the
+    next allowed message picks them up whichever worker it lands on.
+    """
+
+    def __init__(self, rate: float, capacity: float, deferred_ttl: float = 3600):
+        self.rate = rate
+        self.capacity = capacity
+        self.deferred_ttl = deferred_ttl  # seconds a deferred text keeps the bucket document alive
+
+    def allow(self, key: str) -> bool:
+        if rate_limit_collection is None:
+            return True
+        now = time.time()
+        idle_ttl = self.capacity / self.rate if self.rate > 0 else 3600
+        refilled = {"$add": [
+            {"$ifNull": ["$tokens", self.capacity]},
+            {"$multiply": [{"$subtract": [now, {"$ifNull": ["$updated", now]}]}, self.rate]},
+        ]}
+        pipeline = [
+            {"$set": {"tokens": {"$min": [self.capacity, refilled]}, "updated": now,
+                      "expires_at": {"$max": ["$expires_at", datetime.fromtimestamp(now + idle_ttl, timezone.utc)]}}},
+            {"$set": {"allowed": {"$gte": ["$tokens", 1]}}},
+            {"$set": {"tokens": {"$cond": ["$allowed", {"$subtract": ["$tokens", 1]}, "$tokens"]}}},
+        ]
+        try:
+            doc = rate_limit_collection.find_one_and_update(
+                {"_id": key}, pipeline, upsert=True, return_document=ReturnDocument.AFTER
+            )
+            return bool(doc and doc.get("allowed"))
+        except Exception as e:
+            # fail open: a limiter outage must not stop replies
+            dev_log(e, "ERR_RATE_LIMIT")
+            return True
+
+    def defer(self, key: str, text: str, max_deferred: int):
+        if rate_limit_collection is None:
+            return
+        try:
+            rate_limit_collection.update_one(
+                {"_id": key},
+                {"$push": {"deferred": {"$each": [text], "$slice": -max_deferred}},
+                 "$max": {"expires_at": datetime.now(timezone.utc) + timedelta(seconds=self.deferred_ttl)}},
+                upsert=True
+            )
+        except Exception as e:
+            dev_log(e, "ERR_RATE_LIMIT")
+
+    def take_deferred(self, key: str) -> list:
+        # one atomic take: of two workers answering the same user, only one gets the texts
+        if rate_limit_collection is None:
+            return []
+        try:
+            doc = rate_limit_collection.find_one_and_update(
+                {"_id": key, "deferred": {"$exists": True}},
+                {"$unset": {"deferred": ""}},
+                projection={"deferred": 1},
+                return_document=ReturnDocument.BEFORE
+            )
+        except Exception as e:
+            dev_log(e, "ERR_RATE_LIMIT")
+            return []
+        return (doc or {}).get("deferred") or []
+
+
+class RateLimiter:
+    """Per-user admission control in front of the reply pipeline.
+
+    `backend` is anything with allow(key) -> bool, defer(key, text, max_deferred) and
+    take_deferred(key) -> list methods: MemoryRateLimitBackend for a single process,
+    MongoRateLimitBackend to share buckets and deferred texts across workers, or your own.
+    Over-limit users get at most one "slow down" notice per RATE_LIMIT_NOTICE_INTERVAL;
+    with RATE_LIMIT_ACTION=coalesce their texts are also kept and folded into the next turn.
+    """
+
+    def __init__(self, backend, notice_interval: float, max_deferred: int = 5, max_users: int = 10000):
+        self.backend = backend
+        self.notice_interval = notice_interval
+        self.max_deferred = max_deferred
+        self.max_users = max(1, max_users)
+        self._notified = OrderedDict()  # user id -> monotonic time of the last notice
+        self._lock = threading.Lock()
+        self.allowed = 0
+        self.limited = 0
+        self.deferred = 0
+
+    def allow(self, user_id: str) -> bool:
+        ok = self.backend.allow(user_id)
+        with self._lock:
+            if ok:
+                self.allowed += 1
+            else:
+                self.limited += 1
+        return ok
+
+    def should_notify(self, user_id: str) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            last = self._notified.get(user_id)
+            if last is not None and now - last < self.notice_interval:
+                return False
+            self._notified[user_id] = now
+            self._notified.move_to_end(user_id)
+            while len(self._notified) > self.max_users:
+                self._notified.popitem(last=False)
+            return True
+
+    def defer(self, user_id: str, text: str):
+        self.backend.defer(user_id, text, self.max_deferred)
+        with self._lock:
+            self.deferred += 1
+
+    def take_deferred(self, user_id: str) -> list:
+        return self.backend.take_deferred(user_id)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"allowed": self.allowed, "limited": self.limited, "deferred": self.deferred}
+
+
+class LoadShedder:
+    """Caps how many reply turns run at once in this process; the rest are turned away cheaply."""
+
+    def __init__(self, max_concurrent: int):
+        self.max_concurrent = max_concurrent
+        self.inflight = 0
+        self.shed = 0
+        self._lock = threading.Lock()
+
+    def try_enter(self) -> bool:
+        with self._lock:
+            if self.max_concurrent > 0 and self.inflight >= self.max_concurrent:
+                self.shed += 1
+                return False
+            self.inflight += 1
+            return True
+
+    def leave(self):
+        with self._lock:
+            self.inflight -= 1
+
+
+def _make_rate_limit_backend():
+    rate = RATE_LIMIT_PER_MINUTE / 60
+    if RATE_LIMIT_BACKEND == "mongo":
+        return MongoRateLimitBackend(rate, RATE_LIMIT_BURST)
+    return MemoryRateLimitBackend(rate, RATE_LIMIT_BURST)
+
+rate_limiter = RateLimiter(_make_rate_limit_backend(), RATE_LIMIT_NOTICE_INTERVAL)
+load_shedder = LoadShedder(MAX_CONCURRENT_TURNS)
+
+RATE_LIMITED_REPLY = "You're sending messages faster than I can answer. Please wait a moment before sending more."
+RATE_LIMITED_COALESCE_REPLY = "Got it - I'll answer this together with your next message."
+OVERLOADED_REPLY = "I'm handling a lot of conversations right now. Please try again in a minute."
+
+def turn_away_reply(user_id: str, message: dict, reason: str) -> str | None:
+    #bookkeeping for a message refused by the limiter or shedder; returns the notice to send, if any
+    metrics.inc("messages_turned_away_total", {"reason": reason})
+    logging.warning("Turned away message from %s (%s)", user_id[-4:], reason)
+    text_body = (message.get("text") or {}).get("body") if message.get("type") == "text" else None
+    coalesce = RATE_LIMIT_ACTION == "coalesce" and text_body
+    if coalesce:
+        rate_limiter.defer(user_id, text_body)
+    if not rate_limiter.should_notify(user_id):
+        return None
+    if coalesce:
+        return RATE_LIMITED_COALESCE_REPLY
+    return RATE_LIMITED_REPLY if reason == "user" else OVERLOADED_REPLY
+
+def with_deferred_texts(user_id: str, message: dict) -> dict:
+    #fold texts held back by RATE_LIMIT_ACTION=coalesce into this (allowed) text message
+    if RATE_LIMIT_ACTION != "coalesce" or message.get("type") != "text":
+        return message
+    deferred = rate_limiter.take_deferred(user_id)
+    if not deferred:
+        return message
+    body = "\n".join(deferred + [(message.get("text") or {}).get("body") or ""]).strip()
+    return {**message, "text": {**(message.get("text") or {}), "body": body}}
+
+def handle_incoming_message(message: dict, contacts: list) -> None:
+    """Admit a message past the per-user limiter and global shedder, then run the reply pipeline."""
+    user_id = message.get("from")
+    if RATE_LIMIT_ENABLED and not rate_limiter.allow(user_id):
+        notice = turn_away_reply(user_id, message, "user")
+        if notice:
+            send_message(user_id, notice)
+        return
+    if not load_shedder.try_enter():
+        notice = turn_away_reply(user_id, message, "global")
+        if notice:
+            send_message(user_id, notice)
+        return
+    try:
+        process_incoming_message(with_deferred_texts(user_id, message), contacts)
+    finally:
+        load_shedder.leave()
+
+def process_incoming_message(message: dict, contacts: list) -> None:
+    """Run the full reply pipeline for a single inbound WhatsApp message."""
+    user_id = message.get("from")
+    msg_type = message.get("type", "unknown")
+    user_name = None
+    user_phone = user_id
+    
+    #get user name from contacts
+    for contact in contacts:
+        if contact.get("wa_id") == user_id:
+            profile = contact.get("profile", {})
+            user_name = profile.get("name")
+            break
+    
+    if msg_type == "text":
+        text_body = (message.get("text") or {}).get("body")
+        if not text_body:
+            return
+
+        is_new_user = is_first_time_user(user_id)
+        
+        #nly detect location for new users (phone numbers don't change countries)
+        if is_new_user:
+            location_data = detect_user_location(user_id)
+            if location_data:
+                save_user_location(user_id, location_data, user_name)
+        
+        if is_new_user:
+            logging.info("New user registered")
+
+        # save user message to database (synchronously: a failure must reach the user as ERR100)
+        saved = save_message_to_db(
+            user_id=user_id,
+            message=text_body,
+            sender_type="user",
+            message_type="text",
+            user_name=user_name,
+            phone_number=user_phone,
+            sync=True
+        )
+        if not saved:
+            send_message(user_id, make_user_safe_error("ERR100"))
+            return
+
+        # send welcome message to new users
+        if is_new_user:
+            welcome_msg = build_welcome_message(user_name)
+            send_message(user_id, welcome_msg)
+            
+            save_message_to_db(
+                user_id=user_id,
+                message=welcome_msg,
+                sender_type="bot",
+                message_type="text",
+                user_name=user_name,
+                phone_number=user_phone
+            )
+            
+
+
+        if COALESCE_WINDOW > 0:
+            # answered once the user's burst goes quiet, together with the texts around it
+            message_coalescer.add(user_id, text_body, user_name, user_phone)
+        else:
+            reply_to_turn(user_id, text_body, user_name, user_phone)
+
+    else:
+        # handle non-text messages
+        save_message_to_db(user_id, f"[{msg_type.upper()}]", "user", msg_type)
+        fallback = ("I currently support text messages only. "
+                    "Please send your request as text.")
+        send_message(user_id, fallback)
+
+
+def reply_to_turn(user_id: str, text_body: str, user_name: str | None = None, user_phone: str | None = None):
+    """Generate, store and send the bot's answer to one user turn (a single text or a coalesced burst)."""
+    # generate AI reply (streaming mode sends it chunk by chunk while generating)
+    reply_sent = False
+    if AI_STREAMING:
+        reply_text, reply_sent = stream_ai_reply(user_id, text_body)
+    else:
+        reply_text = generate_ai_reply_with_context(user_id, text_body)
+
+    # save bot reply to database
+    save_message_to_db(
+        user_id=user_id,
+        message=reply_text,
+        sender_type="bot",
+        message_type="text",
+        user_name=user_name,
+        phone_number=user_phone
+    )
+    note_turns_for_summary(user_id, [text_body, reply_text])
+
+    # send reply to user
+    if not reply_sent:
+        send_ok = send_message(user_id, reply_text)
+        if not send_ok:
+            logging.error("Failed to send WhatsApp message to %s", user_id)
+
+
+class MessageCoalescer:
+    """Debounces bursts of texts from one user into a single reply turn.
+
+    Every text restarts its user's COALESCE_WINDOW timer; when the timer runs out, or
+    COALESCE_MAX_WAIT after the first text of the burst, the texts are joined and answered
+    with one completion on a few worker threads. A user never has two turns running at
+    once: texts that arrive while a reply is being generated form the next burst.
+    """
+
+    def __init__(self, window: float, max_wait: float, workers: int, reply_fn):
+        self.window = window
+        self.max_wait = max(window, max_wait)
+        self.workers = max(1, workers)
+        self.reply_fn = reply_fn
+        self._bursts = {}  # user_id -> {"texts", "first", "due", "user_name", "user_phone"}
+        self._running = set()  # users whose turn is being answered right now
+        self._cond = threading.Condition()
+        self._thread = None
+        self._workers = WorkerThreads(self.workers, "coalesced-turn")
+        self._closed = False
+        self.messages = 0
+        self.turns = 0
+
+    def start(self):
+        with self._cond:
+            if self._thread is not None or self._closed:
+                return
+            self._thread = threading.Thread(target=self._run, name="message-coalescer", daemon=True)
+            self._thread.start()
+
+    def add(self, user_id: str, text: str, user_name: str | None = None, user_phone: str | None = None):
+        if self._closed:
+            # shutting down: answer late arrivals directly instead of holding them
+            self.reply_fn(user_id, text, user_name, user_phone)
+            return
+        self.start()
+        now = time.monotonic()
+        with self._cond:
+            burst = self._bursts.get(user_id)
+            if burst is None:
+                burst = self._bursts[user_id] = {"texts": [], "first": now, "user_name": user_name,
+                                                 "user_phone": user_phone}
+            burst["texts"].append(text)
+            burst["due"] = min(now + self.window, burst["first"] + self.max_wait)
+            self.messages += 1
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._closed and not self._bursts:
+                        return
+                    now = time.monotonic()
+                    idle = {u: b for u, b in self._bursts.items() if u not in self._running}
+                    ready = [u for u, b in idle.items() if self._closed or b["due"] <= now]
+                    if ready:
+                        break
+                    self._cond.wait(min((b["due"] - now for b in idle.values()), default=None))
+                batches = []
+                for user_id in ready:
+                    batches.append((user_id, self._bursts.pop(user_id)))
+                    self._running.add(user_id)
+            for user_id, burst in batches:
+                self._workers.submit(self._reply, user_id, burst)
+
+    def _reply(self, user_id: str, burst: dict):
+        try:
+            self.reply_fn(user_id, "\n".join(burst["texts"]), burst["user_name"], burst["user_phone"])
+        except Exception as e:
+            dev_log(e, "ERR_COALESCE")
+        finally:
+            with self._cond:
+                self._running.discard(user_id)
+                self.turns += 1
+                self._cond.notify()
+
+    def drain(self, timeout: float = QUEUE_DRAIN_TIMEOUT):
+        """Answer every pending burst now and wait for the replies (called on shutdown)."""
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify()
+        if self._thread is None:
+            return
+        deadline = time.monotonic() + timeout
+        self._thread.join(timeout)
+        self._workers.shutdown(max(0, deadline - time.monotonic()))
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "messages": self.messages,
+                "turns": self.turns,
+                "ratio": round(self.messages / self.turns, 2) if self.turns else 0.0,
+                "pending_users": len(self._bursts),
+            }
+
+
+message_coalescer = MessageCoalescer(COALESCE_WINDOW, COALESCE_MAX_WAIT, COALESCE_WORKERS, reply_to_turn)
+atexit.register(message_coalescer.drain)  # registered before work_queue, so it runs after the queue drains
+
+
+class LocalWorkQueue:
+    """In-process work queue split into per-user lanes.
+
+    Each lane is a FIFO drained by exactly one consumer thread, and a user is always
+    hashed to the same lane, so one user's messages are handled strictly in arrival
+    order while different users run in parallel across lanes. Threads are started
+    lazily on the first submit so gunicorn workers (including --preload setups) each
+    get their own consumers after fork.
+    """
+
+    def __init__(self, workers: int, maxsize: int):
+        self.workers = max(1, workers)
+        lane_size = max(1, -(-maxsize // self.workers)) if maxsize > 0 else 0
+        self._lanes = [queue.Queue(maxsize=lane_size) for _ in range(self.workers)]
+        self._processed = [0] * self.workers
+        self._peak = [0] * self.workers
+        self._threads = []
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def start(self):
+        with self._lock:
+            if self._threads or self._closed:
+                return
+            for i, lane in enumerate(self._lanes):
+                t = threading.Thread(target=self._consume, args=(i,), name=f"webhook-lane-{i}", daemon=True)
+                t.start()
+                self._threads.append(t)
+            logging.info("200 Work queue started with %d lanes", self.workers)
+
+    def lane_for(self, user_id: str | None) -> int:
+        # crc32 rather than hash() so lane assignment is stable across processes
+        return zlib.crc32((user_id or "").encode("utf-8")) % self.workers
+
+    def submit(self, message: dict, contacts: list, timeout: float = QUEUE_PUT_TIMEOUT) -> bool:
+        """Enqueue a message on its user's lane; returns False when the lane stays full for `timeout` seconds."""
+        if self._closed:
+            return False
+        self.start()
+        index = self.lane_for(message.get("from"))
+        lane = self._lanes[index]
+        try:
+            lane.put((message, contacts), timeout=timeout)
+        except queue.Full:
+            return False
+        self._peak[index] = max(self._peak[index], lane.qsize())
+        return True
+
+    def depth(self) -> int:
+        return sum(lane.qsize() for lane in self._lanes)
+
+    def lane_stats(self) -> list:
+        """Current depth, peak depth and processed count for every lane."""
+        return [
+            {"lane": i, "depth": lane.qsize(), "peak_depth": self._peak[i], "processed": self._processed[i]}
+            for i, lane in enumerate(self._lanes)
+        ]
+
+    def _consume(self, index: int):
+        lane = self._lanes[index]
+        while True:
+            item = lane.get()
+            try:
+                if item is None:
+                    return
+                message, contacts = item
+                handle_incoming_message(message, contacts)
+                self._processed[index] += 1
+            except Exception as e:
+                error_id = str(uuid.uuid4())[:8]
+                dev_log(e, f"WORKER_ERR_{error_id}")
+            finally:
+                lane.task_done()
+
+    def drain(self, timeout: float = QUEUE_DRAIN_TIMEOUT):
+        """Stop accepting work, let every lane finish what is queued and join the consumers."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            threads = list(self._threads)
+        if not threads:
+            return
+        logging.info("Draining work queue (%d pending)", self.depth())
+        for lane in self._lanes:
+            lane.put(None)
+        deadline = time.monotonic() + timeout
+        for t in threads:
+            t.join(max(0.0, deadline - time.monotonic()))
+        if any(t.is_alive() for t in threads):
+            logging.error("Work queue drain timed out with %d messages pending", self.depth())
+        else:
+            logging.info("200 Work queue drained")
+
+
+work_queue = LocalWorkQueue(WORKER_THREADS, QUEUE_MAXSIZE)
+atexit.register(work_queue.drain)
+
+class MessageDeduplicator:
+    """Remembers handled WhatsApp message ids so Meta redeliveries are dropped before any work.
+
+    A bounded in-memory LRU with TTL answers most lookups; when DEDUP_PERSIST is on the
+    processed_messages collection (TTL indexed) catches redeliveries that land on another
+    worker or arrive after a restart.
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: int):
+        self.max_entries = max(1, max_entries)
+        self.ttl_seconds = ttl_seconds
+        self._seen = OrderedDict()  # message id -> expiry (monotonic seconds)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.persistent_hits = 0
+        self.misses = 0
+
+    def seen_before(self, message_id: str | None) -> bool:
+        """Check-and-mark: True if the id was already handled, otherwise record it and return False."""
+        if not message_id:
+            return False
+        now = time.monotonic()
+        with self._lock:
+            expiry = self._seen.get(message_id)
+            if expiry is not None and expiry > now:
+                self._seen.move_to_end(message_id)
+                self.hits += 1
+                return True
+            self._seen[message_id] = now + self.ttl_seconds
+            self._seen.move_to_end(message_id)
+            while len(self._seen) > self.max_entries:
+                self._seen.popitem(last=False)
+
+        if processed_collection is not None:
+            try:
+                processed_collection.insert_one({"_id": message_id, "created_at": datetime.now(timezone.utc)})
+            except DuplicateKeyError:
+                with self._lock:
+                    self.hits += 1
+                    self.persistent_hits += 1
+                return True
+            except Exception as e:
+                # fail open: a dedup outage must not stop replies
+                dev_log(e, "ERR_DEDUP")
+
+        with self._lock:
+            self.misses += 1
+        return False
+
+    def forget(self, message_id: str | None):
+        """Drop an id again so a redelivery is processed (used when handling failed)."""
+        if not message_id:
+            return
+        with self._lock:
+            self._seen.pop(message_id, None)
+        if processed_collection is not None:
+            try:
+                processed_collection.delete_one({"_id": message_id})
+            except Exception as e:
+                dev_log(e, "ERR_DEDUP")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "persistent_hits": self.persistent_hits,
+                "misses": self.misses,
+                "cached_ids": len(self._seen),
+            }
+
+
+message_dedup = MessageDeduplicator(DEDUP_MAX_ENTRIES, DEDUP_TTL_SECONDS)
+
+class DeliveryTracker:
+    """Folds WhatsApp status callbacks into one message_deliveries document per outbound message.
+
+    Statuses are coalesced in memory per message id and written by a background thread
+    every DELIVERY_FLUSH_INTERVAL seconds, or once DELIVERY_BUFFER_MAX ids are pending, as a
+    single unordered bulk_write. Milestones are set with $min, so callbacks that arrive late,
+    twice or out of order never move a timestamp forward.
+    """
+
+    FIELDS = {"sent": "sent_at", "delivered": "delivered_at", "read": "read_at", "failed": "failed_at"}
+    READ_BUCKETS = (1, 5, 15, 60, 300, 900, 3600, 21600, 86400)
+
+    def __init__(self, max_pending: int, flush_interval: float, max_sent_ids: int = 10000):
+        self.max_pending = max(1, max_pending)
+        self.flush_interval = flush_interval
+        self.max_sent_ids = max_sent_ids
+        self._pending = {}  # message id -> {"recipient_id", "<milestone>_at": datetime, ...}
+        self._sent_at = OrderedDict()  # message id -> sent time, for the in-process read latency histogram
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._closed = False
+        self.read_latency = Histogram(self.READ_BUCKETS)
+        self.recorded = 0
+        self.flushed = 0
+        self.failed = 0
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None or self._closed:
+                return
+            self._thread = threading.Thread(target=self._run, name="delivery-tracker", daemon=True)
+            self._thread.start()
+
+    def record(self, status: dict) -> bool:
+        """Buffer one entry of a webhook's statuses list; returns False for ones we don't track."""
+        field = self.FIELDS.get(status.get("status"))
+        message_id = status.get("id")
+        if field is None or not message_id or delivery_collection is None:
+            return False
+        try:
+            at = datetime.fromtimestamp(int(status.get("timestamp")), timezone.utc)
+        except (TypeError, ValueError, OverflowError):
+            at = datetime.now(timezone.utc)
+
+        self.start()
+        read_after = None
+        with self._lock:
+            entry = self._pending.setdefault(message_id, {"recipient_id": status.get("recipient_id")})
+            if field not in entry or at < entry[field]:
+                entry[field] = at
+            if field == "failed" and status.get("errors"):
+                entry["error_code"] = (status["errors"][0] or {}).get("code")
+            if field == "sent":
+                self._sent_at[message_id] = at
+                while len(self._sent_at) > self.max_sent_ids:
+                    self._sent_at.popitem(last=False)
+            elif field == "read" and message_id in self._sent_at:
+                read_after = (at - self._sent_at.pop(message_id)).total_seconds()
+            self.recorded += 1
+            full = len(self._pending) >= self.max_pending
+        if read_after is not None:
+            self.read_latency.observe(max(0.0, read_after))
+        if self._closed:
+            self.flush()
+        elif full:
+            self._wakeup.set()
+        return True
+
+    def pending(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+    def _run(self):
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self) -> int:
+        """Write everything pending now; returns the number of message ids written."""
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            if not pending or delivery_collection is None:
+                return 0
+
+            ops = []
+            for message_id, entry in pending.items():
+                update = {
+                    "$min": {f: entry[f] for f in self.FIELDS.values() if f in entry},
+                    "$setOnInsert": {"recipient_id": entry.get("recipient_id")},
+                }
+                if entry.get("error_code") is not None:
+                    update["$set"] = {"error_code": entry["error_code"]}
+                ops.append(UpdateOne({"_id": message_id}, update, upsert=True))
+            try:
+                delivery_collection.bulk_write(ops, ordered=False)
+                self.flushed += len(ops)
+                return len(ops)
+            except Exception as e:
+                dev_log(e, "ERR_DELIVERY_SAVE")
+                self.failed += len(ops)
+                return 0
+
+    def close(self):
+        """Stop the flusher and write whatever is still pending (called on shutdown)."""
+        self._closed = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.flush_interval + 5)
+        self.flush()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "recorded": self.recorded,
+                "flushed": self.flushed,
+                "failed": self.failed,
+                "pending": len(self._pending),
+            }
+
+
+delivery_tracker = DeliveryTracker(DELIVERY_BUFFER_MAX, DELIVERY_FLUSH_INTERVAL)
+atexit.register(delivery_tracker.close)
+
+def get_delivery_stats(since: datetime | None = None) -> dict:
+    #delivered/read/failed counts and average send->delivered / send->read latency, in one aggregation
+    if delivery_collection is None:
+        return {"error": "Delivery tracking disabled"}
+
+    def seconds_between(start: str, end: str) -> dict:
+        return {"$divide": [{"$subtract": [end, start]}, 1000]}
+
+    def has(field: str) -> dict:
+        return {"$cond": [{"$gt": [field, None]}, 1, 0]}
+
+    try:
+        pipeline = [{"$match": {"sent_at": {"$gte": since}}}] if since else []
+        pipeline.append({"$group": {
+            "_id": None,
+            "messages": {"$sum": 1},
+            "sent": {"$sum": has("$sent_at")},
+            "delivered": {"$sum": has("$delivered_at")},
+            "read": {"$sum": has("$read_at")},
+            "failed": {"$sum": has("$failed_at")},
+            "avg_delivery_seconds": {"$avg": seconds_between("$sent_at", "$delivered_at")},
+            "avg_read_seconds": {"$avg": seconds_between("$sent_at", "$read_at")},
+            "max_read_seconds": {"$max": seconds_between("$sent_at", "$read_at")},
+        }})
+        row = next(delivery_collection.aggregate(pipeline), None) or {}
+        row.pop("_id", None)
+        return row or {"messages": 0}
+    except Exception as e:
+        logging.error("Error getting delivery stats: %s", e)
+        return {"error": str(e)}
+
+_MESSAGES_KEY = b'"messages"'
+_STATUSES_KEY = b'"statuses"'
+
+def is_status_only_payload(raw: bytes) -> bool:
+    """Byte scan for sent/delivered/read callbacks, which never carry a "messages" key.
+
+    A quote inside user text is always escaped in JSON, so the key cannot be faked by content.
+    """
+    return _MESSAGES_KEY not in raw and _STATUSES_KEY in raw
+
+def validate_webhook_payload(data) -> str | None:
+    """Structural check of a parsed Meta webhook body; returns why it is malformed, or None."""
+    if not isinstance(data, dict):
+        return "body is not a JSON object"
+    entries = data.get("entry")
+    if not isinstance(entries, list):
+        return "missing entry list"
+    for entry in entries:
+        if not isinstance(entry, dict) or not isinstance(entry.get("changes", []), list):
+            return "malformed entry"
+        for change in entry.get("changes", []):
+            if not isinstance(change, dict) or not isinstance(change.get("value", {}), dict):
+                return "malformed change"
+            value = change.get("value", {})
+            for key in ("messages", "contacts", "statuses"):
+                items = value.get(key)
+                if items is not None and not (isinstance(items, list) and all(isinstance(i, dict) for i in items)):
+                    return f"malformed {key}"
+            for message in value.get("messages") or []:
+                if not message.get("from") or not isinstance(message["from"], str):
+                    return "message without sender"
+                if not isinstance(message.get("id", ""), str) or not isinstance(message.get("type", ""), str):
+                    return "malformed message"
+    return None
+
 @app.route("/webhook", methods=["GET"])
 def verify():
     #Verification endpoint for WhatsApp webhoo
@@ -456,9 +3476,29 @@ def verify():
 @app.route("/webhook", methods=["POST"])
 def webhook():
     """Main webhook entrypoint from WhatsApp."""
-    data = request.get_json(silent=True) or {}
+    raw = request.get_data(cache=True)
+    if not DELIVERY_TRACKING_ENABLED and is_status_only_payload(raw):
+        # the bulk of Meta's traffic; nothing to do with it, so skip parsing altogether
+        metrics.inc("webhook_fast_path_total", {"kind": "status"})
+        return jsonify({"status": "received"}), 200
+
+    with metrics.stage("webhook_parse"):
+        try:
+            data = json.loads(raw)
+        except ValueError:
+            data = None
+        problem = validate_webhook_payload(data)
+    if problem:
+        metrics.inc("webhook_rejected_total")
+        logging.warning("Rejected malformed webhook payload: %s", problem)
+        return jsonify({"status": "invalid", "error": problem}), 400
     logging.info("200 Received message")
 
+    if MONGO_URI and collection is None and not database_supervisor.wait_ready(DB_READY_TIMEOUT):
+        # without the database every existing user looks new and saving fails with ERR100; let Meta redeliver
+        logging.error("Database not connected yet; asking WhatsApp to retry")
+        return jsonify({"status": "unavailable"}), 503
+
     try:
         for entry in data.get("entry", []):
             for change in entry.get("changes", []):
@@ -466,99 +3506,27 @@ def webhook():
                 messages = value.get("messages") or []
                 contacts = value.get("contacts") or []
                 
-                if messages:
-                    for message in messages:
-                        user_id = message.get("from")
-                        msg_type = message.get("type", "unknown")
-                        user_name = None
-                        user_phone = user_id
-                        
-                        #get user name from contacts
-                        for contact in contacts:
-                            if contact.get("wa_id") == user_id:
-                                profile = contact.get("profile", {})
-                                user_name = profile.get("name")
-                                break
-                        
-                        if msg_type == "text":
-                            text_body = (message.get("text") or {}).get("body")
-                            if not text_body:
-                                continue
-
-                            is_new_user = is_first_time_user(user_id)
-                            
-                            #nly detect location for new users (phone numbers don't change countries)
-                            if is_new_user:
-                                location_data = detect_user_location(user_id)
-                                if location_data:
-                                    save_user_location(user_id, location_data, user_name)
-                            
-                            if is_new_user:
-                                logging.info("New user registered")
-
-                            # save user message to database
-                            saved = save_message_to_db(
-                                user_id=user_id,
-                                message=text_body,
-                                sender_type="user",
-                                message_type="text",
-                                user_name=user_name,
-                                phone_number=user_phone
-                            )
-                            if not saved:
-                                send_message(user_id, make_user_safe_error("ERR100"))
-                                continue
-
-                            # send welcome message to new users
-                            if is_new_user:
-                                welcome_msg = build_welcome_message(user_name)
-                                send_message(user_id, welcome_msg)
-                                
-                                save_message_to_db(
-                                    user_id=user_id,
-                                    message=welcome_msg,
-                                    sender_type="bot",
-                                    message_type="text",
-                                    user_name=user_name,
-                                    phone_number=user_phone
-                                )
-                                
-
-
-                            # generate AI reply
-                            reply_text = generate_ai_reply_with_context(user_id, text_body)
-
-                            # save bot reply to database
-                            save_message_to_db(
-                                user_id=user_id,
-                                message=reply_text,
-                                sender_type="bot",
-                                message_type="text",
-                                user_name=user_name,
-                                phone_number=user_phone
-                            )
-
-                            # send reply to user
-                            send_ok = send_message(user_id, reply_text)
-                            if not send_ok:
-                                logging.error("Failed to send WhatsApp message to %s", user_id)
-
-                        else:
-                            # handle non-text messages
-                            save_message_to_db(user_id, f"[{msg_type.upper()}]", "user", msg_type)
-                            fallback = ("I currently support text messages only. "
-                                        "Please send your request as text.")
-                            send_message(user_id, fallback)
-
-                statuses = value.get("statuses") or []
-                for status in statuses:
-                    try:
-                        msg_id = status.get("id")
-                        recipient_id = status.get("recipient_id")
-                        st = status.get("status")
-
-                    except Exception:
-                        logging.debug("Malformed status object: %s", status)
+                for message in messages:
+                    message_id = message.get("id")
+                    if message_dedup.seen_before(message_id):
+                        logging.info("Skipping redelivered message")
+                        continue
+
+                    if not ASYNC_WEBHOOK:
+                        try:
+                            handle_incoming_message(message, contacts)
+                        except Exception:
+                            message_dedup.forget(message_id)
+                            raise
+                    elif not work_queue.submit(message, contacts):
+                        # queue is saturated: let Meta redeliver later instead of blocking the worker
+                        message_dedup.forget(message_id)
+                        logging.error("Work queue full; asking WhatsApp to retry")
+                        return jsonify({"status": "busy"}), 503
+
+                if DELIVERY_TRACKING_ENABLED:
+                    for status in value.get("statuses") or []:
+                        delivery_tracker.record(status)
 
         return jsonify({"status": "received"}), 200
 
@@ -568,10 +3536,115 @@ def webhook():
         return jsonify({"status": "error", "error": f"Internal error {error_id}"}), 500
 
 
+metrics.register_histogram("stage_seconds", llm_gateway.latency, {"stage": "llm"})
+metrics.register_histogram("stage_seconds", summary_gateway.latency, {"stage": "summary_llm"})
+metrics.register_histogram("whatsapp_request_seconds", whatsapp_sender.latency)
+metrics.register_histogram("stream_first_chunk_seconds", ttfm_histogram)
+metrics.register_histogram("prompt_tokens", prompt_tokens_histogram)
+metrics.register_histogram("delivery_read_seconds", delivery_tracker.read_latency)
+
+@metrics.collector
+def _component_gauges() -> list:
+    gauges = [
+        ("queue_depth_total", None, work_queue.depth()),
+        ("write_buffer_pending", None, write_buffer.pending()),
+        ("mongo_pool_open_connections", None, mongo_pool_listener.open),
+        ("mongo_pool_checked_out", None, mongo_pool_listener.checked_out),
+        ("whatsapp_retries", None, whatsapp_sender.retries),
+        ("whatsapp_failures", None, whatsapp_sender.failures),
+    ]
+    gauges += conversation_archiver.gauges()
+    for lane in work_queue.lane_stats():
+        labels = {"lane": lane["lane"]}
+        gauges.append(("queue_depth", labels, lane["depth"]))
+        gauges.append(("queue_peak_depth", labels, lane["peak_depth"]))
+        gauges.append(("queue_processed", labels, lane["processed"]))
+
+    gauges.append(("turns_inflight", None, load_shedder.inflight))
+    gauges.append(("turns_shed", None, load_shedder.shed))
+
+    for prefix, gateway in (("llm", llm_gateway), ("summary_llm", summary_gateway)):
+        llm = gateway.stats()
+        gauges.append((f"{prefix}_inflight", None, llm["inflight"]))
+        gauges.append((f"{prefix}_rejected", None, llm["rejected"]))
+        for state in ("closed", "open", "half_open"):
+            gauges.append((f"{prefix}_breaker_state", {"state": state}, 1 if llm["state"] == state else 0))
+        for model, count in llm["requests"].items():
+            gauges.append((f"{prefix}_requests", {"model": model}, count))
+        for model, count in llm["errors"].items():
+            gauges.append((f"{prefix}_errors", {"model": model}, count))
+
+    for prefix, stats in (("dedup", message_dedup.stats()),
+                          ("history_cache", history_cache.stats()),
+                          ("response_cache", response_cache.stats()),
+                          ("delivery", delivery_tracker.stats()),
+                          ("rate_limit", rate_limiter.stats()),
+                          ("coalesce", message_coalescer.stats()),
+                          ("known_users", known_users.stats()),
+                          ("database", database_supervisor.stats())):
+        for key, value in stats.items():
+            gauges.append((f"{prefix}_{key}", None, value))
+    return gauges
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    #prometheus text exposition of counters, stage latencies, queue depths and component stats
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+def _on_database_ready():
+    #one-off work that needs the collections; runs in whichever process just connected
+    if ENSURE_INDEXES:
+        ensure_indexes()
+    if ARCHIVE_ENABLED and archive_collection is not None:
+        conversation_archiver.start()
+    if users_collection is not None:
+        threading.Thread(target=known_users.warm, name="known-users-warm", daemon=True).start()
+    threading.Thread(target=migrate_user_summaries, name="user-summaries-migration", daemon=True).start()
+
+_started_at = time.monotonic()
+
+def readiness() -> tuple[bool, dict]:
+    """(ready, details) for /readyz: ready once the database is connected and answering pings."""
+    database = "disabled"
+    if MONGO_URI:
+        if collection is None:
+            database = "connecting"
+        else:
+            database = "ok" if database_supervisor.healthy else "unhealthy"
+    details = {
+        "database": database,
+        "ai": "configured" if GROQ_API_KEY else "disabled",
+        "uptime_seconds": round(time.monotonic() - _started_at, 1),
+    }
+    return database in ("disabled", "ok"), details
+
+@app.before_request
+def ensure_started():
+    # first request in a (possibly forked) worker starts its own database supervisor; cheap afterwards
+    database_supervisor.start()
+
+@app.route("/healthz", methods=["GET"])
+def liveness():
+    #liveness: the process is up and serving requests, whatever the state of its dependencies
+    return jsonify({"status": "alive", "uptime_seconds": round(time.monotonic() - _started_at, 1)}), 200
+
+@app.route("/readyz", methods=["GET"])
+def readiness_endpoint():
+    #readiness: keep traffic away until the database is usable
+    ready, details = readiness()
+    return jsonify({"status": "ready" if ready else "not ready", **details}), 200 if ready else 503
+
+# nothing is started at import: with gunicorn --preload the master imports this module and forks,
+# so the supervisor (and with it the MongoClient, archiver and migration) starts in each worker,
+# from gunicorn.conf.py's post_worker_init or, failing that, ensure_started on the first request
+
+
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5000))
     logging.info("WhatsApp Bot starting on port %d", port)
-    logging.info("Database: %s", "Connected" if collection is not None else "Disabled")
-    logging.info("AI: %s", "Ready" if ai_client is not None else "Disabled") 
-    logging.info("Location: %s", "Ready" if location_collection is not None else "Disabled")
+    logging.info("Database: %s", "Connecting in background" if MONGO_URI else "Disabled")
+    logging.info("AI: %s", "Configured" if GROQ_API_KEY else "Disabled")
+    logging.info("Location: %s", "Connecting in background" if MONGO_URI else "Disabled")
+    logging.info("Webhook mode: %s", f"queued ({WORKER_THREADS} workers)" if ASYNC_WEBHOOK else "inline")
+    database_supervisor.start()
     app.run(host="0.0.0.0", port=port, debug=False)
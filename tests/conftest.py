@@ -0,0 +1,75 @@
+"""Shared fixtures: main.py imported once against a database.
+
+Tests use the mongod at MONGODB_TEST_URI when it is set (its whatsapp_bot_test
+database is wiped between tests) and mongomock otherwise. Checks that need a real
+server, like query plans, are marked `integration` and skipped without
+MONGODB_TEST_URI; selecting them with -m integration and no server is an error,
+so a CI job meant to check plan shape can't pass by skipping.
+
+    python -m pip install pytest mongomock
+    python -m pytest tests
+    MONGODB_TEST_URI=mongodb://localhost:27017 python -m pytest -m integration tests
+"""
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)  # main.py reads codes.json relative to the working directory
+
+import loadtest  # noqa: E402  (patch_mongomock is shared with the load test harness)
+
+TEST_URI = os.getenv("MONGODB_TEST_URI")
+
+needs_mongod = pytest.mark.skipif(not TEST_URI, reason="needs a real mongod: set MONGODB_TEST_URI")
+
+
+def pytest_configure(config):
+    config.addinivalue_line("markers", "integration: needs a real mongod at MONGODB_TEST_URI")
+    if not TEST_URI and "integration" in (config.getoption("markexpr") or "").replace("not integration", ""):
+        raise pytest.UsageError("-m integration needs a real mongod: set MONGODB_TEST_URI")
+
+
+def _atomic_writes(mongomock):
+    # a real server applies each write atomically; mongomock does not, so concurrency tests
+    # would be testing mongomock. One lock per client makes each call behave like one server op.
+    import threading
+    from mongomock.collection import Collection
+
+    lock = threading.RLock()
+    for name in ("insert_one", "insert_many", "update_one", "update_many", "replace_one", "bulk_write",
+                 "find_one_and_update", "delete_one", "delete_many", "find_one", "count_documents"):
+        original = getattr(Collection, name)
+
+        def atomic(self, *args, _original=original, **kwargs):
+            with lock:
+                return _original(self, *args, **kwargs)
+        setattr(Collection, name, atomic)
+
+
+@pytest.fixture(scope="session")
+def main():
+    os.environ.update({
+        "MONGODB_URI": TEST_URI or "mongodb://mongomock", "DATABASE_NAME": "whatsapp_bot_test",
+        "COLLECTION_NAME": "conversations", "BOT_NAME": "Test Bot",
+    })
+    os.environ.pop("GROQ_API_KEY", None)
+    if not TEST_URI:
+        mongomock = pytest.importorskip("mongomock")
+        import pymongo
+        pymongo.MongoClient = mongomock.MongoClient
+        loadtest.patch_mongomock(mongomock)
+        _atomic_writes(mongomock)
+    import main as module
+    assert module.database_supervisor.wait_ready(timeout=30), "database never became ready"
+    return module
+
+
+@pytest.fixture
+def db(main):
+    for name in main.db.list_collection_names():
+        if name != "system.indexes":
+            main.db[name].delete_many({})
+    return main.db
@@ -0,0 +1,52 @@
+"""summarize_conversation against a fake client, and how its summary replaces covered turns."""
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+
+class FakeClient:
+    """chat.completions.create that records each prompt and answers "summary <n>"."""
+
+    def __init__(self):
+        self.prompts = []
+        self.chat = SimpleNamespace(completions=self)
+
+    def create(self, model, messages, stream=False, timeout=None):
+        self.prompts.append(messages[-1]["content"])
+        content = f"summary {len(self.prompts)}"
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+
+def _history(user_id, count):
+    # microsecond timestamps, like the write-through history cache holds
+    start = datetime(2026, 1, 1, 12, tzinfo=timezone.utc)
+    return [{"user_id": user_id, "conversation_id": f"chat_{user_id}", "sender_type": "user" if i % 2 == 0 else "bot",
+             "message": f"turn {i} " + "word " * 20, "timestamp": start + timedelta(seconds=i, microseconds=123456)}
+            for i in range(count)]
+
+
+def test_older_turns_are_folded_in_chunks_and_covered_until_is_the_last_one(main, db, monkeypatch):
+    user_id = "254700000101"
+    history = _history(user_id, 10)
+    main.collection.insert_many([dict(h) for h in history])
+    monkeypatch.setattr(main, "SUMMARY_KEEP_TURNS", 2)
+    monkeypatch.setattr(main, "SUMMARY_MAX_INPUT_TOKENS", 3 * main.estimate_tokens("Assistant: " + history[1]["message"]))
+    client = FakeClient()
+
+    assert main.summarize_conversation(user_id, client=client)
+
+    assert len(client.prompts) == 3  # 8 older turns in chunks of at most 3
+    assert "turn 0 " in client.prompts[0] and "turn 3 " not in client.prompts[0]
+    assert "summary 1" in client.prompts[1]  # each chunk builds on the previous summary
+    assert "turn 7 " in client.prompts[2] and "turn 8 " not in client.prompts[2]
+    stored = main.conversation_summary_collection.find_one({"_id": user_id})
+    assert stored["summary"] == "summary 3"
+    assert stored["turns_covered"] == 8
+    newest_covered = history[7]["timestamp"]
+    assert main._as_utc(stored["covered_until"]) == newest_covered.replace(microsecond=123000)
+
+    # the stored (millisecond) covered_until must still hide turn 7 as the cache holds it
+    main._conversation_summaries.pop(user_id, None)
+    summary = main.get_conversation_summary(user_id)
+    messages = main.assemble_chat_messages(user_id, "next", history, "system", summary)
+    assert [m["content"].split(" ")[1] for m in messages[2:-1]] == ["8", "9"]
+    assert messages[1]["content"].endswith("summary 3")
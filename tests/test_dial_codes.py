@@ -0,0 +1,17 @@
+"""The compiled dial-code index resolves numbers exactly like the old codes.json scan."""
+import loadtest
+
+
+def test_dial_code_index_matches_the_old_scan(main):
+    main.load_dial_code_index()
+    numbers = loadtest.synthetic_numbers(20000, seed=3) + ["+1 (684) 555-0100", "44-7700-900000", "", "abc"]
+
+    for number in numbers:
+        old = loadtest.legacy_detect_user_location(number, main.country_codes)
+        new = main.detect_user_location(number)
+        assert (old or {}).get("country_code") == (new or {}).get("country_code"), number
+
+    batch = main.detect_user_locations(numbers)
+    assert {n: (loc or {}).get("country_code") for n, loc in batch.items()} == {
+        n: (main.detect_user_location(n) or {}).get("country_code") for n in numbers
+    }
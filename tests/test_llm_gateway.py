@@ -0,0 +1,191 @@
+"""LLMGateway against a fake Groq client that injects latency and failures."""
+import asyncio
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+
+class FakeClient:
+    """Exposes chat.completions.create like groq.Groq; `script` maps a model to its behaviour.
+
+    A behaviour is "ok", "fail", a number of seconds to take before answering (a
+    call slower than its timeout raises TimeoutError, like the SDK), ("fail", seconds)
+    to fail after that long, or an Event to wait on before answering.
+    """
+
+    def __init__(self, **script):
+        self.script = script
+        self.calls = []  # (model, timeout)
+        self.chat = SimpleNamespace(completions=self)
+
+    def _answer(self, model: str):
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=f"from {model}"))])
+
+    def create(self, model, messages, stream=False, timeout=None):
+        self.calls.append((model, timeout))
+        behaviour = self.script.get(model, "ok")
+        if isinstance(behaviour, tuple):
+            time.sleep(behaviour[1])
+            behaviour = behaviour[0]
+        if behaviour == "fail":
+            raise RuntimeError(f"{model} is down")
+        if isinstance(behaviour, threading.Event):
+            behaviour.wait(5)
+        elif isinstance(behaviour, (int, float)):
+            time.sleep(min(behaviour, timeout))
+            if behaviour > timeout:
+                raise TimeoutError(f"{model} timed out")
+        return self._answer(model)
+
+
+class FakeAsyncClient(FakeClient):
+    async def create(self, model, messages, stream=False, timeout=None):
+        self.calls.append((model, timeout))
+        behaviour = self.script.get(model, "ok")
+        if isinstance(behaviour, tuple):
+            await asyncio.sleep(behaviour[1])
+            behaviour = behaviour[0]
+        if behaviour == "fail":
+            raise RuntimeError(f"{model} is down")
+        if isinstance(behaviour, (int, float)):
+            await asyncio.sleep(min(behaviour, timeout))
+            if behaviour > timeout:
+                raise TimeoutError(f"{model} timed out")
+        return self._answer(model)
+
+
+def make_gateway(main, cls=None, models=("a", "b", "c"), **overrides):
+    options = dict(timeout=5, max_inflight=4, queue_timeout=1, failure_threshold=2, reset_timeout=0.1)
+    options.update(overrides)
+    return (cls or main.LLMGateway)(list(models), **options)
+
+
+def ask(gateway, client):
+    return gateway.complete([{"role": "user", "content": "hi"}], client=client).choices[0].message.content
+
+
+def test_models_are_tried_in_order_until_one_answers(main):
+    gateway = make_gateway(main)
+    client = FakeClient(a="fail", b="ok", c="ok")
+
+    assert ask(gateway, client) == "from b"
+    assert [model for model, _ in client.calls] == ["a", "b"]
+    stats = gateway.stats()
+    assert stats["errors"] == {"a": 1}
+    assert stats["state"] == "closed"
+
+
+def test_one_deadline_covers_every_model(main):
+    gateway = make_gateway(main, timeout=0.3)
+    client = FakeClient(a=("fail", 0.2), b=1.0, c="ok")  # a fails slowly inside the budget, b would take too long
+
+    started = time.monotonic()
+    with pytest.raises(TimeoutError):
+        ask(gateway, client)
+    elapsed = time.monotonic() - started
+
+    assert elapsed < 0.45
+    assert [model for model, _ in client.calls] == ["a", "b"]  # no time left for c
+    assert client.calls[0][1] == pytest.approx(0.3, abs=0.02)
+    assert client.calls[1][1] <= 0.3 - 0.2 + 0.02  # b only gets what a left over
+
+
+def test_breaker_opens_then_half_open_trial_closes_it(main):
+    gateway = make_gateway(main, models=("a",))
+    failing, healthy = FakeClient(a="fail"), FakeClient(a="ok")
+
+    for _ in range(2):
+        with pytest.raises(RuntimeError):
+            ask(gateway, failing)
+    assert gateway.state == "open"
+    with pytest.raises(main.LLMUnavailableError, match="breaker open"):
+        ask(gateway, healthy)
+    assert healthy.calls == []  # shed without touching the provider
+
+    time.sleep(0.12)
+    assert gateway.state == "half_open"
+    with pytest.raises(RuntimeError):
+        ask(gateway, failing)  # a failed trial opens it again at once
+    assert gateway.state == "open"
+
+    time.sleep(0.12)
+    assert ask(gateway, healthy) == "from a"
+    assert gateway.state == "closed"
+
+
+def test_calls_beyond_max_inflight_are_rejected_after_queue_timeout(main):
+    gateway = make_gateway(main, models=("a",), max_inflight=1, queue_timeout=0.1)
+    release = threading.Event()
+    holder = threading.Thread(target=ask, args=(gateway, FakeClient(a=release)))
+    holder.start()
+    time.sleep(0.05)
+
+    with pytest.raises(main.LLMUnavailableError, match="in flight"):
+        ask(gateway, FakeClient())
+    release.set()
+    holder.join()
+    assert gateway.stats()["rejected"] == 1
+    assert ask(gateway, FakeClient()) == "from a"  # the slot came back
+
+
+def test_only_the_half_open_trial_releases_the_trial_flag(main):
+    gateway = make_gateway(main, models=("a",), max_inflight=1, queue_timeout=1.0,
+                           failure_threshold=1, reset_timeout=0.05)
+    release = threading.Event()
+    errors = {}
+
+    def run(name, client):
+        try:
+            ask(gateway, client)
+        except Exception as e:
+            errors[name] = e
+
+    holder = threading.Thread(target=run, args=("holder", FakeClient(a=release)))
+    holder.start()
+    time.sleep(0.05)
+    waiter = threading.Thread(target=run, args=("waiter", FakeClient()))  # admitted while closed
+    waiter.start()
+    time.sleep(0.05)
+
+    gateway._record(False)  # the provider fails elsewhere: open, then half-open
+    time.sleep(0.25)
+    trial = threading.Thread(target=run, args=("trial", FakeClient()))
+    trial.start()
+    time.sleep(0.05)
+    assert gateway.state == "half_open" and gateway._trial_running
+
+    waiter.join()  # its slot wait runs out first, while the trial is still queued
+    assert "in flight" in str(errors["waiter"])
+    assert gateway._trial_running
+    with pytest.raises(main.LLMUnavailableError, match="breaker open"):
+        ask(gateway, FakeClient())  # a second probe must not get through
+
+    release.set()
+    holder.join()
+    trial.join()
+    assert "trial" not in errors
+    assert not gateway._trial_running
+    assert gateway.state == "closed"
+
+
+def test_async_gateway_shares_the_fallback_and_deadline(main):
+    asgi = pytest.importorskip("asgi")
+    gateway = make_gateway(main, cls=asgi.AsyncLLMGateway, timeout=0.3)
+    client = FakeAsyncClient(a="fail", b=0.1, c="ok")
+
+    async def go():
+        completion = await gateway.complete([{"role": "user", "content": "hi"}], client=client)
+        return completion.choices[0].message.content
+
+    assert asyncio.run(go()) == "from b"
+    assert [model for model, _ in client.calls] == ["a", "b"]
+    assert client.calls[1][1] <= 0.3
+
+    slow = FakeAsyncClient(a=("fail", 0.2), b=1.0)
+    gateway = make_gateway(main, cls=asgi.AsyncLLMGateway, models=("a", "b"), timeout=0.3)
+    started = time.monotonic()
+    with pytest.raises(TimeoutError):
+        asyncio.run(gateway.complete([{"role": "user", "content": "hi"}], client=slow))
+    assert time.monotonic() - started < 0.45
@@ -0,0 +1,23 @@
+"""Every hot query must be served by an index, checked with explain() on a real mongod."""
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from conftest import needs_mongod
+
+
+@pytest.mark.integration
+@needs_mongod
+def test_hot_queries_use_indexes(main, db):
+    assert main.ensure_indexes()
+    # a few documents per collection, so the planner has something to choose between
+    now = datetime.now(timezone.utc)
+    for i in range(20):
+        user_id = f"2547{i:08d}"
+        main.save_message_to_db(user_id, "hello", "user", user_name="Ann", phone_number=user_id, sync=True)
+        main.save_user_location(user_id, main.detect_user_location(user_id), "Ann")
+    if main.archive_collection is not None:
+        main.archive_collection.insert_one({"_id": "254700000001:2020-01-01", "user_id": "254700000001",
+                                            "day": now - timedelta(days=400), "messages": []})
+
+    assert main.check_query_plans("254700000001") == []
@@ -0,0 +1,32 @@
+"""Importing main starts nothing, so gunicorn --preload forks a master with no threads or sockets."""
+import os
+import subprocess
+import sys
+
+from conftest import ROOT
+
+IMPORT_ONLY = """
+import threading
+import main
+assert [t.name for t in threading.enumerate()] == ["MainThread"], threading.enumerate()
+assert main.mongo_client is None and main.collection is None
+
+pid = os.fork()
+if pid == 0:  # a worker: its first request starts its own supervisor
+    main.app.test_client().get("/healthz")
+    alive = main.database_supervisor._thread is not None and main.database_supervisor._thread.is_alive()
+    os._exit(0 if alive and main.database_supervisor._pid == os.getpid() else 1)
+_, status = os.waitpid(pid, 0)
+assert os.waitstatus_to_exitcode(status) == 0, "the forked worker did not start its supervisor"
+assert [t.name for t in threading.enumerate()] == ["MainThread"], "the master started threads"
+print("ok")
+"""
+
+
+def test_import_starts_no_threads_and_workers_start_their_own():
+    env = dict(os.environ, MONGODB_URI="mongodb://10.255.255.1:27017/?serverSelectionTimeoutMS=500",
+               DATABASE_NAME="whatsapp_bot_test", GROQ_API_KEY="")
+    out = subprocess.run([sys.executable, "-c", "import os\n" + IMPORT_ONLY], cwd=ROOT, env=env,
+                         capture_output=True, text=True, timeout=60)
+    assert out.returncode == 0, out.stderr[-2000:]
+    assert out.stdout.strip().endswith("ok")
@@ -0,0 +1,22 @@
+"""Streamed replies are cut into WhatsApp-sized chunks between the min and max lengths."""
+
+
+def test_a_short_opening_paragraph_is_not_sent_on_its_own(main):
+    buffer = "Hi.\n\n" + "word " * (main.STREAM_MIN_CHUNK_CHARS // 5)
+
+    parts, rest = main.cut_stream_buffer(buffer)
+
+    assert parts == []  # no 3-char "Hi." message
+    assert rest == buffer
+
+
+def test_every_chunk_stays_between_the_min_and_max_lengths(main):
+    text = "Hi.\n\n" + "A sentence that goes on for a while. " * 80 + "\n\n" + "x" * (main.STREAM_MAX_CHUNK_CHARS * 2)
+
+    parts, rest = main.cut_stream_buffer(text)
+
+    assert "".join(parts) + rest == text
+    assert parts[0].startswith("Hi.\n\n")
+    for part in parts:
+        assert main.STREAM_MIN_CHUNK_CHARS <= len(part) <= main.STREAM_MAX_CHUNK_CHARS, len(part)
+    assert len(parts[-1]) == main.STREAM_MAX_CHUNK_CHARS  # no space or sentence end: hard cut
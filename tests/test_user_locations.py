@@ -0,0 +1,60 @@
+"""save_user_location / save_user_locations_bulk under concurrent workers."""
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+WORKERS = 16
+SAVES_PER_WORKER = 25
+
+
+def _hammer(fn, workers: int = WORKERS):
+    # release every worker at once and switch threads often, so reads and writes really interleave
+    barrier = threading.Barrier(workers)
+
+    def run(_):
+        barrier.wait()
+        return fn()
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        with ThreadPoolExecutor(workers) as pool:
+            return list(pool.map(run, range(workers)))
+    finally:
+        sys.setswitchinterval(interval)
+
+
+def test_concurrent_saves_count_every_detection(main, db):
+    user_id = "254711111111"
+    location = main.detect_user_location(user_id)
+
+    results = _hammer(lambda: all(main.save_user_location(user_id, location, "Ann") for _ in range(SAVES_PER_WORKER)))
+
+    assert all(results)
+    docs = list(db[main.LOCATION_COLLECTION_NAME].find({"user_id": user_id}))
+    assert len(docs) == 1
+    assert docs[0]["detection_count"] == WORKERS * SAVES_PER_WORKER
+    assert docs[0]["country_code"] == "KE"
+    assert abs((main._as_utc(docs[0]["first_detected"]) - location["detected_at"]).total_seconds()) < 0.001
+
+
+def test_first_detected_survives_later_saves(main, db):
+    user_id = "2348022222222"
+    first = main.detect_user_location(user_id)
+    main.save_user_location(user_id, first)
+    main.save_user_location(user_id, main.detect_user_location(user_id), "Chen")
+
+    doc = db[main.LOCATION_COLLECTION_NAME].find_one({"user_id": user_id})
+    assert doc["detection_count"] == 2
+    assert doc["user_name"] == "Chen"
+    assert abs((main._as_utc(doc["first_detected"]) - first["detected_at"]).total_seconds()) < 0.001
+
+
+def test_concurrent_bulk_backfills_count_once_per_run(main, db):
+    user_ids = [f"2547{i:08d}" for i in range(200)]
+
+    written = _hammer(lambda: main.backfill_user_locations(user_ids), workers=8)
+
+    assert written == [len(user_ids)] * 8
+    locations = db[main.LOCATION_COLLECTION_NAME]
+    assert locations.count_documents({}) == len(user_ids)
+    assert {d["detection_count"] for d in locations.find({}, {"detection_count": 1})} == {8}
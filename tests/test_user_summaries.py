@@ -0,0 +1,49 @@
+"""Rebuilding user_summaries while live messages keep updating them."""
+from datetime import datetime, timedelta, timezone
+
+
+def _message(main, user_id, sender_type, timestamp, name=None):
+    main.collection.insert_one({"user_id": user_id, "conversation_id": f"chat_{user_id}", "sender_type": sender_type,
+                                "message": "hi", "timestamp": timestamp, "user_name": name, "phone_number": user_id})
+    main.update_user_summary(user_id, sender_type, timestamp, name, user_id if name else None)
+
+
+def test_rebuild_keeps_live_updates_that_land_after_its_aggregation(main, db, monkeypatch):
+    user_id = "254700000001"
+    start = datetime(2026, 1, 1, tzinfo=timezone.utc)
+    for i in range(3):
+        _message(main, user_id, "user" if i % 2 == 0 else "bot", start + timedelta(minutes=i), name="Ann")
+
+    bulk_write = main.summary_collection.bulk_write
+
+    def live_message_first(ops, **kwargs):
+        # a webhook saves a message between the rebuild's aggregation and its write
+        _message(main, user_id, "user", start + timedelta(hours=1), name="Ann B")
+        return bulk_write(ops, **kwargs)
+    monkeypatch.setattr(main.summary_collection, "bulk_write", live_message_first)
+
+    assert main.rebuild_user_summaries() == 1
+
+    summary = main.summary_collection.find_one({"_id": user_id})
+    assert summary["total_messages"] == 4
+    assert summary["user_messages"] == 3
+    assert summary["bot_messages"] == 1
+    assert main._as_utc(summary["first_message"]) == start
+    assert main._as_utc(summary["last_message"]) == start + timedelta(hours=1)
+    assert summary["user_name"] == "Ann B"  # the newer live name is not overwritten
+
+
+def test_rebuild_backfills_users_without_a_summary(main, db):
+    user_id = "254700000002"
+    start = datetime(2026, 1, 1, tzinfo=timezone.utc)
+    main.collection.insert_many([
+        {"user_id": user_id, "sender_type": "user", "message": "hi", "timestamp": start,
+         "user_name": "Bo", "phone_number": user_id},
+        {"user_id": user_id, "sender_type": "bot", "message": "hello", "timestamp": start + timedelta(seconds=5)},
+    ])
+
+    assert main.rebuild_user_summaries() == 1
+
+    [user] = main.get_all_users()
+    assert (user["user_id"], user["user_name"], user["total_messages"]) == (user_id, "Bo", 2)
+    assert (user["user_messages"], user["bot_messages"]) == (1, 1)
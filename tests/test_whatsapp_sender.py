@@ -0,0 +1,84 @@
+"""WhatsAppSender resends only when the request never left: a dropped connection may follow delivery."""
+import asyncio
+import socket
+import threading
+
+import pytest
+import requests
+
+
+def _closed_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _hang_up_server():
+    """Reads each request, then closes without answering; returns (port, accepted connection count)."""
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen()
+    accepted = []
+
+    def serve():
+        while True:
+            try:
+                conn, _ = server.accept()
+            except OSError:
+                return
+            accepted.append(conn)
+            conn.recv(65536)
+            conn.close()
+    threading.Thread(target=serve, daemon=True).start()
+    return server, accepted
+
+
+def _sender(cls, port: int):
+    return cls(f"http://127.0.0.1:{port}/v21.0", "1000", "token", pool_size=1, max_rps=0,
+               max_retries=2, backoff_base=0.001)
+
+
+def test_refused_connection_is_retried(main):
+    sender = _sender(main.WhatsAppSender, _closed_port())
+
+    assert sender.send("254700000001", "hi") is False
+    assert sender.retries == 2
+
+
+def test_connection_dropped_after_the_request_is_not_resent(main):
+    server, accepted = _hang_up_server()
+    sender = _sender(main.WhatsAppSender, server.getsockname()[1])
+    try:
+        assert sender.send("254700000001", "hi") is False
+    finally:
+        server.close()
+    assert len(accepted) == 1
+    assert sender.retries == 0
+
+
+def test_connect_timeout_is_retried_and_read_timeout_is_not(main):
+    sender = _sender(main.WhatsAppSender, _closed_port())
+    assert sender._on_error(requests.ConnectTimeout("connect timed out"), 0, 0.0) is True
+    assert sender._on_error(requests.ReadTimeout("read timed out"), 0, 0.0) is False
+    assert sender._on_error(requests.ConnectionError("('Connection aborted.', RemoteDisconnected())"), 0, 0.0) is False
+
+
+def test_async_sender_follows_the_same_rules(main):
+    asgi = pytest.importorskip("asgi")
+    refused = _sender(asgi.AsyncWhatsAppSender, _closed_port())
+    server, accepted = _hang_up_server()
+    dropped = _sender(asgi.AsyncWhatsAppSender, server.getsockname()[1])
+
+    async def go():
+        try:
+            return await refused.send("254700000001", "hi"), await dropped.send("254700000001", "hi")
+        finally:
+            for sender in (refused, dropped):
+                if sender._session is not None:
+                    await sender._session.aclose()
+    try:
+        assert asyncio.run(go()) == (False, False)
+    finally:
+        server.close()
+    assert refused.retries == 2
+    assert dropped.retries == 0 and len(accepted) == 1
@@ -1,7 +1,25 @@
+"""Development runner: restarts the bot on source changes without dropping requests.
+
+The runner owns the public PORT and proxies it to a main.py child on a private
+port. On a change it starts a new child, waits for /readyz, switches traffic to
+it, lets the old child finish its in-flight requests, then stops it with SIGINT
+so its atexit hooks drain the work queue, coalescer and write buffers. Editors
+fire several events per save, so changes are debounced into a single reload, and
+a child that fails to start leaves the old one serving.
+
+    python worker.py             # serves http://localhost:$PORT (default 5000)
+"""
+import http.client
+import os
+import signal
+import socket
+import subprocess
 import sys
+import threading
 import time
-import subprocess
-import os
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 from dotenv import load_dotenv
@@ -12,50 +30,244 @@ load_dotenv(override=True)
 
 print("Environment variables loaded from .env file")
 
+PORT = int(os.environ.get("PORT", 5000))
+RELOAD_DEBOUNCE = float(os.getenv("RELOAD_DEBOUNCE", "0.5"))  # seconds of quiet before a batch of changes reloads
+RELOAD_READY_TIMEOUT = float(os.getenv("RELOAD_READY_TIMEOUT", "30"))  # wait this long for the new child's /readyz
+RELOAD_DRAIN_TIMEOUT = float(os.getenv("RELOAD_DRAIN_TIMEOUT", "30"))  # wait this long for the old child to exit
+WATCH_SUFFIXES = (".py", ".json")
+IGNORED_DIRS = {".git", "__pycache__", ".venv", "venv", "env", "node_modules", ".pytest_cache"}
+HOP_BY_HOP = {"connection", "keep-alive", "proxy-connection", "transfer-encoding", "upgrade", "te", "trailer"}
+
+
+def free_port() -> int:
+    # the children can't share PORT (the Flask dev server has no SO_REUSEPORT), so each gets its own
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class Child:
+    """One main.py process on a private port, with a count of proxied requests still open."""
+
+    def __init__(self, script: str, generation: int):
+        self.script = script
+        self.generation = generation
+        self.port = free_port()
+        self.inflight = 0
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        env = dict(os.environ, PORT=str(self.port))
+        # own session: Ctrl+C in the terminal reaches only the runner, which then stops the child itself
+        self.process = subprocess.Popen([sys.executable, script], env=env, start_new_session=True)
+
+    def alive(self) -> bool:
+        return self.process.poll() is None
+
+    def probe(self, path: str) -> bool:
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{self.port}{path}", timeout=2) as response:
+                return response.status == 200
+        except Exception:
+            return False
+
+    def wait_ready(self, timeout: float) -> bool:
+        """True once /readyz answers 200; False if the child died or never became ready."""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if not self.alive():
+                return False
+            if self.probe("/readyz"):
+                return True
+            time.sleep(0.1)
+        if self.probe("/healthz"):
+            # serving but its dependencies are down (e.g. no MongoDB locally); still worth switching to
+            print(f"{self.script} #{self.generation} is up but not ready after {timeout:.0f}s; switching anyway")
+            return True
+        return False
+
+    def acquire(self):
+        with self._lock:
+            self.inflight += 1
+
+    def release(self):
+        with self._lock:
+            self.inflight -= 1
+            if self.inflight == 0:
+                self._idle.notify_all()
+
+    def stop(self, timeout: float):
+        """Wait for proxied requests to finish, then interrupt the child and wait for it to exit."""
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            while self.inflight and time.monotonic() < deadline:
+                self._idle.wait(deadline - time.monotonic())
+        if self.alive():
+            # SIGINT, not SIGTERM: KeyboardInterrupt unwinds normally, so atexit drains queued work
+            if os.name == "nt":
+                self.process.terminate()
+            else:
+                self.process.send_signal(signal.SIGINT)
+            try:
+                self.process.wait(timeout=max(deadline - time.monotonic(), 1))
+            except subprocess.TimeoutExpired:
+                print(f"{self.script} #{self.generation} did not exit in time; killing it")
+                self.process.kill()
+                self.process.wait()
+
+
+class Proxy(ThreadingHTTPServer):
+    """Forwards every request on PORT to the current child."""
+
+    daemon_threads = True
+
+    def __init__(self, port: int):
+        super().__init__(("0.0.0.0", port), ProxyHandler)
+        self.current = None
+        self._lock = threading.Lock()
+
+    def checkout(self):
+        with self._lock:
+            child = self.current
+            if child is not None:
+                child.acquire()  # under the lock, so a swap can't stop a child between pick and count
+            return child
+
+    def swap(self, child):
+        with self._lock:
+            previous, self.current = self.current, child
+            return previous
+
+
+class ProxyHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def forward(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        child = self.server.checkout()
+        if child is None:
+            self.reply(503, [("Content-Type", "text/plain")], b"bot is starting")
+            return
+        try:
+            upstream = http.client.HTTPConnection("127.0.0.1", child.port, timeout=300)
+            headers = {k: v for k, v in self.headers.items() if k.lower() not in HOP_BY_HOP}
+            upstream.request(self.command, self.path, body=body, headers=headers)
+            response = upstream.getresponse()
+            self.reply(response.status, response.getheaders(), response.read())
+            upstream.close()
+        except Exception as e:
+            self.reply(502, [("Content-Type", "text/plain")], f"upstream error: {e}".encode())
+        finally:
+            child.release()
+
+    def reply(self, status: int, headers, payload: bytes):
+        self.send_response(status)
+        for key, value in headers:
+            if key.lower() not in HOP_BY_HOP and key.lower() != "content-length":
+                self.send_header(key, value)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(payload)
+
+    do_GET = do_POST = do_PUT = do_DELETE = do_HEAD = do_PATCH = forward
+
+    def log_message(self, format, *args):
+        pass  # the child logs its own requests
+
+
 class ChangeHandler(FileSystemEventHandler):
-    def __init__(self, script):
+    def __init__(self, script, proxy):
         self.script = script
-        self.process = None
+        self.proxy = proxy
+        self.generation = 0
+        self.changed = set()
+        self._last_event = 0.0
+        self._cond = threading.Condition()
+        self._stopping = False
         self.run_script()
-        
-    def run_script(self):
-        if self.process and self.process.poll() is None:
-            print(f"Terminating existing {self.script} process...")
-            self.process.terminate()
-            self.process.wait(timeout=5)  
-        env = os.environ.copy()
-        print(f"Starting {self.script}...")
-        self.process = subprocess.Popen([sys.executable, self.script], env=env)
-        print(f"{self.script} is now running")
-
-    def on_modified(self, event):
-     
-        if event.src_path.endswith(self.script):
-            print(f'{self.script} has been modified. Restarting...')
+        self._thread = threading.Thread(target=self._run, name="reloader", daemon=True)
+        self._thread.start()
+
+    def run_script(self) -> bool:
+        """Start a new child, switch traffic once it is ready, then drain and stop the old one."""
+        self.generation += 1
+        print(f"Starting {self.script} #{self.generation}...")
+        child = Child(self.script, self.generation)
+        if not child.wait_ready(RELOAD_READY_TIMEOUT):
+            print(f"{self.script} #{self.generation} failed to start; keeping the running process")
+            if child.alive():
+                child.stop(0)
+            return False
+        previous = self.proxy.swap(child)
+        print(f"{self.script} #{self.generation} is now serving on port {PORT}")
+        if previous is not None:
+            print(f"Draining {self.script} #{previous.generation} ({previous.inflight} requests in flight)...")
+            previous.stop(RELOAD_DRAIN_TIMEOUT)
+            print(f"{self.script} #{previous.generation} stopped")
+        return True
+
+    def watched(self, path: str) -> bool:
+        parts = os.path.relpath(path).split(os.sep)
+        if any(part in IGNORED_DIRS or part.startswith(".") for part in parts):
+            return False
+        return path.endswith(WATCH_SUFFIXES)
+
+    def on_any_event(self, event):
+        if event.is_directory or event.event_type not in ("created", "modified", "moved", "deleted"):
+            return
+        paths = [event.src_path, getattr(event, "dest_path", "")]
+        hits = [p for p in paths if p and self.watched(p)]
+        if hits:
+            with self._cond:
+                self.changed.update(os.path.relpath(p) for p in hits)
+                self._last_event = time.monotonic()
+                self._cond.notify()
+
+    def _run(self):
+        # one reload per burst of events: wait until RELOAD_DEBOUNCE passes with no new event
+        while True:
+            with self._cond:
+                while not self.changed and not self._stopping:
+                    self._cond.wait()
+                if self._stopping:
+                    return
+                while (quiet := time.monotonic() - self._last_event) < RELOAD_DEBOUNCE:
+                    self._cond.wait(RELOAD_DEBOUNCE - quiet)
+                changed, self.changed = sorted(self.changed), set()
+            print(f"{', '.join(changed)} changed. Restarting...")
             self.run_script()
 
+    def stop(self):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        child = self.proxy.swap(None)
+        if child is not None:
+            child.stop(RELOAD_DRAIN_TIMEOUT)
+
+
 if __name__ == "__main__":
     script_to_watch = "main.py"
     print("\n===== WhatsApp Bot Runner =====")
     print(f"Starting and monitoring {script_to_watch}")
     print("This script will automatically restart the bot when changes are detected")
-  
-    event_handler = ChangeHandler(script_to_watch)
+
+    proxy = Proxy(PORT)
+    threading.Thread(target=proxy.serve_forever, name="proxy", daemon=True).start()
+    event_handler = ChangeHandler(script_to_watch, proxy)
     observer = Observer()
-    observer.schedule(event_handler, path='.', recursive=False)
+    observer.schedule(event_handler, path='.', recursive=True)
     observer.start()
 
     try:
-        print(f"\nWatching for changes in {script_to_watch}...")
+        print(f"\nWatching *.py and *.json for changes, serving on port {PORT}...")
         print("Press Ctrl+C to stop the bot")
         while True:
             time.sleep(1)
     except KeyboardInterrupt:
         print("\nStopping observer and bot process...")
         observer.stop()
-      
-        if event_handler.process and event_handler.process.poll() is None:
-            event_handler.process.terminate()
-            event_handler.process.wait(timeout=5)
+        event_handler.stop()
+        proxy.shutdown()
         print("Bot stopped successfully")
-    observer.join()
\ No newline at end of file
+    observer.join()